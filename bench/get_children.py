@@ -0,0 +1,44 @@
+# Usage: python -m bench.get_children [rows]
+# Measures FolderDataHandler.get_children on a large table before and after the index migration.
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+from lib.db import Database
+from lib.db.migrations import MIGRATIONS
+
+
+def fill(db: Database, rows: int, folders: int):
+	with db.transaction() as con:
+		con.executemany("INSERT INTO folders (id, user_id, name, parent_folder_id) VALUES (?, ?, ?, ?)",
+			((i, i % 1000, f'folder{i}', (i // 10) or None) for i in range(1, folders + 1)))
+		con.executemany("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id) VALUES (?, ?, ?, ?, ?, ?)",
+			((f'file{i}', f'file{i}.bin', 'application/octet-stream', i % 1000, i, random.randint(1, folders)) for i in range(rows)))
+
+def timeit(db: Database, folders: int, n: int) -> float:
+	ids = [random.randint(1, folders) for _ in range(n)]
+	start = perf_counter()
+	for i in ids:
+		db.folder.get_children(i)
+	return (perf_counter() - start) / n * 1000
+
+def main(rows: int = 1_000_000):
+	folders = max(rows // 100, 1)
+	path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	db = Database(path, lru_size=0)
+	print(f'Filling {rows} files in {folders} folders...')
+	fill(db, rows, folders)
+	for name in ('folders_parent_name', 'files_parent_name', 'folders_user_name'):
+		db.con.execute(f"DROP INDEX {name}")
+	print(f'get_children without indexes: {timeit(db, folders, 20):.3f} ms/call')
+	start = perf_counter()
+	db.con.executescript(MIGRATIONS[1])
+	print(f'Migration took {perf_counter() - start:.2f} s')
+	print(f'get_children with indexes:    {timeit(db, folders, 2000):.3f} ms/call')
+	db.con.close()
+	os.remove(path)
+
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
@@ -0,0 +1,373 @@
+# Usage: python -m bench.load [scenario ...] [--users N] [--rounds N] [--latency S] [--rate-limit P] [--save FILE] [--baseline FILE]
+# Runs the real bot (lib.ui.main with TelegramBot, TelegramIO and Database) against an in-process fake Bot API
+# with configurable latency and injected 429 responses. Synthetic users drive the handlers concurrently, each
+# waiting for the bot's reply before the next action, and every scenario reports throughput, reply latency
+# percentiles, SQLite statements and API calls per action. --save records the results as a baseline,
+# --baseline compares against one, --metrics and --slow turn on lib.metrics instrumentation.
+import os
+import sys
+import json
+import random
+import logging
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Condition, Event, Thread
+from time import perf_counter, sleep
+from telebot import TeleBot, apihelper, types as tt
+from lib.bot import TelegramBot, OutboundScheduler
+from lib.db import Database
+from lib.io import TelegramIO
+from lib.metrics import Metrics
+from lib.ui import main as bot_main, ensure_home
+
+
+TOKEN = '123:bench'
+STORAGE_CHAT = -100
+
+
+class FakeResponse:
+	def __init__(self, status_code: int, body: dict):
+		self.status_code = status_code
+		self.body = body
+		self.text = json.dumps(body)
+
+	def json(self) -> dict:
+		return self.body
+
+
+class FakeTelegram:
+	# Installed as telebot's request sender, answers Bot API methods from memory.
+	# Every call sleeps latency plus up to jitter seconds, a rate_limit fraction of calls is answered with 429.
+	# Messages the bot sends or edits are collected per chat, clients wait on them as replies
+	def __init__(self, latency: float = 0.0, jitter: float = 0.0, rate_limit: float = 0.0, retry_after: int = 1, seed: int = 0):
+		self.latency = latency
+		self.jitter = jitter
+		self.rate_limit = rate_limit
+		self.retry_after = retry_after
+		self.random = random.Random(seed)
+		self.cond = Condition()
+		self.ids = count(1)
+		self.files: dict[str, dict] = {}
+		self.messages: dict[tuple[int, int], dict] = {}
+		self.inbox: dict[int, list[dict]] = defaultdict(list)
+		self.calls: Counter = Counter()
+		self.limited = 0
+		self.methods = {
+			'sendMessage': self.send_message, 'sendDocument': self.send_document, 'sendMediaGroup': self.send_media_group,
+			'editMessageText': self.edit_message, 'editMessageReplyMarkup': self.edit_message, 'editMessageCaption': self.edit_message,
+			'getFile': self.get_file,
+		}
+
+	def __call__(self, method: str, url: str, params: dict|None = None, files: dict|None = None, **kwargs) -> FakeResponse:
+		name = url.rsplit('/', 1)[1]
+		with self.cond:
+			self.calls[name] += 1
+			delay = self.latency + self.random.uniform(0, self.jitter)
+			limited = self.random.random() < self.rate_limit
+			self.limited += limited
+		sleep(delay)
+		if limited:
+			return FakeResponse(429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+									  'parameters': {'retry_after': self.retry_after}})
+		handler = self.methods.get(name)
+		return FakeResponse(200, {'ok': True, 'result': handler(params or {}) if handler else True})
+
+	def document(self, name: str, size: int, unique_id: str|None = None) -> dict:
+		n = next(self.ids)
+		doc = {'file_id': f'file{n}', 'file_unique_id': unique_id or f'unique{n}', 'file_name': name,
+			   'mime_type': 'application/octet-stream', 'file_size': size}
+		with self.cond:
+			self.files[doc['file_id']] = doc
+		return doc
+
+	def deliver(self, chat_id: int, message_id: int|None = None, **fields) -> dict:
+		with self.cond:
+			key = (chat_id, message_id or next(self.ids))
+			msg = self.messages[key] = {**self.messages.get(key, {'message_id': key[1], 'date': 0,
+					'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}}), **fields}
+			self.inbox[chat_id].append(msg)
+			self.cond.notify_all()
+		return msg
+
+	def wait(self, chat_id: int, seen: int, timeout: float) -> dict|None:
+		# Next message for chat_id after the first `seen` ones
+		with self.cond:
+			if not self.cond.wait_for(lambda: len(self.inbox[chat_id]) > seen, timeout):
+				return None
+			return self.inbox[chat_id][seen]
+
+	def send_message(self, p: dict) -> dict:
+		return self.deliver(int(p['chat_id']), text=p['text'], reply_markup=markup(p))
+
+	def edit_message(self, p: dict) -> dict:
+		fields = {k: p[k] for k in ('text', 'caption') if k in p}
+		return self.deliver(int(p['chat_id']), int(p['message_id']), reply_markup=markup(p), **fields)
+
+	def send_document(self, p: dict) -> dict:
+		return self.deliver(int(p['chat_id']), document=self.files.get(p['document']), caption=p.get('caption'), reply_markup=markup(p))
+
+	def send_media_group(self, p: dict) -> list[dict]:
+		return [self.deliver(int(p['chat_id']), document=self.files.get(x['media'])) for x in json.loads(p['media'])]
+
+	def get_file(self, p: dict) -> dict:
+		return {**self.files[p['file_id']], 'file_path': f"documents/{p['file_id']}"}
+
+
+def markup(p: dict) -> dict|None:
+	return json.loads(p['reply_markup']) if p.get('reply_markup') else None
+
+
+class BenchBot(TelegramBot):
+	# run() only signals that lib.ui.main has registered its handlers, updates are fed by the clients
+	def __init__(self, scheduler: OutboundScheduler, threads: int, metrics: Metrics|None):
+		super().__init__(TOKEN, bot=TeleBot(TOKEN, parse_mode='HTML', num_threads=threads), scheduler=scheduler, metrics=metrics)
+		self.ready = Event()
+		self.stopped = Event()
+
+	def run(self):
+		self.ready.set()
+		self.stopped.wait()
+
+
+class Client:
+	# A synthetic user. act() feeds one update and waits for the bot's reply, the last
+	# explorer message stands in for the screen whose buttons the user presses
+	def __init__(self, bench: 'Bench', user_id: int):
+		self.bench = bench
+		self.user_id = user_id
+		self.screen: dict|None = None
+		self.latencies: list[float] = []
+		self.errors = 0
+
+	def update(self, **fields) -> dict:
+		return {'update_id': next(self.bench.fake.ids), **fields}
+
+	def message(self, **fields) -> dict:
+		user = {'id': self.user_id, 'is_bot': False, 'first_name': 'bench'}
+		return self.update(message={'message_id': next(self.bench.fake.ids), 'date': 0,
+									'chat': {'id': self.user_id, 'type': 'private'}, 'from': user, **fields})
+
+	def send(self, update: dict):
+		self.bench.tg.bot.process_new_updates([tt.Update.de_json(update)])
+
+	def act(self, update: dict|list[dict], measure: bool = True) -> dict|None:
+		fake = self.bench.fake
+		seen = len(fake.inbox[self.user_id])
+		start = perf_counter()
+		for x in (update if isinstance(update, list) else [update]):
+			self.send(x)
+		reply = fake.wait(self.user_id, seen, self.bench.args.timeout)
+		if reply is None:
+			self.errors += measure
+			return None
+		if measure:
+			self.latencies.append(perf_counter() - start)
+		if reply.get('text') and reply.get('reply_markup'):
+			self.screen = reply
+		return reply
+
+	def command(self, text: str, measure: bool = True) -> dict|None:
+		return self.act(self.message(text=text, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]), measure)
+
+	def text(self, text: str) -> dict|None:
+		return self.act(self.message(text=text))
+
+	def upload(self, docs: list[dict]) -> dict|None:
+		return self.act([self.message(document=x) for x in docs])
+
+	def buttons(self) -> list[tuple[str, str]]:
+		if self.screen is None:
+			return []
+		return [(b['text'], b['callback_data']) for row in self.screen['reply_markup']['inline_keyboard'] for b in row]
+
+	def press(self, data: str) -> dict|None:
+		user = {'id': self.user_id, 'is_bot': False, 'first_name': 'bench'}
+		return self.act(self.update(callback_query={'id': str(next(self.bench.fake.ids)), 'from': user,
+													'chat_instance': 'bench', 'data': data, 'message': self.screen}))
+
+
+def fill(db: Database, user_id: int, parent_id: int, folders: int, files: int, size: int = 1024):
+	with db.transaction() as con:
+		con.executemany("INSERT INTO folders (user_id, name, parent_folder_id) VALUES (?, ?, ?)",
+						[(user_id, f'folder {i:05}', parent_id) for i in range(folders)])
+		con.executemany("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+						[(f'stored{user_id}_{i}', f'file {i:05}.bin', 'application/octet-stream', user_id, i, parent_id, size) for i in range(files)])
+	db.children_cache.clear()
+
+def chain(db: Database, user_id: int, parent_id: int, depth: int):
+	with db.transaction():
+		for i in range(depth):
+			parent_id = db.folder.create_folder(user_id, f'level {i}', parent_id)
+
+
+# Scenarios: setup(client) runs before the clock starts, run(client) performs `rounds` measured actions
+
+def setup_start(c: Client):
+	pass
+
+def run_start(c: Client):
+	for _ in range(c.bench.args.rounds):
+		c.command('/start')
+
+def setup_home(c: Client):
+	c.command('/start', measure=False)
+
+def run_mkdir(c: Client):
+	for i in range(c.bench.args.rounds):
+		c.text(f'new folder {i}')
+
+def setup_wide(c: Client):
+	wide = c.bench.args.wide
+	fill(c.bench.db, c.user_id, ensure_home(c.bench.db, c.user_id).folder_id, wide // 10, wide - wide // 10)
+	c.command('/start', measure=False)
+
+def run_browse_wide(c: Client):
+	# Pages forward through a big folder, back to the first page with /start once the last one is reached
+	for _ in range(c.bench.args.rounds):
+		nxt = [d for t, d in c.buttons() if t == '▶️' and d != 'none']
+		if nxt:
+			c.press(nxt[0])
+		else:
+			c.command('/start')
+
+def setup_files(c: Client):
+	fill(c.bench.db, c.user_id, ensure_home(c.bench.db, c.user_id).folder_id, 0, c.bench.args.wide)
+	c.command('/start', measure=False)
+
+def setup_deep(c: Client):
+	chain(c.bench.db, c.user_id, ensure_home(c.bench.db, c.user_id).folder_id, c.bench.args.depth)
+	c.command('/start', measure=False)
+
+def run_browse_deep(c: Client):
+	# Walks down a chain of nested folders, restarting from the top at the bottom
+	for _ in range(c.bench.args.rounds):
+		down = [d for t, d in c.buttons() if t.startswith('📁 ') and not t.startswith('📁 ..')]
+		if down:
+			c.press(down[0])
+		else:
+			c.command('/start')
+
+def run_preview(c: Client):
+	files = [d for t, d in c.buttons() if d.startswith('file:')]
+	for i in range(c.bench.args.rounds):
+		c.press(files[i % len(files)])
+
+def run_upload(c: Client):
+	# Bursts of documents sent back to back, timed until the upload summary arrives.
+	# Every 4th document is the same content for all users, exercising deduplication
+	fake, args = c.bench.fake, c.bench.args
+	for r in range(args.rounds):
+		docs = [fake.document(f'upload {r}.{i}.bin', 4096, 'shared' if i % 4 == 3 else None) for i in range(args.burst)]
+		c.upload(docs)
+
+
+SCENARIOS = {
+	'start': (setup_start, run_start),
+	'mkdir': (setup_home, run_mkdir),
+	'browse_wide': (setup_wide, run_browse_wide),
+	'browse_deep': (setup_deep, run_browse_deep),
+	'preview': (setup_files, run_preview),
+	'upload': (setup_home, run_upload),
+}
+
+
+class Bench:
+	# One bot instance with a fresh database per scenario
+	def __init__(self, args: argparse.Namespace, directory: str, name: str):
+		self.args = args
+		self.fake = FakeTelegram(args.latency, args.jitter, args.rate_limit, args.retry_after, args.seed)
+		apihelper.CUSTOM_REQUEST_SENDER = self.fake
+		self.db = Database(os.path.join(directory, f'{name}.db'))
+		if args.limits:
+			scheduler = OutboundScheduler()
+		else:
+			scheduler = OutboundScheduler(global_rate=1e9, private_rate=1e9, private_burst=1e9, group_rate=1e9, group_burst=1e9)
+		self.metrics = None
+		if args.metrics or args.slow is not None:
+			self.metrics = Metrics(args.slow / 1000 if args.slow is not None else None)
+			self.metrics.instrument(self.db)
+		self.tg = BenchBot(scheduler, args.threads, self.metrics)
+		storage = TelegramIO(tt.Chat(STORAGE_CHAT, 'supergroup'), self.tg, self.db, args.job_workers)
+		Thread(target=bot_main, args=(self.tg, storage, args.window, args.workers, None, self.metrics), daemon=True).start()
+		self.tg.ready.wait()
+
+	def run(self, setup, run) -> dict:
+		clients = [Client(self, 1000 + i) for i in range(self.args.users)]
+		with ThreadPoolExecutor(len(clients)) as ex:
+			list(ex.map(setup, clients))
+		queries, calls, limited = self.db.pool.query_count(), sum(self.fake.calls.values()), self.fake.limited
+		start = perf_counter()
+		with ThreadPoolExecutor(len(clients)) as ex:
+			list(ex.map(run, clients))
+		elapsed = perf_counter() - start
+		self.tg.stopped.set()
+		latencies = sorted(x for c in clients for x in c.latencies)
+		actions = len(latencies) or 1
+		p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+		return {
+			'actions': len(latencies), 'errors': sum(c.errors for c in clients), 'seconds': elapsed,
+			'throughput': len(latencies) / elapsed, 'p50': p(0.5), 'p95': p(0.95), 'p99': p(0.99), 'max': p(1),
+			'queries': (self.db.pool.query_count() - queries) / actions,
+			'api_calls': (sum(self.fake.calls.values()) - calls) / actions, 'limited': self.fake.limited - limited,
+		}
+
+
+def report(name: str, r: dict, base: dict|None):
+	def delta(key: str) -> str:
+		if not base or not base.get(key):
+			return ''
+		return f' ({(r[key] - base[key]) * 100 / base[key]:+.0f}%)'
+	print(f"{name:12} {r['actions']} actions in {r['seconds']:.2f}s, {r['throughput']:.1f}/s{delta('throughput')}, {r['errors']} timed out")
+	print(f"{'':12} p50={r['p50']:.1f}ms{delta('p50')} p95={r['p95']:.1f}ms{delta('p95')} p99={r['p99']:.1f}ms{delta('p99')} max={r['max']:.1f}ms")
+	print(f"{'':12} {r['queries']:.1f} queries/action{delta('queries')}, {r['api_calls']:.2f} API calls/action{delta('api_calls')}, {r['limited']} calls got 429")
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Synthetic load against the bot with a fake Telegram backend')
+	parser.add_argument('scenarios', nargs='*', help=f'any of {", ".join(SCENARIOS)}, all by default')
+	parser.add_argument('--users', type=int, default=20, help='concurrent synthetic users')
+	parser.add_argument('--rounds', type=int, default=20, help='measured actions per user')
+	parser.add_argument('--latency', type=float, default=0.02, help='seconds every API call takes')
+	parser.add_argument('--jitter', type=float, default=0.01, help='up to this many extra seconds per call')
+	parser.add_argument('--rate-limit', type=float, default=0.0, help='fraction of API calls answered with 429')
+	parser.add_argument('--retry-after', type=int, default=1, help='retry_after of injected 429 responses')
+	parser.add_argument('--limits', action='store_true', help="apply Telegram's rate limits in the outbound scheduler")
+	parser.add_argument('--window', type=float, default=0.05, help='upload coalescing window')
+	parser.add_argument('--workers', type=int, default=8, help='dispatcher workers')
+	parser.add_argument('--threads', type=int, default=2, help='telebot handler threads')
+	parser.add_argument('--job-workers', type=int, default=2)
+	parser.add_argument('--wide', type=int, default=2000, help='children of the folder in browse_wide and preview')
+	parser.add_argument('--depth', type=int, default=50, help='nesting depth in browse_deep')
+	parser.add_argument('--burst', type=int, default=8, help='documents per upload burst')
+	parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a reply')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--metrics', action='store_true', help='run with lib.metrics instrumentation, to measure its overhead')
+	parser.add_argument('--slow', type=float, help='also print traces of callbacks slower than this many ms')
+	parser.add_argument('--save', help='write the results to this JSON file')
+	parser.add_argument('--baseline', help='compare with results saved by --save')
+	args = parser.parse_args()
+	if unknown := set(args.scenarios) - set(SCENARIOS):
+		parser.error(f'unknown scenarios: {", ".join(unknown)}')
+	logging.basicConfig(level=logging.ERROR)
+	logging.getLogger('tgdrive.trace').setLevel(logging.WARNING)
+
+	baseline = {}
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)['results']
+	results = {}
+	with tempfile.TemporaryDirectory() as directory:
+		for name in args.scenarios or SCENARIOS:
+			results[name] = Bench(args, directory, name).run(*SCENARIOS[name])
+			report(name, results[name], baseline.get(name))
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump({'args': vars(args), 'results': results}, f, indent=1)
+	return 1 if any(x['errors'] for x in results.values()) else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
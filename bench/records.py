@@ -0,0 +1,70 @@
+# Usage: python -m bench.records [rows]
+# Compares the old __dict__ records built from fetched tuples with the slotted records built by a row factory,
+# and with streaming a directory through iter_children, on one folder holding `rows` children.
+import os
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+from lib.db import Database
+
+
+class DictFolderData:
+	def __init__(self, folder_id, user_id, name, parent_folder_id):
+		self.folder_id = folder_id
+		self.user_id = user_id
+		self.name = name
+		self.parent_folder_id = parent_folder_id
+
+class DictFileData:
+	def __init__(self, file_id, actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id=None, file_size=None):
+		self.file_id = file_id
+		self.actual_file_id = actual_file_id
+		self.name = name
+		self.mime_type = mime_type
+		self.user_id = user_id
+		self.message_id = message_id
+		self.parent_folder_id = parent_folder_id
+		self.file_unique_id = file_unique_id
+		self.file_size = file_size
+
+def old_children(db: Database, folder_id: int) -> list:
+	# get_children as it was: fetchall, unpack every tuple, concatenate two lists
+	cursor = db.read().cursor()
+	cursor.execute("SELECT id, user_id, name FROM folders WHERE parent_folder_id = ? ORDER BY name, id", (folder_id,))
+	result = [DictFolderData(*x, folder_id) for x in cursor.fetchall()]
+	cursor.execute("SELECT id, actual_file_id, name, mime_type, user_id, message_id, file_unique_id, file_size FROM files WHERE parent_folder_id = ? ORDER BY name, id", (folder_id,))
+	result += [DictFileData(*x[:6], folder_id, *x[6:]) for x in cursor.fetchall()]
+	return result
+
+def stream(db: Database, folder_id: int) -> int:
+	return sum(1 for _ in db.folder.iter_children(folder_id))
+
+def measure(name: str, fn, n: int = 5):
+	tracemalloc.start()
+	kept = fn()
+	current, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	del kept
+	start = perf_counter()
+	for _ in range(n):
+		fn()
+	print(f'{name:<28} {(perf_counter() - start) / n * 1000:8.1f} ms   held {current / 2**20:7.1f} MiB   peak {peak / 2**20:7.1f} MiB')
+
+def main(rows: int = 100_000):
+	path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	db = Database(path, lru_size=0)
+	root = db.folder.create_folder(1, 'root')
+	with db.transaction() as con:
+		con.executemany("INSERT INTO folders (user_id, name, parent_folder_id) VALUES (1, ?, ?)", ((f'folder{i}', root) for i in range(rows // 10)))
+		con.executemany("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size) VALUES (?, ?, 'application/pdf', 1, ?, ?, ?, ?)",
+			((f'BQACAgIAAxkBAAI{i:012}', f'file{i}.pdf', i, root, f'AgAD{i:08}', i * 100) for i in range(rows - rows // 10)))
+	measure('dict records, fetchall', lambda: old_children(db, root))
+	measure('slotted records, factory', lambda: db.folder.get_children(root))
+	measure('iter_children (streamed)', lambda: stream(db, root))
+	db.pool.close()
+	os.remove(path)
+
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
@@ -0,0 +1,49 @@
+# Usage: python -m bench.search [rows] [users]
+# Measures SearchHandler.search on a full-text index with a million folders and files spread over many users.
+import os
+import sys
+import random
+import tempfile
+from time import perf_counter
+from lib.db import Database
+
+
+WORDS = ['report', 'invoice', 'holiday', 'photo', 'backup', 'notes', 'draft', 'final', 'scan', 'contract',
+		 'music', 'lecture', 'project', 'budget', 'resume', 'video', 'archive', 'receipt', 'slides', 'thesis']
+TYPES = ['application/pdf', 'image/jpeg', 'audio/mpeg', 'video/mp4', 'application/zip', 'text/plain']
+
+def name(i: int) -> str:
+	return f'{random.choice(WORDS)} {random.choice(WORDS)} {i}'
+
+def fill(db: Database, rows: int, users: int):
+	folders = max(rows // 20, 1)
+	with db.transaction() as con:
+		con.executemany("INSERT INTO folders (id, user_id, name, parent_folder_id) VALUES (?, ?, ?, NULL)",
+			((i, i % users, name(i)) for i in range(1, folders + 1)))
+		con.executemany("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id) VALUES (?, ?, ?, ?, ?, ?)",
+			((f'file{i}', name(i) + '.bin', random.choice(TYPES), i % users, i, i % folders + 1) for i in range(rows - folders)))
+	db.search.index_pending()
+	db.con.execute("INSERT INTO search (search) VALUES ('optimize')")
+
+def timeit(db: Database, users: int, text: str, n: int) -> float:
+	ids = [random.randrange(users) for _ in range(n)]
+	start = perf_counter()
+	for u in ids:
+		db.search.search(u, text)
+	return (perf_counter() - start) / n * 1000
+
+def main(rows: int = 1_000_000, users: int = 1000):
+	path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+	db = Database(path)
+	print(f'Filling {rows} folders and files for {users} users...')
+	start = perf_counter()
+	fill(db, rows, users)
+	print(f'Indexed in {perf_counter() - start:.1f} s')
+	for text in ['report', 'rep', 're', 'holiday photo', 'pdf', 'final 12', 'nothingmatches']:
+		print(f'search {text!r:>18}: {timeit(db, users, text, 500):.3f} ms/call')
+	db.con.close()
+	os.remove(path)
+
+
+if __name__ == '__main__':
+	main(*map(int, sys.argv[1:]))
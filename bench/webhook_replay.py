@@ -0,0 +1,71 @@
+# Usage: python -m bench.webhook_replay [updates.jsonl] [requests] [concurrency]
+# Replays recorded update JSON (one update per line) against a local WebhookServer and reports
+# acknowledgement and handling latency percentiles. Without a file, synthetic text messages are sent.
+import sys
+import json
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from itertools import cycle, islice
+from time import perf_counter, sleep
+from telebot import TeleBot
+from lib.webhook import WebhookServer
+
+
+SECRET = 'bench-secret'
+
+
+def synthetic(n: int):
+	for i in range(n):
+		yield {'update_id': i, 'message': {
+			'message_id': i, 'date': 0, 'text': f'folder {i}',
+			'chat': {'id': 1000 + i % 100, 'type': 'private'},
+			'from': {'id': 1000 + i % 100, 'is_bot': False, 'first_name': 'bench'},
+		}}
+
+def percentiles(xs: list[float]) -> str:
+	xs = sorted(xs)
+	p = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1000
+	return f'p50={p(0.5):.2f}ms p95={p(0.95):.2f}ms p99={p(0.99):.2f}ms max={xs[-1] * 1000:.2f}ms'
+
+def main(path: str|None = None, requests: int = 5000, concurrency: int = 16):
+	bot = TeleBot('0:bench', threaded=False)
+	@bot.message_handler(content_types=['text'])
+	def handle(msg):
+		pass
+	server = WebhookServer(bot, SECRET, '127.0.0.1', 0)
+	server.start()
+
+	if path:
+		with open(path) as f:
+			updates = [json.loads(x) for x in f if x.strip()]
+		updates = list(islice(cycle(updates), requests))
+	else:
+		updates = list(synthetic(requests))
+	bodies = [json.dumps(x).encode() for x in updates]
+
+	def send(chunk: list[bytes]) -> list[float]:
+		con = http.client.HTTPConnection('127.0.0.1', server.port)
+		out = []
+		for body in chunk:
+			start = perf_counter()
+			con.request('POST', '/', body, {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': SECRET})
+			con.getresponse().read()
+			out.append(perf_counter() - start)
+		con.close()
+		return out
+
+	start = perf_counter()
+	with ThreadPoolExecutor(concurrency) as ex:
+		acks = sum(ex.map(send, [bodies[i::concurrency] for i in range(concurrency)]), [])
+	while len(server.latencies) < server.received:
+		sleep(0.01)
+	elapsed = perf_counter() - start
+	print(f'{server.received} updates in {elapsed:.2f}s ({server.received / elapsed:.0f}/s), {server.rejected} rejected')
+	print(f'ack:      {percentiles(acks)}')
+	print(f'handling: {percentiles(list(server.latencies))}')
+	server.shutdown()
+
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	main(args[0] if args and not args[0].isdigit() else None, *map(int, [x for x in args if x.isdigit()]))
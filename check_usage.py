@@ -0,0 +1,18 @@
+# Usage: python check_usage.py [database] [--fix]
+# Recomputes per-folder and per-user usage totals from scratch and reports where the stored ones drifted.
+import sys
+from utils.funcs import size_to_human
+from lib.db import Database
+
+
+def main(database: str = 'data.db', fix: bool = False):
+	drift = Database(database).usage.check(fix)
+	for kind, id, (count, size), (real_count, real_size) in drift:
+		print(f'{kind} {id}: stored {count} files / {size_to_human(size)}, actual {real_count} files / {size_to_human(real_size)}')
+	print(f'{len(drift)} mismatches' + (', fixed' if fix and drift else ''))
+	return 1 if drift and not fix else 0
+
+
+if __name__ == '__main__':
+	args = [x for x in sys.argv[1:] if x != '--fix']
+	sys.exit(main(*args, fix='--fix' in sys.argv[1:]))
@@ -0,0 +1,5 @@
+from .bot import AsyncTelegramBot, AsyncOutboundScheduler
+from .db import AsyncDatabase
+from .io import AsyncTelegramIO, AsyncUploadCoalescer
+
+__all__ = ['AsyncTelegramBot', 'AsyncOutboundScheduler', 'AsyncDatabase', 'AsyncTelegramIO', 'AsyncUploadCoalescer']
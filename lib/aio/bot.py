@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from time import monotonic
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+from telebot import types as tt
+from typing import Awaitable, Callable, TypeVar
+from lib.base import Service
+from lib.metrics import Metrics
+from lib.bot import OutboundScheduler, RenderedMessages, INTERACTIVE, page_keyboard, render_hash, not_modified
+
+
+T = TypeVar('T')
+
+
+class AsyncOutboundScheduler(OutboundScheduler):
+	# Same buckets and ordering as OutboundScheduler, waiting on the event loop instead of a thread
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.cond = asyncio.Condition()
+
+	async def acquire(self, chat_id: int|None, priority: int = INTERACTIVE):
+		async with self.cond:
+			me = (priority, next(self.seq), chat_id)
+			self.waiters.append(me)
+			try:
+				while True:
+					now = monotonic()
+					waits = {w: self.chat_wait(w[2], now) for w in self.waiters}
+					ready = [w for w, t in waits.items() if t == 0]
+					glob = self.glob.wait_time(now)
+					if ready and min(ready) == me and glob == 0:
+						self.take(chat_id, now)
+						return
+					try:
+						await asyncio.wait_for(self.cond.wait(), max(glob, min(waits.values()), 0.001))
+					except asyncio.TimeoutError:
+						pass
+			finally:
+				self.waiters.remove(me)
+				self.cond.notify_all()
+
+	async def call(self, chat_id: int|None, fn: Callable[..., Awaitable[T]], *args, priority: int = INTERACTIVE, **kwargs) -> T:
+		for attempt in range(self.retries + 1):
+			await self.acquire(chat_id, priority)
+			try:
+				return await fn(*args, **kwargs)
+			except ApiTelegramException as e:
+				if e.error_code != 429 or attempt == self.retries:
+					raise
+				retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 0)
+				delay = max(retry_after, self.backoff * 2 ** attempt)
+				logging.warning(f'Rate limited in chat {chat_id}, retrying in {delay}s')
+				async with self.cond:
+					self.block(chat_id, delay)
+					self.cond.notify_all()
+
+
+class AsyncTelegramBot(Service):
+	def __init__(self, api_key: str, parse_mode = 'HTML', bot: AsyncTeleBot = None, scheduler: AsyncOutboundScheduler = None,
+			  metrics: Metrics|None = None):
+		self.bot = bot or AsyncTeleBot(api_key, parse_mode=parse_mode)
+		self.scheduler = scheduler or AsyncOutboundScheduler()
+		self.rendered = RenderedMessages()
+		self.metrics = metrics
+
+	async def call(self, chat_id: int|None, fn: Callable[..., Awaitable[T]], *args, priority: int = INTERACTIVE, **kwargs) -> T:
+		if self.metrics is None:
+			return await self.scheduler.call(chat_id, fn, *args, priority=priority, **kwargs)
+		with self.metrics.timer('tgdrive_telegram_call_seconds', (('method', fn.__name__),)):
+			return await self.scheduler.call(chat_id, self.metrics.api_async(fn), *args, priority=priority, **kwargs)
+
+	async def polling(self):
+		await self.bot.infinity_polling()
+
+	async def delete(self, message: tt.Message):
+		await self.call(message.chat.id, self.bot.delete_message, message.chat.id, message.id)
+
+	async def text(self, user_id: int, text: str, parse_mode=None, keyboard=None):
+		await self.call(user_id, self.bot.send_message, user_id, text, parse_mode, reply_markup=keyboard)
+
+	async def edit(self, message: tt.Message, text: str, parse_mode=None, keyboard=None):
+		chat_id, message_id = message.chat.id, message.message_id
+		old = self.rendered.get(chat_id, message_id)
+		new = render_hash(text, keyboard)
+		if old == new:
+			return
+		try:
+			if old is not None and old[0] == new[0]:
+				await self.call(chat_id, self.bot.edit_message_reply_markup, chat_id, message_id, reply_markup=keyboard)
+			else:
+				await self.call(chat_id, self.bot.edit_message_text, text, chat_id, message_id, parse_mode=parse_mode, reply_markup=keyboard)
+		except ApiTelegramException as e:
+			if not not_modified(e):
+				logging.info(f'Could not edit message {message_id} in {chat_id}, sending a new one: {e.description}')
+				return await self.text(chat_id, text, parse_mode, keyboard)
+		self.rendered.set(chat_id, message_id, text, keyboard)
+
+	async def list(self, user_id: int, text: str, parse_mode,
+		  entries: list[list[tt.InlineKeyboardButton]],
+		  prev_page: str|None = None, next_page: str|None = None, page_label: str = '',
+		  message: tt.Message|None = None):
+		keyboard = page_keyboard(entries, prev_page, next_page, page_label)
+		if message is not None:
+			await self.edit(message, text, parse_mode, keyboard)
+		else:
+			await self.text(user_id, text, parse_mode, keyboard)
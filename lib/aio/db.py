@@ -0,0 +1,21 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+from lib.db import Database
+
+
+T = TypeVar('T')
+
+
+class AsyncDatabase:
+	# Runs blocking Database calls on a small fixed pool, each worker keeps its own read connection
+	def __init__(self, db: Database, workers: int = 4):
+		self.db = db
+		self.executor = ThreadPoolExecutor(workers, thread_name_prefix='db')
+
+	async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+		# The call sees the caller's context variables, so it shows up in the request's trace
+		ctx = contextvars.copy_context()
+		return await asyncio.get_running_loop().run_in_executor(self.executor, partial(ctx.run, fn, *args, **kwargs))
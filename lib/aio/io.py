@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+from lib.base import Service
+from lib.db import FileData, FolderData
+from lib.bot import BACKGROUND
+from lib.io import UploadBatch, content_key, store_files, release_files
+from utils.funcs import chunks
+from telebot import types as tt
+from telebot.asyncio_helper import ApiTelegramException
+from .bot import AsyncTelegramBot
+from .db import AsyncDatabase
+
+
+class AsyncTelegramIO(Service):
+	def __init__(self, storage: tt.Chat, tg: AsyncTelegramBot, db: AsyncDatabase) -> None:
+		self.chat = storage
+		self.tg   = tg
+		self.db   = db
+		# Storage message deletes running in the background
+		self.tasks: set[asyncio.Task] = set()
+
+	async def _send(self, files: list[tt.Document], caption: str = None) -> list[tt.Message]:
+		if len(files) == 1:
+			return [await self.tg.call(self.chat.id, self.tg.bot.send_document, self.chat.id, files[0].file_id, caption=caption, priority=BACKGROUND)]
+		if not 1 < len(files) <= 10:
+			raise ValueError(f"Media group must have 2-10 files, got {len(files)}")
+		return await self.tg.call(self.chat.id, self.tg.bot.send_media_group, self.chat.id,
+								[tt.InputMediaDocument(f.file_id) for f in files], priority=BACKGROUND)
+
+	async def _send_new(self, files: list[tt.Document], caption: str = None) -> dict[str, int]:
+		# Same as TelegramIO._send_new, content the storage chat already holds isn't forwarded again
+		known = await self.db.run(self.db.db.blob.get_blobs, [f.file_unique_id for f in files if f.file_unique_id])
+		new = list({content_key(f): f for f in files if f.file_unique_id not in known}.values())
+		msgs = await self._send(new, caption) if new else []
+		return {content_key(f): msg.message_id for f, msg in zip(new, msgs)}
+
+	def _store(self, files: list[tt.Document], sent: dict[str, int], folder: FolderData) -> tuple[list[FileData], list[int]]:
+		db = self.db.db
+		file_ids, spare = store_files(db, files, sent, folder)
+		return [db.file.get_file(x) for x in file_ids], spare
+
+	async def upload(self, f: tt.Document, folder: FolderData, caption: str = None) -> FileData:
+		try:
+			stored, spare = await self.db.run(self._store, [f], await self._send_new([f], caption), folder)
+			self._delete_later(spare)
+			return stored[0]
+		except Exception as e:
+			logging.error(f"File upload failed: {e}")
+			raise ValueError("File upload failed")
+
+	async def upload_group(self, files: list[tt.Document], folder: FolderData) -> list[FileData]:
+		try:
+			stored, spare = await self.db.run(self._store, files, await self._send_new(files), folder)
+			self._delete_later(spare)
+			return stored
+		except Exception as e:
+			logging.error(f"File group upload failed: {e}")
+			raise ValueError("File upload failed")
+
+	async def delete(self, file_id: int) -> FileData:
+		# Removes the row now, storage messages nobody references anymore are deleted in the background
+		file, message_ids = await self.db.run(self._delete, file_id)
+		self._delete_later(message_ids)
+		return file
+
+	async def delete_folder(self, folder_id: int) -> list[FileData]:
+		files, message_ids = await self.db.run(self._delete_folder, folder_id)
+		self._delete_later(message_ids)
+		return files
+
+	def _delete(self, file_id: int) -> tuple[FileData, list[int]]:
+		db = self.db.db
+		with db.transaction():
+			file = db.file.get_file(file_id)
+			if file is None:
+				raise ValueError(f"Invalid file: {file_id}")
+			db.file.delete_file(file_id)
+			return file, release_files(db, [file])
+
+	def _delete_folder(self, folder_id: int) -> tuple[list[FileData], list[int]]:
+		db = self.db.db
+		with db.transaction():
+			files = db.folder.delete_folder(folder_id)
+			return files, release_files(db, files)
+
+	def _delete_later(self, message_ids: list[int]):
+		for group in chunks(message_ids, 100):
+			self.tasks.add(t := asyncio.create_task(self._delete_messages(group)))
+			t.add_done_callback(self.tasks.discard)
+
+	async def _delete_messages(self, ids: list[int]):
+		try:
+			if len(ids) == 1:
+				await self.tg.call(self.chat.id, self.tg.bot.delete_message, self.chat.id, ids[0], priority=BACKGROUND)
+			else:
+				await self.tg.call(self.chat.id, self.tg.bot.delete_messages, self.chat.id, ids, priority=BACKGROUND)
+		except ApiTelegramException as e:
+			# Already deleted or too old to delete
+			logging.warning(f"Could not delete storage messages {ids}: {e.description}")
+		except Exception as e:
+			logging.error(f"Could not delete storage messages {ids}: {e}")
+
+
+class AsyncUploadCoalescer:
+	# asyncio counterpart of lib.io.UploadCoalescer
+	def __init__(self, io: AsyncTelegramIO, on_flush: Callable[[int, FolderData, list[FileData], list[tt.Document]], Awaitable[None]],
+			  window: float = 1.5):
+		self.io = io
+		self.on_flush = on_flush
+		self.window = window
+		self.pending: dict[int, UploadBatch] = {}
+		self.tasks: set[asyncio.Task] = set()
+		# Bytes per user of batches being forwarded, there is no job queue to count them in
+		self.flushing: dict[int, int] = {}
+
+	def pending_size(self, user_id: int) -> int:
+		batch = self.pending.get(user_id)
+		return (sum(f.file_size or 0 for f in batch.files) if batch is not None else 0) + self.flushing.get(user_id, 0)
+
+	def add(self, user_id: int, f: tt.Document, folder: FolderData):
+		batch = self.pending.get(user_id)
+		if batch is not None and batch.folder.folder_id != folder.folder_id:
+			batch.timer.cancel()
+			self.tasks.add(t := asyncio.create_task(self.flush(user_id, batch, 0)))
+			t.add_done_callback(self.tasks.discard)
+			batch = None
+		if batch is None:
+			batch = self.pending[user_id] = UploadBatch(folder)
+			batch.timer = asyncio.create_task(self.flush(user_id, batch, self.window))
+		batch.files.append(f)
+
+	async def flush(self, user_id: int, batch: UploadBatch, delay: float):
+		await asyncio.sleep(delay)
+		if self.pending.get(user_id) is batch:
+			del self.pending[user_id]
+		size = sum(f.file_size or 0 for f in batch.files)
+		self.flushing[user_id] = self.flushing.get(user_id, 0) + size
+		try:
+			results = await asyncio.gather(*(self.io.upload_group(g, batch.folder) for g in chunks(batch.files, 10)), return_exceptions=True)
+		finally:
+			if (left := self.flushing[user_id] - size):
+				self.flushing[user_id] = left
+			else:
+				del self.flushing[user_id]
+		uploaded, failed = [], []
+		for group, r in zip(chunks(batch.files, 10), results):
+			if isinstance(r, Exception):
+				failed += group
+			else:
+				uploaded += r
+		try:
+			await self.on_flush(user_id, batch.folder, uploaded, failed)
+		except Exception as e:
+			logging.error(f"Upload flush callback failed for user {user_id}: {e}")
@@ -0,0 +1,242 @@
+import asyncio
+import logging
+from typing import Literal
+from telebot import types as tt
+from lib.db.main import FolderData, FileData, Cursor
+from lib.metrics import Metrics
+from lib.indexer import SearchIndexer
+from lib.ui import HELP_TEXT, parse_commands, ensure_home, create_in_current, file_caption, upload_summary, render_dir, render_search, usage_text, over_quota, paste
+from html import escape
+from utils.funcs import sanitize_folder_name, size_to_human
+from .bot import AsyncTelegramBot
+from .io import AsyncTelegramIO, AsyncUploadCoalescer
+
+
+async def main(tg: AsyncTelegramBot, storage: AsyncTelegramIO, upload_window: float = 1.5, prompt_timeout: float = 300,
+			   quota: int|None = None, metrics: Metrics|None = None):
+	adb = storage.db
+	db = adb.db
+	text_handlers: dict[int, asyncio.Future] = {}
+	tasks: set[asyncio.Task] = set()
+	searches: dict[int, str] = {}
+	selections: dict[int, set[Cursor]] = {}
+	if metrics is not None:
+		metrics.gauge('tgdrive_text_handlers_pending', 'Prompts waiting for an answer from the user', lambda: len(text_handlers))
+		metrics.gauge('tgdrive_tasks_pending', 'Callback commands running in the background', lambda: len(tasks))
+	async def wait_for_text(user_id: int, timeout: float = prompt_timeout) -> str|None:
+		if (old := text_handlers.get(user_id)) is not None:
+			old.cancel()
+		text_handlers[user_id] = t = asyncio.get_running_loop().create_future()
+		try:
+			return await asyncio.wait_for(t, timeout)
+		except (asyncio.TimeoutError, asyncio.CancelledError):
+			return None
+		finally:
+			if text_handlers.get(user_id) is t:
+				del text_handlers[user_id]
+
+
+	async def preview_file(user_id: int, file_id: int):
+		file = await adb.run(db.file.get_file, file_id)
+		kb = tt.InlineKeyboardMarkup([
+			[tt.InlineKeyboardButton("🆗", callback_data='deleteme')]
+		])
+		if file.file_size is not None:
+			await tg.call(user_id, tg.bot.send_document, user_id, file.actual_file_id, caption=file_caption(file), reply_markup=kb)
+			return
+		msg = await tg.call(user_id, tg.bot.send_document, user_id, file.actual_file_id, caption="⏳ Please wait...")
+		await tg.call(user_id, tg.bot.edit_message_caption, file_caption(file, msg.document.file_size), user_id, msg.message_id, reply_markup=kb)
+		await adb.run(db.file.set_file_size, file.file_id, msg.document.file_size)
+
+	async def explore_dir(user_id: int, folder_id: int|None, mode: Literal['browse','delete','rename','select'] = 'browse', page: str|None = None,
+						  message: tt.Message|None = None):
+		r = await adb.run(render_dir, db, user_id, folder_id, mode, page, selected=frozenset(selections.get(user_id, ())))
+		if r is None:
+			await tg.text(user_id, '❌ This folder does not exist or you do not have necessary permissions.')
+			return
+		await tg.list(user_id, *r, message=message)
+		await adb.run(db.user.set_last_opened_folder, user_id, folder_id)
+
+	async def confirm_delete_folder(confirmed: bool, user_id: int, folder_id: int):
+		kb = tt.InlineKeyboardMarkup([[
+			tt.InlineKeyboardButton(f"Yes, delete", callback_data=f'deleteme;delete_folder:{folder_id}:1'),
+			tt.InlineKeyboardButton(f"No, cancel", callback_data=f'deleteme')
+		]])
+		folder = await adb.run(db.folder.get_folder, folder_id)
+		if not folder:
+			return await tg.text(user_id, "❌ This folder has already been deleted")
+		if not confirmed:
+			return await tg.text(user_id, f"Are you sure you want to delete folder \"{folder.name}\"?", keyboard=kb)
+		try:
+			await storage.delete_folder(folder.folder_id)
+			await tg.text(user_id, f"✅ Folder \"{folder.name}\" deleted")
+		except Exception as e:
+			logging.error(f"Error deleting folder {folder_id} by user {user_id}: {e}")
+			await tg.text(user_id, "❌ Error deleting folder")
+
+	async def confirm_delete_file(confirmed: bool, user_id: int, file_id: int):
+		kb = tt.InlineKeyboardMarkup([[
+			tt.InlineKeyboardButton(f"Yes, delete", callback_data=f'deleteme;delete_file:{file_id}:1'),
+			tt.InlineKeyboardButton(f"No, cancel", callback_data=f'deleteme')
+		]])
+		file = await adb.run(db.file.get_file, file_id)
+		if not file:
+			return await tg.text(user_id, "❌ This file has already been deleted")
+		if not confirmed:
+			return await tg.text(user_id, f"Are you sure you want to delete file \"{file.name}\"?", keyboard=kb)
+		try:
+			await storage.delete(file.file_id)
+			await tg.text(user_id, f"✅ File \"{file.name}\" deleted")
+		except Exception as e:
+			logging.error(f"Error deleting file {file_id} by user {user_id}: {e}")
+			await tg.text(user_id, "❌ Error deleting file")
+
+	async def rename_folder(user_id: int, folder_id: int):
+		folder = await adb.run(db.folder.get_folder, folder_id)
+		await tg.text(user_id, f'Send the new name for folder {folder.name}')
+		new_folder_name = await wait_for_text(user_id)
+		if new_folder_name is None:
+			return await tg.text(user_id, '✖️ Renaming cancelled')
+		try:
+			await adb.run(db.folder.rename_folder, folder_id, new_folder_name)
+			logging.info(f"User {user_id} renamed folder {folder_id} to \"{new_folder_name}\"")
+			await tg.text(user_id, f'✅ Folder renamed to \"{new_folder_name}\"')
+		except Exception as e:
+			logging.error(f"Error renaming folder {folder_id} by user {user_id} to \"{new_folder_name}\": {e}")
+			await tg.text(user_id, f'❌ Error renaming folder')
+
+	async def search(user_id: int, text: str|None, offset: int = 0, message: tt.Message|None = None):
+		if text is None:
+			return await tg.text(user_id, '⌛ This search has expired, use /search again')
+		searches[user_id] = text
+		await tg.list(user_id, *(await adb.run(render_search, db, user_id, text, offset)), message=message)
+
+	async def prompt_search(user_id: int):
+		await tg.text(user_id, 'Send the name or type of the file or folder to look for')
+		if (text := await wait_for_text(user_id)) is not None:
+			await search(user_id, text)
+
+	async def paste_selected(user_id: int, action: Literal['move','copy'], folder_id: int, message: tt.Message):
+		done, text = await adb.run(paste, db, user_id, action, folder_id, set(selections.get(user_id, ())), quota)
+		if done:
+			selections.pop(user_id, None)
+		await tg.text(user_id, text)
+		await explore_dir(user_id, folder_id, 'browse', None, message)
+
+	async def upload_done(user_id: int, folder: FolderData, uploaded: list[FileData], failed: list[tt.Document]):
+		await tg.text(user_id, upload_summary(folder, uploaded, failed))
+
+	SearchIndexer(db).start()
+	uploads = AsyncUploadCoalescer(storage, upload_done, upload_window)
+
+
+
+	@tg.bot.message_handler(commands=['help'])
+	async def help(msg: tt.Message):
+		await tg.call(msg.chat.id, tg.bot.reply_to, msg, HELP_TEXT)
+
+	@tg.bot.message_handler(commands=['start'])
+	async def start(msg: tt.Message):
+		u = msg.chat.id
+		root_dir = await adb.run(ensure_home, db, u)
+		await explore_dir(u, root_dir.folder_id)
+
+	@tg.bot.message_handler(commands=['search'])
+	async def search_command(msg: tt.Message):
+		u = msg.chat.id
+		text = msg.text.partition(' ')[2].strip()
+		if text:
+			await search(u, text)
+		else:
+			tasks.add(t := asyncio.create_task(prompt_search(u)))
+			t.add_done_callback(tasks.discard)
+
+	@tg.bot.message_handler(commands=['usage'])
+	async def usage(msg: tt.Message):
+		u = msg.chat.id
+		user = await adb.run(db.user.get_user, u)
+		if user is None or (total := await adb.run(db.usage.user, u)) is None:
+			return await tg.text(u, 'Use /start first')
+		folder_id = user.last_opened_folder_id
+		folder = await adb.run(db.folder.get_folder, folder_id) if folder_id is not None else None
+		await tg.text(u, usage_text(total, total.quota if total.quota is not None else quota, folder,
+								   await adb.run(db.usage.folder, folder_id) if folder is not None else None))
+
+	@tg.bot.message_handler(content_types=['text'])
+	async def handle_text(msg: tt.Message):
+		u = msg.chat.id
+		t = msg.text
+		if (h := text_handlers.get(u, None)) is not None: # Answer pending prompt
+			if not h.done():
+				h.set_result(t)
+		else: # Create new folder
+			name = sanitize_folder_name(t)
+			if name:
+				if await adb.run(create_in_current, db, u, name):
+					await tg.text(u, f"✅ Folder '{name}' created")
+			else:
+				await tg.text(u, "❌ Invalid folder name, try again")
+
+	@tg.bot.message_handler(content_types=['document'])
+	async def upload_file(msg: tt.Message):
+		f = msg.document
+		u = msg.chat.id
+		user = await adb.run(db.user.get_user, u)
+		if (folder_id := user.last_opened_folder_id) is None: return
+		folder = await adb.run(db.folder.get_folder, folder_id)
+		logging.info(f'File from {u} to folder {folder_id}: {f.file_name} ({f.mime_type}) of size {size_to_human(f.file_size)}')
+		if (limit := await adb.run(over_quota, db, u, quota, uploads.pending_size(u) + (f.file_size or 0))) is not None:
+			return await tg.text(u, f'❌ File "{escape(f.file_name or "")}" not uploaded, it would exceed your {size_to_human(limit)} quota')
+		uploads.add(u, f, folder)
+
+	@tg.bot.callback_query_handler(func = lambda x: True)
+	async def buttons_handle(query: tt.CallbackQuery):
+		commands = parse_commands(query.data)
+		user_id = query.from_user.id
+		logging.info(f"Callback from {user_id}: {commands}")
+		async def handle_command(command):
+			cmd = command[0]
+			args = command[1:]
+			try:
+				if cmd == 'none':
+					return
+				elif cmd == 'deleteme':
+					await tg.delete(query.message)
+				elif cmd == 'maint':
+					await tg.text(user_id, "🚧 Please try again later, this option is now under maintenance 🚧")
+				elif cmd == 'explorer':
+					await explore_dir(user_id, int(args[0]), args[1] if len(args) > 1 else 'browse', args[2] if len(args) > 2 else None, query.message)
+				elif cmd == 'search':
+					await search(user_id, searches.get(user_id), int(args[0]), query.message)
+				elif cmd == 'select':
+					selections.setdefault(user_id, set()).symmetric_difference_update({(int(args[0]), int(args[1]))})
+					await explore_dir(user_id, int(args[2]), 'select', args[3] if len(args) > 3 else None, query.message)
+				elif cmd == 'unselect':
+					selections.pop(user_id, None)
+					await explore_dir(user_id, int(args[0]), 'browse', None, query.message)
+				elif cmd == 'paste':
+					await paste_selected(user_id, args[0], int(args[1]), query.message)
+				elif cmd == 'file':
+					await preview_file(user_id, int(args[0]))
+				elif cmd == 'delete_folder':
+					await confirm_delete_folder(int(args[1]) if (len(args) > 1) else 0, user_id, folder_id=int(args[0]))
+				elif cmd == 'delete_file':
+					await confirm_delete_file(int(args[1]) if (len(args) > 1) else 0, user_id, file_id=args[0])
+				elif cmd == 'rename_folder':
+					await rename_folder(user_id, int(args[0]))
+			except Exception as e:
+				logging.error(f"Error in callback command \"{cmd}\" with args {args}: {e}")
+		async def handle_traced(command):
+			with metrics.trace(command[0], user_id):
+				await handle_command(command)
+		for command in commands:
+			# A pending prompt must not hold back the rest of the chain, it isn't traced as it waits for the user
+			if command[0] == 'rename_folder':
+				tasks.add(t := asyncio.create_task(handle_command(command)))
+				t.add_done_callback(tasks.discard)
+			elif metrics is not None:
+				await handle_traced(command)
+			else:
+				await handle_command(command)
+
+	await tg.polling()
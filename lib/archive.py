@@ -0,0 +1,143 @@
+import json
+import logging
+from itertools import islice
+from typing import IO, Iterable, Optional
+from lib.db import Database
+from lib.db.main import FOLDER, FILE
+from lib.db.migrations import NOW
+
+
+# Line-delimited JSON: a header object, then one array per folder (parents before children) and per file,
+# each starting with FOLDER or FILE followed by the fields listed in the header.
+# Archives reference storage chat messages and bot file ids, so they only restore into an instance
+# running with the same bot and storage chat.
+FORMAT = 'tgdrive-tree'
+VERSION = 1
+FOLDER_FIELDS = ['id', 'parent_folder_id', 'name']
+FILE_FIELDS = ['parent_folder_id', 'name', 'mime_type', 'actual_file_id', 'message_id', 'file_unique_id', 'file_size']
+
+# All folders of a user, starting from their root folders
+TREE = """
+WITH RECURSIVE tree(id, parent_folder_id, name) AS (
+	SELECT id, parent_folder_id, name FROM folders WHERE user_id = ? AND parent_folder_id IS NULL
+	UNION ALL
+	SELECT f.id, f.parent_folder_id, f.name FROM folders f JOIN tree t ON f.parent_folder_id = t.id
+)"""
+
+
+def export_tree(db: Database, user_id: int, out: IO[str]) -> dict:
+	# Rows are streamed from SQLite cursors straight to `out`, memory use doesn't depend on the tree size
+	counts = {'folders': 0, 'files': 0}
+	with db.pool.snapshot() as con:
+		root = con.execute("SELECT root_folder_id FROM users WHERE id = ?", (user_id,)).fetchone()
+		out.write(dumps({'format': FORMAT, 'version': VERSION, 'user_id': user_id, 'root_folder_id': root[0] if root else None,
+						 'folder': FOLDER_FIELDS, 'file': FILE_FIELDS}))
+		# Without ORDER BY the recursive query emits rows breadth-first as it goes, so parents always come first
+		for row in con.execute(f"{TREE} SELECT {FOLDER}, id, parent_folder_id, name FROM tree", (user_id,)):
+			out.write(dumps(row))
+			counts['folders'] += 1
+		# Files go by the folders they are in, files.user_id of rows stored before owners were recorded can't be trusted
+		for row in con.execute(f"{TREE} SELECT {FILE}, {', '.join('f.' + x for x in FILE_FIELDS)} FROM files f JOIN tree t ON f.parent_folder_id = t.id", (user_id,)):
+			out.write(dumps(row))
+			counts['files'] += 1
+	return counts
+
+def dumps(x) -> str:
+	return json.dumps(x, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+
+def import_tree(db: Database, user_id: int, lines: Iterable[str], parent_folder_id: Optional[int] = None,
+				batch: int = 10000) -> dict:
+	# Each batch of rows is its own transaction, so a bot running on the same database only ever waits for one batch.
+	# A failed import keeps the batches before it. Old -> new folder ids are kept in a temp table, so parents are
+	# resolved by SQLite and memory use stays flat. Archive roots land under parent_folder_id, or become the user's
+	# root folder if the user has none
+	lines = iter(lines)
+	header = json.loads(next(lines))
+	if (header.get('format'), header.get('version'), header.get('folder'), header.get('file')) != (FORMAT, VERSION, FOLDER_FIELDS, FILE_FIELDS):
+		raise ValueError(f"Not a {FORMAT} v{VERSION} archive")
+	rows = (json.loads(x) for x in lines if x.strip())
+	counts = {'folders': 0, 'files': 0, 'skipped': 0}
+	with db.transaction() as con:
+		con.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+		root = con.execute("SELECT root_folder_id FROM users WHERE id = ?", (user_id,)).fetchone()[0]
+		if parent_folder_id is None:
+			parent_folder_id = root
+		con.execute("DROP TABLE IF EXISTS temp.import_map")
+		con.execute("CREATE TEMP TABLE import_map (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)")
+	try:
+		while chunk := list(islice(rows, batch)):
+			with db.transaction() as con:
+				import_batch(con, user_id, chunk, parent_folder_id, counts)
+		if root is None and header['root_folder_id'] is not None:
+			with db.transaction() as con:
+				con.execute("UPDATE users SET root_folder_id = (SELECT new_id FROM import_map WHERE old_id = ?) WHERE id = ?",
+							(header['root_folder_id'], user_id))
+	finally:
+		with db.transaction() as con:
+			con.execute("DROP TABLE IF EXISTS temp.import_map")
+		db.clear_caches()
+	if counts['skipped']:
+		logging.warning(f"{counts['skipped']} files of the archive had no folder and were skipped")
+	return counts
+
+def import_batch(con, user_id: int, chunk: list, parent_folder_id: Optional[int], counts: dict) -> None:
+	# The bulk_load row turns off the per-row usage and search triggers, their work is done for the batch as a whole.
+	# Ids are taken inside the transaction, the bot may have added rows since the last batch
+	con.execute("INSERT INTO bulk_load (active) VALUES (1)")
+	first_folder = con.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM folders").fetchone()[0]
+	last_file = con.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+	folders = [x[1:] for x in chunk if x[0] == FOLDER]
+	files = [x[1:] for x in chunk if x[0] == FILE]
+	if folders:
+		mapping = [(x[0], first_folder + i) for i, x in enumerate(folders)]
+		con.executemany("INSERT INTO import_map (old_id, new_id) VALUES (?, ?)", mapping)
+		con.executemany("""
+		INSERT INTO folders (id, user_id, name, parent_folder_id)
+			VALUES (?, ?, ?, COALESCE((SELECT new_id FROM import_map WHERE old_id = ?), ?))
+		""", [(new, user_id, x[2], x[1], parent_folder_id) for (_, new), x in zip(mapping, folders)])
+		counts['folders'] += len(folders)
+	if files:
+		share_messages(con, [x[4] for x in files if x[5] is None])
+		con.executemany("""
+		INSERT OR IGNORE INTO blobs (file_unique_id, actual_file_id, message_id)
+			SELECT COALESCE(?, 'message:' || ?), ?, ? WHERE EXISTS (SELECT 1 FROM import_map WHERE old_id = ?)
+		""", [(x[5], x[4], x[3], x[4], x[0]) for x in files])
+		cursor = con.executemany("""
+		INSERT INTO files (parent_folder_id, name, mime_type, actual_file_id, message_id, file_unique_id, file_size, user_id)
+			SELECT new_id, ?, ?, ?, ?, COALESCE(?, 'message:' || ?), ?, ? FROM import_map WHERE old_id = ?
+		""", [(*x[1:5], x[5], x[4], x[6], user_id, x[0]) for x in files])
+		counts['files'] += cursor.rowcount
+		counts['skipped'] += len(files) - cursor.rowcount
+	con.execute("DELETE FROM bulk_load")
+	con.execute("INSERT OR IGNORE INTO search_pending (id) SELECT id * 2 FROM folders WHERE id >= ?", (first_folder,))
+	con.execute("INSERT OR IGNORE INTO search_pending (id) SELECT id * 2 + 1 FROM files WHERE id > ?", (last_file,))
+	# New files count towards every folder above them, new folders and all above them are modified
+	con.execute(f"""
+	WITH RECURSIVE added(folder_id, n, size) AS (
+		SELECT parent_folder_id, COUNT(*), COALESCE(SUM(file_size), 0) FROM files WHERE id > ? GROUP BY parent_folder_id
+		UNION ALL
+		SELECT id, 0, 0 FROM folders WHERE id >= ?
+	), up(folder_id, n, size) AS (
+		SELECT folder_id, n, size FROM added
+		UNION ALL
+		SELECT f.parent_folder_id, u.n, u.size FROM up u JOIN folders f ON f.id = u.folder_id WHERE f.parent_folder_id IS NOT NULL
+	)
+	UPDATE folders SET file_count = file_count + t.n, total_size = total_size + t.size, modified = {NOW}
+		FROM (SELECT folder_id, SUM(n) AS n, SUM(size) AS size FROM up GROUP BY folder_id) t WHERE folders.id = t.folder_id
+	""", (last_file, first_folder))
+	con.execute(f"""
+	UPDATE users SET (file_count, total_size, modified) = (
+		SELECT users.file_count + COUNT(*), users.total_size + COALESCE(SUM(file_size), 0), {NOW} FROM files WHERE id > ?
+	) WHERE id = ? AND EXISTS (SELECT 1 FROM files WHERE id > ?)
+	""", (last_file, user_id, last_file))
+
+def share_messages(con, message_ids: list) -> None:
+	# Imported copies share storage messages with any rows already pointing at them. Rows stored before deduplication
+	# own their message, so they go under blob reference counting first (same as FileDataHandler.share_storage)
+	if not message_ids:
+		return
+	ids = json.dumps(message_ids)
+	con.execute("""INSERT OR IGNORE INTO blobs (file_unique_id, actual_file_id, message_id, refs)
+		SELECT 'message:' || message_id, actual_file_id, message_id, 1 FROM files WHERE file_unique_id IS NULL AND message_id IN (SELECT value FROM json_each(?))""", (ids,))
+	con.execute("UPDATE files SET file_unique_id = 'message:' || message_id WHERE file_unique_id IS NULL AND message_id IN (SELECT value FROM json_each(?))", (ids,))
@@ -1,34 +1,229 @@
+import heapq
+import logging
+import secrets
+from collections import OrderedDict
+from itertools import count
+from threading import Condition, Lock
+from time import monotonic
 from telebot import TeleBot, types as tt
+from telebot.apihelper import ApiTelegramException
 from typing import Callable, TypeVar
+from urllib.parse import urlparse
 from lib.base import Service
-from utils.funcs import chunks 
+from lib.metrics import Metrics
+from lib.webhook import WebhookServer
 
 
 T = TypeVar('T')
 
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class TokenBucket:
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated = monotonic()
+		self.blocked_until = 0.0
+
+	def refill(self, now: float):
+		self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+
+	def wait_time(self, now: float) -> float:
+		self.refill(now)
+		return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0)
+
+	def take(self, now: float):
+		self.refill(now)
+		self.tokens -= 1
+
+	def block(self, now: float, seconds: float):
+		self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class OutboundScheduler:
+	# Every outbound API call waits for a token from the global bucket and from its chat's bucket.
+	# Waiters are served by priority (INTERACTIVE before BACKGROUND), then FIFO, skipping chats that are still limited.
+	# 429 responses block the chat for retry_after (at least exponential backoff) and the call is retried.
+	# chat_id None is for calls that send nothing to a chat (getFile), they only take from the global bucket.
+	def __init__(self, global_rate: float = 30, private_rate: float = 1, private_burst: float = 3,
+			  group_rate: float = 20 / 60, group_burst: float = 20, retries: int = 5, backoff: float = 1.0):
+		self.glob = TokenBucket(global_rate, global_rate)
+		self.private = (private_rate, private_burst)
+		self.group = (group_rate, group_burst)
+		self.retries = retries
+		self.backoff = backoff
+		self.chats: dict[int, TokenBucket] = {}
+		self.waiters: list[tuple[int, int, int]] = []
+		self.seq = count()
+		self.cond = Condition()
+
+	def bucket(self, chat_id: int) -> TokenBucket:
+		b = self.chats.get(chat_id)
+		if b is None:
+			if len(self.chats) > 10000:
+				now = monotonic()
+				for k in [k for k, v in self.chats.items() if v.wait_time(now) == 0 and v.tokens >= v.capacity]:
+					del self.chats[k]
+			b = self.chats[chat_id] = TokenBucket(*(self.group if chat_id < 0 else self.private))
+		return b
+
+	def chat_wait(self, chat_id: int|None, now: float) -> float:
+		return 0.0 if chat_id is None else self.bucket(chat_id).wait_time(now)
+
+	def take(self, chat_id: int|None, now: float):
+		self.glob.take(now)
+		if chat_id is not None:
+			self.bucket(chat_id).take(now)
+
+	def block(self, chat_id: int|None, seconds: float):
+		(self.glob if chat_id is None else self.bucket(chat_id)).block(monotonic(), seconds)
+
+	def acquire(self, chat_id: int|None, priority: int = INTERACTIVE):
+		with self.cond:
+			me = (priority, next(self.seq), chat_id)
+			heapq.heappush(self.waiters, me)
+			try:
+				while True:
+					now = monotonic()
+					waits = {w: self.chat_wait(w[2], now) for w in self.waiters}
+					ready = [w for w, t in waits.items() if t == 0]
+					glob = self.glob.wait_time(now)
+					if ready and min(ready) == me and glob == 0:
+						self.take(chat_id, now)
+						return
+					self.cond.wait(max(glob, min(waits.values()), 0.001))
+			finally:
+				self.waiters.remove(me)
+				heapq.heapify(self.waiters)
+				self.cond.notify_all()
+
+	def call(self, chat_id: int|None, fn: Callable[..., T], *args, priority: int = INTERACTIVE, **kwargs) -> T:
+		for attempt in range(self.retries + 1):
+			self.acquire(chat_id, priority)
+			try:
+				return fn(*args, **kwargs)
+			except ApiTelegramException as e:
+				if e.error_code != 429 or attempt == self.retries:
+					raise
+				retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 0)
+				delay = max(retry_after, self.backoff * 2 ** attempt)
+				logging.warning(f'Rate limited in chat {chat_id}, retrying in {delay}s')
+				with self.cond:
+					self.block(chat_id, delay)
+					self.cond.notify_all()
+
+
+def page_keyboard(entries: list[list[tt.InlineKeyboardButton]], prev_page: str|None = None,
+				  next_page: str|None = None, page_label: str = '') -> tt.InlineKeyboardMarkup:
+	keyboard = tt.InlineKeyboardMarkup(entries)
+	if prev_page or next_page:
+		keyboard.keyboard.append([
+			tt.InlineKeyboardButton('◀️', callback_data=prev_page or 'none'),
+			tt.InlineKeyboardButton(page_label or '·', callback_data='none'),
+			tt.InlineKeyboardButton('▶️', callback_data=next_page or 'none'),
+		])
+	return keyboard
+
+
+class RenderedMessages:
+	# Remembers what was last put into recent messages, so re-rendering identical content is skipped
+	def __init__(self, maxsize: int = 10000):
+		self.maxsize = maxsize
+		self.data: OrderedDict[tuple[int, int], tuple[int, int]] = OrderedDict()
+		self.lock = Lock()
+
+	def get(self, chat_id: int, message_id: int) -> tuple[int, int]|None:
+		with self.lock:
+			return self.data.get((chat_id, message_id))
+
+	def set(self, chat_id: int, message_id: int, text: str, keyboard: tt.InlineKeyboardMarkup|None):
+		with self.lock:
+			self.data[(chat_id, message_id)] = render_hash(text, keyboard)
+			self.data.move_to_end((chat_id, message_id))
+			if len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+
+def render_hash(text: str, keyboard: tt.InlineKeyboardMarkup|None) -> tuple[int, int]:
+	return hash(text), hash(keyboard.to_json() if keyboard else None)
+
+def not_modified(e: ApiTelegramException) -> bool:
+	return e.error_code == 400 and 'message is not modified' in e.description
+
+
 class TelegramBot(Service):
-	def __init__(self, api_key: str, parse_mode = 'HTML'):
-		self.bot = TeleBot(api_key, parse_mode=parse_mode)
+	def __init__(self, api_key: str, parse_mode = 'HTML', bot: TeleBot = None, scheduler: OutboundScheduler = None,
+			  metrics: Metrics|None = None, threaded: bool = True):
+		# threaded=False when updates come through the webhook, its workers run the handlers
+		self.bot = bot or TeleBot(api_key, parse_mode=parse_mode, threaded=threaded)
+		self.scheduler = scheduler or OutboundScheduler()
+		self.rendered = RenderedMessages()
+		self.metrics = metrics
+		self.webhook = None
+
+	def call(self, chat_id: int|None, fn: Callable[..., T], *args, priority: int = INTERACTIVE, **kwargs) -> T:
+		if self.metrics is None:
+			return self.scheduler.call(chat_id, fn, *args, priority=priority, **kwargs)
+		with self.metrics.timer('tgdrive_telegram_call_seconds', (('method', fn.__name__),)):
+			return self.scheduler.call(chat_id, self.metrics.api(fn), *args, priority=priority, **kwargs)
 
 	def polling(self):
 		self.bot.infinity_polling()
 
+	def use_webhook(self, url: str, secret: str|None = None, host: str = '0.0.0.0', port: int = 8443, workers: int = 4):
+		# Without a configured secret a random one is registered with Telegram for this run
+		secret = secret or secrets.token_urlsafe(32)
+		path = urlparse(url).path or '/'
+		if self.bot.threaded:
+			# telebot's own unbounded pool would take the handlers off the webhook workers and defeat the queue bound
+			self.bot.worker_pool.close()
+			self.bot.threaded = False
+		self.webhook = WebhookServer(self.bot, secret, host, port, path, workers)
+		self.bot.remove_webhook()
+		self.bot.set_webhook(url, secret_token=secret)
+
+	def run(self):
+		if self.webhook is not None:
+			self.webhook.serve_forever()
+		else:
+			self.polling()
+
 	def delete(self, message: tt.Message):
-		self.bot.delete_message(message.chat.id, message.id)
+		self.call(message.chat.id, self.bot.delete_message, message.chat.id, message.id)
 
 	def text(self, user_id: int, text: str, parse_mode=None, keyboard=None):
-		self.bot.send_message(user_id, text, parse_mode, reply_markup=keyboard)
-	
+		self.call(user_id, self.bot.send_message, user_id, text, parse_mode, reply_markup=keyboard)
+
+	def edit(self, message: tt.Message, text: str, parse_mode=None, keyboard=None):
+		# Edits in place, skipping the call if nothing changed and sending a new message if the old one can't be edited
+		chat_id, message_id = message.chat.id, message.message_id
+		old = self.rendered.get(chat_id, message_id)
+		new = render_hash(text, keyboard)
+		if old == new:
+			return
+		try:
+			if old is not None and old[0] == new[0]:
+				self.call(chat_id, self.bot.edit_message_reply_markup, chat_id, message_id, reply_markup=keyboard)
+			else:
+				self.call(chat_id, self.bot.edit_message_text, text, chat_id, message_id, parse_mode=parse_mode, reply_markup=keyboard)
+		except ApiTelegramException as e:
+			if not not_modified(e):
+				logging.info(f'Could not edit message {message_id} in {chat_id}, sending a new one: {e.description}')
+				return self.text(chat_id, text, parse_mode, keyboard)
+		self.rendered.set(chat_id, message_id, text, keyboard)
+
 	def list(self, user_id: int, text: str, parse_mode,
-		  entries: list[tt.InlineKeyboardButton],
-		  cur_page: int = 0, limit: int = 50):
-		c = chunks(entries, limit)
-		if cur_page < 0 or cur_page >= len(c):
-			raise ValueError('Page number out of range')
-		keyboard = tt.InlineKeyboardMarkup(c[cur_page])
-		# keyboard.keyboard.append([
-		# 	tt.InlineKeyboardButton('◀️', callback_data=('none' if cur_page==0      else 'none')),
-		# 	tt.InlineKeyboardButton(f'{cur_page+1}/{len(c)}', callback_data='none'),
-		# 	tt.InlineKeyboardButton('▶️', callback_data=('none' if cur_page>=len(c) else 'none')),
-		# ])
-		self.text(user_id, text, parse_mode, keyboard)
\ No newline at end of file
+		  entries: list[list[tt.InlineKeyboardButton]],
+		  prev_page: str|None = None, next_page: str|None = None, page_label: str = '',
+		  message: tt.Message|None = None):
+		# entries is a single page, prev_page/next_page are callback data of the navigation buttons.
+		# With message set the listing replaces that message's content instead of being sent anew
+		keyboard = page_keyboard(entries, prev_page, next_page, page_label)
+		if message is not None:
+			self.edit(message, text, parse_mode, keyboard)
+		else:
+			self.text(user_id, text, parse_mode, keyboard)
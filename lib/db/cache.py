@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable, Optional, Tuple
+
+
+MISS = object()
+
+
+class LRUCache:
+	# Size-bounded LRU with optional TTL. Lookups hand out the current generation, and put() is dropped
+	# if anything was invalidated since, so a reader racing a writer can't store a stale row.
+	def __init__(self, maxsize: int = 10000, ttl: Optional[float] = None):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.data: OrderedDict[Hashable, Tuple[Any, float]] = OrderedDict()
+		self.lock = Lock()
+		self.generation = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key: Hashable) -> Tuple[Any, int]:
+		with self.lock:
+			item = self.data.get(key)
+			if item is not None and (self.ttl is None or item[1] > monotonic()):
+				self.data.move_to_end(key)
+				self.hits += 1
+				return item[0], self.generation
+			if item is not None:
+				del self.data[key]
+			self.misses += 1
+			return MISS, self.generation
+
+	def put(self, key: Hashable, value: Any, generation: int):
+		if self.maxsize <= 0:
+			return
+		with self.lock:
+			if generation != self.generation:
+				return
+			self.data[key] = (value, monotonic() + self.ttl if self.ttl is not None else 0.0)
+			self.data.move_to_end(key)
+			if len(self.data) > self.maxsize:
+				self.data.popitem(last=False)
+
+	def invalidate(self, *keys: Hashable):
+		with self.lock:
+			self.generation += 1
+			for key in keys:
+				self.data.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.generation += 1
+			self.data.clear()
+
+	def stats(self) -> dict:
+		with self.lock:
+			total = self.hits + self.misses
+			return {'size': len(self.data), 'hits': self.hits, 'misses': self.misses,
+					'hit_rate': self.hits / total if total else 0.0}
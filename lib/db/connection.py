@@ -0,0 +1,154 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
+from .search import search_terms
+
+
+class QueryCounter(threading.local):
+	# Statements run by the current thread, for attributing queries to the code that ran them
+	queries = 0
+
+counter = QueryCounter()
+
+
+class Cursor(sqlite3.Cursor):
+	def execute(self, sql, parameters=()):
+		self.connection.queries += 1
+		counter.queries += 1
+		return super().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		self.connection.queries += 1
+		counter.queries += 1
+		return super().executemany(sql, parameters)
+
+
+class Connection(sqlite3.Connection):
+	# Counts statements run through it and its cursors, executemany counts once.
+	# A connection is only used by one thread at a time, so the counter needs no lock
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.queries = 0
+
+	def cursor(self, factory=Cursor):
+		return super().cursor(factory)
+
+	def execute(self, sql, parameters=()):
+		self.queries += 1
+		counter.queries += 1
+		return super().execute(sql, parameters)
+
+	def executemany(self, sql, parameters):
+		self.queries += 1
+		counter.queries += 1
+		return super().executemany(sql, parameters)
+
+
+class ConnectionPool:
+	# One serialized writer connection shared by all threads, plus a lazily opened read connection per thread.
+	# In WAL mode readers never block behind the writer and see the last committed state.
+	def __init__(self, database_name: str, synchronous: str = 'NORMAL', cache_size: int = -16000,
+			  mmap_size: int = 64 * 1024 * 1024, busy_timeout: int = 5000):
+		self.database_name = database_name
+		self.pragmas = {
+			'synchronous': synchronous, 'cache_size': cache_size,
+			'mmap_size': mmap_size, 'busy_timeout': busy_timeout,
+		}
+		self.memory = database_name == ':memory:'
+		self.connections: list[Connection] = []
+		self.writer = self._connect(check_same_thread=False)
+		if not self.memory:
+			self.writer.execute("PRAGMA journal_mode = WAL")
+		self.lock = threading.RLock()
+		self.local = threading.local()
+		# Called after every outermost transaction, on the thread that ran it
+		self.commit_hooks: list[Callable[[], None]] = []
+		self.data_version = self.writer.execute("PRAGMA data_version").fetchone()[0]
+
+	def _connect(self, check_same_thread: bool = True) -> sqlite3.Connection:
+		con = sqlite3.connect(self.database_name, isolation_level=None, check_same_thread=check_same_thread, factory=Connection)
+		self.connections.append(con)
+		for k, v in self.pragmas.items():
+			con.execute(f"PRAGMA {k} = {v}")
+		con.create_function('search_terms', 2, search_terms, deterministic=True)
+		return con
+
+	def read(self) -> sqlite3.Connection:
+		# Inside a transaction reads go through the writer to see its uncommitted changes.
+		# In-memory databases are private to a connection, so they only have the writer.
+		if self.memory or getattr(self.local, 'depth', 0):
+			return self.writer
+		con = getattr(self.local, 'con', None)
+		if con is None:
+			con = self.local.con = self._connect()
+		return con
+
+	@contextmanager
+	def transaction(self) -> Iterator[sqlite3.Connection]:
+		with self.lock:
+			depth = getattr(self.local, 'depth', 0)
+			self.local.depth = depth + 1
+			try:
+				if depth:
+					yield self.writer
+					return
+				self.local.on_commit = []
+				self.writer.execute("BEGIN IMMEDIATE")
+				try:
+					yield self.writer
+				except BaseException:
+					self.writer.execute("ROLLBACK")
+					raise
+				self.writer.execute("COMMIT")
+			finally:
+				self.local.depth = depth
+				if not depth:
+					callbacks, self.local.on_commit = self.local.on_commit, []
+					for fn in callbacks + self.commit_hooks:
+						fn()
+
+	@contextmanager
+	def snapshot(self) -> Iterator[sqlite3.Connection]:
+		# Read connection for several queries that must see the same committed state
+		if self.memory or getattr(self.local, 'depth', 0):
+			with self.lock:
+				yield self.writer
+			return
+		con = self.read()
+		con.execute("BEGIN")
+		try:
+			yield con
+		finally:
+			con.execute("COMMIT")
+
+	def in_transaction(self) -> bool:
+		return bool(getattr(self.local, 'depth', 0))
+
+	def after_commit(self, fn: Callable[[], None]):
+		# Runs fn once the outermost transaction of this thread ends (right away outside of one)
+		if getattr(self.local, 'depth', 0):
+			self.local.on_commit.append(fn)
+		else:
+			fn()
+
+	def changed_elsewhere(self) -> bool:
+		# True if another connection committed since the last call, e.g. a CLI tool in another process.
+		# data_version of the writer only moves on commits it didn't make, and all writes of this process go through it.
+		# Skipped while a transaction holds the writer, the next call catches up
+		if self.memory or not self.lock.acquire(blocking=False):
+			return False
+		try:
+			version = self.writer.execute("PRAGMA data_version").fetchone()[0]
+		finally:
+			self.lock.release()
+		changed, self.data_version = version != self.data_version, version
+		return changed
+
+	def query_count(self) -> int:
+		# Statements run so far on all connections of the pool
+		return sum(x.queries for x in self.connections)
+
+	def close(self):
+		with self.lock:
+			self.writer.close()
@@ -1,9 +1,27 @@
+import json
 import sqlite3
-from typing import List, Union, Optional
+import time
+from contextlib import closing
+from itertools import islice
+from typing import Callable, Hashable, Iterator, List, Tuple, Union, Optional, TypeVar
+from .cache import LRUCache, MISS
+from .connection import ConnectionPool
+from .migrations import migrate, ancestors, USAGE_TOTALS
+from .search import search_query
+
+
+T = TypeVar('T')
+
+FOLDER = 0
+FILE = 1
+Cursor = Tuple[int, int] # (FOLDER or FILE, id) of a row in a children listing
+MAX_PAGES = 16 # Listings and counts kept per folder in children_cache
 
 
 
 class UserData:
+	__slots__ = ('user_id', 'last_opened_folder_id', 'root_folder_id')
+
 	def __init__(self, user_id: int, last_opened_folder_id: Optional[int] = None, root_folder_id: Optional[int] = None):
 		self.user_id = user_id
 		self.last_opened_folder_id = last_opened_folder_id
@@ -13,7 +31,11 @@ class UserData:
 		return f"UserData(user_id={self.user_id}, last_opened_folder_id={self.last_opened_folder_id}, root_folder_id={self.root_folder_id})"
 
 class FileData:
-    def __init__(self, file_id: str, actual_file_id: str, name: str, mime_type: str, user_id: int, message_id: int, parent_folder_id: int):
+    __slots__ = ('file_id', 'actual_file_id', 'name', 'mime_type', 'user_id', 'message_id', 'parent_folder_id',
+                 'file_unique_id', 'file_size')
+
+    def __init__(self, file_id: str, actual_file_id: str, name: str, mime_type: str, user_id: int, message_id: int, parent_folder_id: int,
+                 file_unique_id: Optional[str] = None, file_size: Optional[int] = None):
         self.file_id = file_id
         self.actual_file_id = actual_file_id
         self.name = name
@@ -21,15 +43,19 @@ class FileData:
         self.user_id = user_id
         self.message_id = message_id
         self.parent_folder_id = parent_folder_id
+        self.file_unique_id = file_unique_id
+        self.file_size = file_size
 
     def __repr__(self):
         return f"FileData(file_id={self.file_id}, actual_file_id='{self.actual_file_id}', " \
                f"name='{self.name}', mime_type='{self.mime_type}', " \
                f"user_id={self.user_id}, message_id={self.message_id}, " \
-               f"parent_folder_id={self.parent_folder_id})"
+               f"parent_folder_id={self.parent_folder_id}, file_unique_id='{self.file_unique_id}', file_size={self.file_size})"
 
 
 class FolderData:
+	__slots__ = ('folder_id', 'user_id', 'name', 'parent_folder_id')
+
 	def __init__(self, folder_id: int, user_id: int, name: str, parent_folder_id: Optional[int]):
 		self.folder_id = folder_id
 		self.user_id = user_id
@@ -42,159 +68,624 @@ class FolderData:
 
 
 
+def child_cursor(child: Union["FolderData", "FileData"]) -> Cursor:
+	return (FOLDER, child.folder_id) if isinstance(child, FolderData) else (FILE, child.file_id)
+
+def row_factory(record: Callable[..., T]) -> Callable[[sqlite3.Cursor, tuple], T]:
+	# Makes a cursor build records straight from its rows, the query selects the constructor's arguments in order
+	return lambda cursor, row: record(*row)
+
+FOLDER_COLUMNS = "id, user_id, name, parent_folder_id"
+FILE_COLUMNS = "id, actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size"
+
+
 class UserDataHandler:
 	def __init__(self, db: "Database"):
-		self.con: sqlite3.Connection= db.con
+		self.db = db
 
 	def create_user(self, user_id: int) -> int:
-		cursor = self.con.cursor()
-		cursor.execute("INSERT INTO users (id) VALUES (?)", (user_id,))
-		cursor.close()
+		with self.db.transaction() as con:
+			con.execute("INSERT INTO users (id) VALUES (?)", (user_id,))
 		return user_id
 
 	def get_user(self, user_id: int) -> Optional[UserData]:
-		cursor = self.con.cursor()
-		cursor.execute("SELECT last_opened_folder_id, root_folder_id FROM users WHERE id = ?", (user_id,))
-		user_data = cursor.fetchone()
-		cursor.close()
-		if user_data:
-			return UserData(user_id, *user_data)
-		return None
+		return self.db.cached(self.db.user_cache, user_id, lambda: self._get_user(user_id))
+
+	def _get_user(self, user_id: int) -> Optional[UserData]:
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(UserData)
+		return cursor.execute("SELECT id, last_opened_folder_id, root_folder_id FROM users WHERE id = ?", (user_id,)).fetchone()
 
 	def set_root_folder(self, user_id: int, root_folder_id: int) -> None:
-		cursor = self.con.cursor()
-		cursor.execute("UPDATE users SET root_folder_id = ? WHERE id = ?", (root_folder_id, user_id))
-		cursor.close()
+		with self.db.transaction() as con:
+			con.execute("UPDATE users SET root_folder_id = ? WHERE id = ?", (root_folder_id, user_id))
+			self.db.invalidate(self.db.user_cache, user_id)
 
 	def set_last_opened_folder(self, user_id: int, last_opened_folder_id: int) -> None:
-		cursor = self.con.cursor()
-		cursor.execute("UPDATE users SET last_opened_folder_id = ? WHERE id = ?", (last_opened_folder_id, user_id))
-		cursor.close()
+		user = self.get_user(user_id)
+		if user is not None and user.last_opened_folder_id == last_opened_folder_id:
+			return
+		with self.db.transaction() as con:
+			con.execute("UPDATE users SET last_opened_folder_id = ? WHERE id = ?", (last_opened_folder_id, user_id))
+			self.db.invalidate(self.db.user_cache, user_id)
 
 
 class FolderDataHandler:
 	def __init__(self, db: "Database"):
-		self.con: sqlite3.Connection= db.con
 		self.db = db
 
 	def create_folder(self, user_id: int, name: str, parent_folder_id: Optional[int] = None) -> int:
-		cursor = self.con.cursor()
-		cursor.execute("INSERT INTO folders (user_id, name, parent_folder_id) VALUES (?, ?, ?)",
-					(user_id, name, parent_folder_id))
-		folder_id = cursor.lastrowid
-		cursor.close()
-		return folder_id
+		with self.db.transaction() as con:
+			cursor = con.execute("INSERT INTO folders (user_id, name, parent_folder_id) VALUES (?, ?, ?)",
+						(user_id, name, parent_folder_id))
+			self.db.invalidate(self.db.children_cache, parent_folder_id)
+			return cursor.lastrowid
 
 	def get_folder(self, folder_id: int) -> Optional[FolderData]:
-		cursor = self.con.cursor()
-		cursor.execute("SELECT user_id, name, parent_folder_id FROM folders WHERE id = ?", (folder_id,))
-		folder_data = cursor.fetchone()
-		cursor.close()
-		if folder_data:
-			return FolderData(folder_id, *folder_data)
-		return None
-
-	def get_children(self, folder_id: int) -> List[Union[FolderData, FileData]]:
-		cursor = self.con.cursor()
-		cursor.execute("SELECT id, user_id, name FROM folders WHERE parent_folder_id = ?", (folder_id,))
-		folders_data = cursor.fetchall()
-		folders = [FolderData(*x, folder_id) for x in folders_data]
-		cursor.execute("SELECT id, actual_file_id, name, mime_type, user_id, message_id FROM files WHERE parent_folder_id = ?", (folder_id,))
-		files_data = cursor.fetchall()
-		cursor.close()
-		files = [FileData(*x, folder_id) for x in files_data]
-		return folders + files
+		return self.db.cached(self.db.folder_cache, folder_id, lambda: self._get_folder(folder_id))
+
+	def _get_folder(self, folder_id: int) -> Optional[FolderData]:
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(FolderData)
+		return cursor.execute(f"SELECT {FOLDER_COLUMNS} FROM folders WHERE id = ?", (folder_id,)).fetchone()
+
+	def get_path(self, folder_id: int) -> List[FolderData]:
+		# Ordered from root down to folder_id. Walks the folder cache first and falls back to a single query on any miss
+		cache = self.db.folder_cache
+		if not self.db.pool.in_transaction():
+			self.db.check_external()
+			path, generation, p = [], None, folder_id
+			while p is not None:
+				folder, g = cache.get(p)
+				if folder is MISS:
+					break
+				generation = g if generation is None else min(generation, g)
+				path.append(folder)
+				p = folder.parent_folder_id
+			else:
+				return path[::-1]
+			path = self._get_path(folder_id)
+			for folder in path:
+				cache.put(folder.folder_id, folder, g if generation is None else generation)
+			return path
+		return self._get_path(folder_id)
+
+	def _get_path(self, folder_id: int) -> List[FolderData]:
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(FolderData)
+		return cursor.execute("""
+		WITH RECURSIVE ancestors(id, user_id, name, parent_folder_id, depth) AS (
+			SELECT id, user_id, name, parent_folder_id, 0 FROM folders WHERE id = ?
+			UNION ALL
+			SELECT f.id, f.user_id, f.name, f.parent_folder_id, a.depth + 1
+				FROM folders f JOIN ancestors a ON f.id = a.parent_folder_id
+		)
+		SELECT id, user_id, name, parent_folder_id FROM ancestors ORDER BY depth DESC
+		""", (folder_id,)).fetchall()
+
+	def get_children(self, folder_id: int, after: Optional[Cursor] = None, before: Optional[Cursor] = None,
+				  limit: Optional[int] = None) -> List[Union[FolderData, FileData]]:
+		# Folders then files, each sorted by (name, id). With a limit returns one keyset page that starts
+		# right after `after` or ends right before `before`, cursors come from child_cursor().
+		# The cached list is shared between callers, don't modify it
+		return self._listing(folder_id, (after, before, limit), lambda: self._get_children(folder_id, after, before, limit))
+
+	def count_children(self, folder_id: int) -> int:
+		return self._listing(folder_id, 'count', lambda: self._count_children(folder_id))
+
+	def _listing(self, folder_id: int, key: Hashable, load: Callable[[], T]) -> T:
+		# children_cache holds the pages and count of a folder in one entry, so one invalidation drops them all.
+		# Only the last MAX_PAGES distinct pages are kept, older ones are loaded again when asked for
+		cache = self.db.children_cache
+		if self.db.pool.in_transaction():
+			return load()
+		self.db.check_external()
+		pages, generation = cache.get(folder_id)
+		if pages is not MISS and key in pages:
+			return pages[key]
+		value = load()
+		pages = dict(pages) if pages is not MISS else {}
+		while len(pages) >= MAX_PAGES:
+			del pages[next(iter(pages))]
+		pages[key] = value
+		cache.put(folder_id, pages, generation)
+		return value
+
+	def _count_children(self, folder_id: int) -> int:
+		con = self.db.read()
+		return con.execute("SELECT (SELECT COUNT(*) FROM folders WHERE parent_folder_id = ?) + (SELECT COUNT(*) FROM files WHERE parent_folder_id = ?)",
+					 (folder_id, folder_id)).fetchone()[0]
+
+	def _get_children(self, folder_id: int, after: Optional[Cursor] = None, before: Optional[Cursor] = None,
+				   limit: Optional[int] = None) -> List[Union[FolderData, FileData]]:
+		with closing(self.iter_children(folder_id, after, before)) as rows:
+			result = list(islice(rows, limit))
+		return result[::-1] if before is not None else result
+
+	def iter_children(self, folder_id: int, after: Optional[Cursor] = None,
+				   before: Optional[Cursor] = None) -> Iterator[Union[FolderData, FileData]]:
+		# Streams children in get_children order (walking backwards from `before` if given) without building lists
+		# or touching the cache. Rows are read as the iterator advances, close it before writing in the same transaction
+		cursor = self.db.read().cursor()
+		tables = [
+			(FOLDER, FolderData, f"SELECT {FOLDER_COLUMNS} FROM folders"),
+			(FILE, FileData, f"SELECT {FILE_COLUMNS} FROM files"),
+		]
+		mark, op, order = after, '>', 'ASC'
+		if before is not None:
+			mark, op, order = before, '<', 'DESC'
+			tables.reverse()
+		if mark is not None:
+			table = 'folders' if mark[0] == FOLDER else 'files'
+			mark_name = cursor.execute(f"SELECT name FROM {table} WHERE id = ?", (mark[1],)).fetchone()
+			if mark_name is None: # Cursor row is gone, restart from the edge
+				mark = None
+		try:
+			for kind, record, query in tables:
+				where, args = "", ()
+				if mark is not None:
+					if kind != mark[0]: # Table comes before the cursor's table in this direction
+						continue
+					where, args = f" AND (name, id) {op} (?, ?)", (mark_name[0], mark[1])
+					mark = None
+				cursor.row_factory = row_factory(record)
+				yield from cursor.execute(f"{query} WHERE parent_folder_id = ?{where} ORDER BY name {order}, id {order}", (folder_id, *args))
+		finally:
+			cursor.close()
 
 	def find_folder(self, name: str, user_id: int) -> Optional[FolderData]:
-		cursor = self.con.cursor()
-		cursor.execute("SELECT id, parent_folder_id FROM folders WHERE name = ? AND user_id = ?", (name, user_id))
-		folder_data = cursor.fetchone()
-		cursor.close()
-		if folder_data:
-			folder_id, parent_folder_id = folder_data
-			return FolderData(folder_id, user_id, name, parent_folder_id)
-		return None
-
-	def delete_folder(self, folder_id: int) -> None:
-		cursor = self.con.cursor()
-		children = self.get_children(folder_id)
-		child: "FileData | FolderData"
-		for child in children:
-			self.delete_folder(child.folder_id) if isinstance(child, FolderData) else self.db.file.delete_file(child.file_id)
-		cursor.execute("DELETE FROM folders WHERE id = ?", (folder_id,))
-		cursor.close()
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(FolderData)
+		return cursor.execute(f"SELECT {FOLDER_COLUMNS} FROM folders WHERE name = ? AND user_id = ?", (name, user_id)).fetchone()
+
+	def delete_folder(self, folder_id: int) -> List[FileData]:
+		# Removes the whole subtree in one transaction, returns deleted files so storage messages can be cleaned up
+		subtree = """
+		WITH RECURSIVE subtree(id) AS (
+			SELECT ?
+			UNION ALL
+			SELECT f.id FROM folders f JOIN subtree s ON f.parent_folder_id = s.id
+		)"""
+		with self.db.transaction() as con:
+			folder_ids = [x for (x,) in con.execute(subtree + " SELECT id FROM subtree", (folder_id,)).fetchall()]
+			parent = con.execute("SELECT parent_folder_id FROM folders WHERE id = ?", (folder_id,)).fetchone()
+			cursor = con.cursor()
+			cursor.row_factory = row_factory(FileData)
+			files = cursor.execute(subtree + f" SELECT {FILE_COLUMNS} FROM files WHERE parent_folder_id IN (SELECT id FROM subtree)", (folder_id,)).fetchall()
+			con.execute(subtree + " DELETE FROM files WHERE parent_folder_id IN (SELECT id FROM subtree)", (folder_id,))
+			con.execute(subtree + " DELETE FROM folders WHERE id IN (SELECT id FROM subtree)", (folder_id,))
+			self.db.invalidate(self.db.folder_cache, *folder_ids)
+			self.db.invalidate(self.db.children_cache, *folder_ids, *(parent or ()))
+		return files
+
+	def within(self, folder_ids: List[int], roots: List[int]) -> set:
+		# Those of folder_ids that are one of roots or inside one of them
+		return self._within(self.db.read(), folder_ids, roots)
+
+	def _within(self, con: sqlite3.Connection, folder_ids: List[int], roots: List[int]) -> set:
+		return {x for (x,) in con.execute("""
+		WITH RECURSIVE up(start, id) AS (
+			SELECT value, value FROM json_each(?)
+			UNION ALL
+			SELECT u.start, f.parent_folder_id FROM up u JOIN folders f ON f.id = u.id WHERE f.parent_folder_id IS NOT NULL
+		)
+		SELECT DISTINCT start FROM up WHERE id IN (SELECT value FROM json_each(?))
+		""", (json.dumps([int(x) for x in folder_ids]), json.dumps([int(x) for x in roots]))).fetchall()}
+
+	def _outermost(self, con: sqlite3.Connection, folder_ids: List[int]) -> List[int]:
+		# Drops the folders that sit inside another one of folder_ids, they come along with it
+		parents = dict(con.execute("SELECT id, parent_folder_id FROM folders WHERE id IN (SELECT value FROM json_each(?))",
+			(json.dumps([int(x) for x in folder_ids]),)).fetchall())
+		nested = self._within(con, [x for x in parents.values() if x is not None], folder_ids)
+		return [x for x in dict.fromkeys(int(x) for x in folder_ids) if parents.get(x) not in nested]
+
+	def move_folders(self, folder_ids: List[int], target_id: int) -> None:
+		# One UPDATE for any number of folders, subtrees come along since only their roots change parent
+		with self.db.transaction() as con:
+			self._check_target(con, folder_ids, target_id)
+			folder_ids = self._outermost(con, folder_ids)
+			ids = json.dumps(folder_ids)
+			parents = [x for (x,) in con.execute("SELECT DISTINCT parent_folder_id FROM folders WHERE id IN (SELECT value FROM json_each(?))", (ids,)).fetchall()]
+			con.execute("UPDATE folders SET parent_folder_id = ? WHERE id IN (SELECT value FROM json_each(?))", (target_id, ids))
+			self.db.invalidate(self.db.folder_cache, *folder_ids)
+			self.db.invalidate(self.db.children_cache, target_id, *parents)
+
+	def copy_folders(self, folder_ids: List[int], target_id: int) -> List[int]:
+		# Duplicates whole subtrees with two INSERT ... SELECT statements, files keep pointing at the same storage messages.
+		# Returns the ids of the copies of folder_ids, a folder inside another selected one maps to its copy within that one's copy
+		with self.db.transaction() as con:
+			self._check_target(con, folder_ids, target_id)
+			roots = self._outermost(con, folder_ids)
+			con.execute("DROP TABLE IF EXISTS temp.copy_map")
+			con.execute("""
+			CREATE TEMP TABLE copy_map AS
+			WITH RECURSIVE subtree(id, depth) AS (
+				SELECT value, 0 FROM json_each(?)
+				UNION ALL
+				SELECT f.id, s.depth + 1 FROM folders f JOIN subtree s ON f.parent_folder_id = s.id
+			)
+			SELECT id AS old_id, depth, (SELECT COALESCE(MAX(id), 0) FROM folders) + ROW_NUMBER() OVER (ORDER BY depth, id) AS new_id FROM subtree
+			""", (json.dumps(roots),))
+			con.execute("""
+			INSERT INTO folders (id, user_id, name, parent_folder_id)
+				SELECT m.new_id, f.user_id, f.name, COALESCE(p.new_id, ?) FROM copy_map m
+					JOIN folders f ON f.id = m.old_id
+					LEFT JOIN copy_map p ON p.old_id = f.parent_folder_id AND m.depth > 0
+				ORDER BY m.new_id
+			""", (target_id,))
+			self.db.file.share_storage("parent_folder_id IN (SELECT old_id FROM copy_map)")
+			con.execute("""
+			INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size)
+				SELECT f.actual_file_id, f.name, f.mime_type, f.user_id, f.message_id, m.new_id, f.file_unique_id, f.file_size
+					FROM files f JOIN copy_map m ON f.parent_folder_id = m.old_id ORDER BY m.new_id, f.id
+			""")
+			new = dict(con.execute("SELECT old_id, new_id FROM copy_map").fetchall())
+			con.execute("DROP TABLE temp.copy_map")
+			self.db.invalidate(self.db.children_cache, target_id)
+		return [new[int(x)] for x in folder_ids]
+
+	def _check_target(self, con: sqlite3.Connection, folder_ids: List[int], target_id: int) -> None:
+		if con.execute("SELECT 1 FROM folders WHERE id = ?", (target_id,)).fetchone() is None:
+			raise ValueError(f"Invalid target folder: {target_id}")
+		path = {x for (x,) in con.execute(ancestors('?'), (target_id,)).fetchall()}
+		if path & {int(x) for x in folder_ids}:
+			raise ValueError(f"Folder {target_id} is inside one of the folders being moved or copied")
 
 	def rename_folder(self, folder_id: int, new_name: str) -> None:
-		cursor = self.con.cursor()
-		cursor.execute("UPDATE folders SET name = ? WHERE id = ?", (new_name, folder_id))
-		cursor.close()
+		with self.db.transaction() as con:
+			parent = con.execute("SELECT parent_folder_id FROM folders WHERE id = ?", (folder_id,)).fetchone()
+			con.execute("UPDATE folders SET name = ? WHERE id = ?", (new_name, folder_id))
+			self.db.invalidate(self.db.folder_cache, folder_id)
+			self.db.invalidate(self.db.children_cache, *(parent or ()))
 
 
 class FileDataHandler:
 	def __init__(self, db: "Database"):
-		self.con: sqlite3.Connection= db.con
+		self.db = db
 
-	def create_file(self, actual_file_id: str, name: str, mime_type: str, user_id: int, message_id: int, parent_folder_id: int) -> str:
-		cursor = self.con.cursor()
-		cursor.execute("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id) VALUES (?, ?, ?, ?, ?, ?)",
-					(actual_file_id, name, mime_type, user_id, message_id, parent_folder_id))
-		file_id = cursor.lastrowid
-		cursor.close()
-		return file_id
+	def create_file(self, actual_file_id: str, name: str, mime_type: str, user_id: int, message_id: int, parent_folder_id: int,
+				 file_unique_id: Optional[str] = None, file_size: Optional[int] = None) -> str:
+		with self.db.transaction() as con:
+			cursor = con.execute("INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+						(actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size))
+			self.db.invalidate(self.db.children_cache, parent_folder_id)
+			return cursor.lastrowid
 
 	def get_file(self, file_id: str) -> Optional[FileData]:
-		cursor = self.con.cursor()
-		cursor.execute("SELECT actual_file_id, name, mime_type, user_id, message_id, parent_folder_id FROM files WHERE id = ?", (file_id,))
-		file_data = cursor.fetchone()
-		cursor.close()
-		if file_data:
-			return FileData(file_id, *file_data)
-		return None
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(FileData)
+		return cursor.execute(f"SELECT {FILE_COLUMNS} FROM files WHERE id = ?", (file_id,)).fetchone()
 
 	def delete_file(self, file_id: str) -> None:
-		cursor = self.con.cursor()
-		cursor.execute("DELETE FROM files WHERE id = ?", (file_id,))
+		with self.db.transaction() as con:
+			parent = con.execute("SELECT parent_folder_id FROM files WHERE id = ?", (file_id,)).fetchone()
+			con.execute("DELETE FROM files WHERE id = ?", (file_id,))
+			self.db.invalidate(self.db.children_cache, *(parent or ()))
+
+	def move_files(self, file_ids: List[str], target_id: int) -> None:
+		with self.db.transaction() as con:
+			if con.execute("SELECT 1 FROM folders WHERE id = ?", (target_id,)).fetchone() is None:
+				raise ValueError(f"Invalid target folder: {target_id}")
+			ids = json.dumps([int(x) for x in file_ids])
+			parents = [x for (x,) in con.execute("SELECT DISTINCT parent_folder_id FROM files WHERE id IN (SELECT value FROM json_each(?))", (ids,)).fetchall()]
+			con.execute("UPDATE files SET parent_folder_id = ? WHERE id IN (SELECT value FROM json_each(?))", (target_id, ids))
+			self.db.invalidate(self.db.children_cache, target_id, *parents)
+
+	def copy_files(self, file_ids: List[str], target_id: int) -> None:
+		# The copies reference the same storage messages, nothing is sent again
+		with self.db.transaction() as con:
+			if con.execute("SELECT 1 FROM folders WHERE id = ?", (target_id,)).fetchone() is None:
+				raise ValueError(f"Invalid target folder: {target_id}")
+			ids = json.dumps([int(x) for x in file_ids])
+			self.share_storage("id IN (SELECT value FROM json_each(?))", (ids,))
+			con.execute("""
+			INSERT INTO files (actual_file_id, name, mime_type, user_id, message_id, parent_folder_id, file_unique_id, file_size)
+				SELECT actual_file_id, name, mime_type, user_id, message_id, ?, file_unique_id, file_size FROM files
+					WHERE id IN (SELECT value FROM json_each(?)) ORDER BY id
+			""", (target_id, ids))
+			self.db.invalidate(self.db.children_cache, target_id)
+
+	def share_storage(self, where: str, args: tuple = ()) -> None:
+		# Rows stored before deduplication own their storage message. Before such a row gets a copy it is put under
+		# blob reference counting with a key of its own, so deleting either row keeps the message for the other
+		with self.db.transaction() as con:
+			con.execute(f"""INSERT OR IGNORE INTO blobs (file_unique_id, actual_file_id, message_id, refs)
+				SELECT 'message:' || message_id, actual_file_id, message_id, 1 FROM files WHERE {where} AND file_unique_id IS NULL""", args)
+			con.execute(f"UPDATE files SET file_unique_id = 'message:' || message_id WHERE {where} AND file_unique_id IS NULL", args)
+
+	def set_file_size(self, file_id: str, file_size: int) -> None:
+		with self.db.transaction() as con:
+			parent = con.execute("SELECT parent_folder_id FROM files WHERE id = ?", (file_id,)).fetchone()
+			con.execute("UPDATE files SET file_size = ? WHERE id = ?", (file_size, file_id))
+			self.db.invalidate(self.db.children_cache, *(parent or ()))
+
+	def missing_size(self, after: int = 0, limit: int = 50) -> List[Tuple[int, str]]:
+		# (id, actual_file_id) of rows stored before sizes were recorded, in id order
+		con = self.db.read()
+		return con.execute("SELECT id, actual_file_id FROM files WHERE file_size IS NULL AND id > ? ORDER BY id LIMIT ?",
+					 (after, limit)).fetchall()
+
+
+
+class SearchHandler:
+	def __init__(self, db: "Database"):
+		self.db = db
+
+	def search(self, user_id: int, text: str, limit: int = 20, offset: int = 0) -> List[Union[FolderData, FileData]]:
+		# Best matches first (bm25, name weighs more than mime type), only the user's own folders and files
+		query = search_query(user_id, text)
+		if query is None:
+			return []
+		cursor = self.db.read().cursor()
+		cursor.execute("""
+		WITH hits(rowid, rank) AS (
+			SELECT rowid, rank FROM search WHERE search MATCH ? ORDER BY rank LIMIT ? OFFSET ?
+		)
+		SELECT h.rowid, h.rank, fo.user_id, fo.name, fo.parent_folder_id,
+			fi.actual_file_id, fi.name, fi.mime_type, fi.user_id, fi.message_id, fi.parent_folder_id, fi.file_unique_id, fi.file_size
+			FROM hits h
+			LEFT JOIN folders fo ON h.rowid % 2 = 0 AND fo.id = h.rowid / 2
+			LEFT JOIN files fi ON h.rowid % 2 = 1 AND fi.id = h.rowid / 2
+			ORDER BY h.rank
+		""", (query, limit, offset))
+		result = []
+		for x in cursor.fetchall():
+			if x[0] % 2 == FOLDER:
+				result.append(FolderData(x[0] // 2, *x[2:5]))
+			else:
+				result.append(FileData(x[0] // 2, *x[5:]))
 		cursor.close()
-		#TODO remove actual file from storage (okay nvm dont do it, telegram storage is free so dont mind garbage)
+		return result
+
+	def has_pending(self) -> bool:
+		return bool(self.db.read().execute("SELECT EXISTS (SELECT 1 FROM search_pending)").fetchone()[0])
+
+	def index_pending(self, limit: Optional[int] = None) -> int:
+		# (Re)indexes up to `limit` rows queued by the search triggers, rows deleted meanwhile just drop out.
+		# Returns how many were taken off the queue. lib.indexer.SearchIndexer calls it in the background
+		with self.db.transaction() as con:
+			ids = json.dumps([x for (x,) in con.execute("SELECT id FROM search_pending ORDER BY id LIMIT ?", (-1 if limit is None else limit,))])
+			n = len(json.loads(ids))
+			if n:
+				con.execute("DELETE FROM search WHERE rowid IN (SELECT value FROM json_each(?))", (ids,))
+				con.execute("""
+				INSERT INTO search (rowid, name, mime_type)
+					SELECT p.value, search_terms(f.user_id, f.name), '' FROM json_each(?) p JOIN folders f ON f.id = p.value / 2 WHERE p.value % 2 = 0
+				""", (ids,))
+				con.execute("""
+				INSERT INTO search (rowid, name, mime_type)
+					SELECT p.value, search_terms(f.user_id, f.name), search_terms(f.user_id, f.mime_type) FROM json_each(?) p JOIN files f ON f.id = p.value / 2 WHERE p.value % 2 = 1
+				""", (ids,))
+				con.execute("DELETE FROM search_pending WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+		return n
+
+
+class UsageData:
+	__slots__ = ('file_count', 'total_size', 'modified', 'quota')
+
+	def __init__(self, file_count: int, total_size: int, modified: Optional[int], quota: Optional[int] = None):
+		self.file_count = file_count
+		self.total_size = total_size
+		self.modified = modified
+		self.quota = quota
+
+	def __repr__(self):
+		return f"UsageData(file_count={self.file_count}, total_size={self.total_size}, modified={self.modified}, quota={self.quota})"
 
 
+class UsageDataHandler:
+	# Totals are kept up to date by triggers (see migration 7), reading them is a primary key lookup
+	def __init__(self, db: "Database"):
+		self.db = db
+
+	def folder(self, folder_id: int) -> Optional[UsageData]:
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(UsageData)
+		return cursor.execute("SELECT file_count, total_size, modified FROM folders WHERE id = ?", (folder_id,)).fetchone()
+
+	def user(self, user_id: int) -> Optional[UsageData]:
+		cursor = self.db.read().cursor()
+		cursor.row_factory = row_factory(UsageData)
+		return cursor.execute("SELECT file_count, total_size, modified, quota FROM users WHERE id = ?", (user_id,)).fetchone()
+
+	def set_quota(self, user_id: int, quota: Optional[int]) -> None:
+		with self.db.transaction() as con:
+			con.execute("UPDATE users SET quota = ? WHERE id = ?", (quota, user_id))
+
+	def check(self, fix: bool = False) -> List[Tuple[str, int, Tuple[int, int], Tuple[int, int]]]:
+		# Recomputes every total from scratch and returns ('folder' or 'user', id, stored, actual) for each mismatch,
+		# where stored and actual are (file_count, total_size). With fix the stored totals are overwritten
+		with self.db.transaction() as con:
+			# executescript would commit the open transaction, so statements go one by one
+			for statement in USAGE_TOTALS.split(';'):
+				if statement.strip():
+					con.execute(statement)
+			drift = []
+			for kind, table in (('folder', 'folders'), ('user', 'users')):
+				drift += [(kind, x[0], (x[1], x[2]), (x[3], x[4])) for x in con.execute(f"""
+				SELECT r.id, r.file_count, r.total_size, COALESCE(t.file_count, 0), COALESCE(t.total_size, 0) FROM {table} r
+					LEFT JOIN usage_totals t ON t.kind = ? AND t.id = r.id
+					WHERE r.file_count != COALESCE(t.file_count, 0) OR r.total_size != COALESCE(t.total_size, 0)
+				""", (0 if kind == 'folder' else 1,)).fetchall()]
+			if fix:
+				con.executemany("UPDATE folders SET file_count = ?, total_size = ? WHERE id = ?", [(*a, i) for k, i, _, a in drift if k == 'folder'])
+				con.executemany("UPDATE users SET file_count = ?, total_size = ? WHERE id = ?", [(*a, i) for k, i, _, a in drift if k == 'user'])
+			con.execute("DROP TABLE temp.usage_totals")
+		return drift
+
+
+class BlobData:
+	__slots__ = ('file_unique_id', 'actual_file_id', 'message_id', 'refs')
+
+	def __init__(self, file_unique_id: str, actual_file_id: str, message_id: int, refs: int):
+		self.file_unique_id = file_unique_id
+		self.actual_file_id = actual_file_id
+		self.message_id = message_id
+		self.refs = refs
+
+	def __repr__(self):
+		return f"BlobData(file_unique_id='{self.file_unique_id}', actual_file_id='{self.actual_file_id}', " \
+			f"message_id={self.message_id}, refs={self.refs})"
+
+
+class BlobDataHandler:
+	# One row per distinct file content in the storage chat. refs is kept up to date by triggers on files
+	def __init__(self, db: "Database"):
+		self.db = db
+
+	def add(self, file_unique_id: str, actual_file_id: str, message_id: int) -> None:
+		with self.db.transaction() as con:
+			con.execute("INSERT OR IGNORE INTO blobs (file_unique_id, actual_file_id, message_id) VALUES (?, ?, ?)",
+						(file_unique_id, actual_file_id, message_id))
+
+	def get_blobs(self, file_unique_ids: List[str]) -> dict:
+		con = self.db.read()
+		result = {}
+		for i in range(0, len(file_unique_ids), 500):
+			part = file_unique_ids[i:i + 500]
+			rows = con.execute(f"SELECT file_unique_id, actual_file_id, message_id, refs FROM blobs WHERE file_unique_id IN ({','.join('?' * len(part))})",
+							   part).fetchall()
+			result.update({x[0]: BlobData(*x) for x in rows})
+		return result
+
+	def release(self) -> List[int]:
+		# Drops blobs nobody references anymore, returns their storage message ids
+		with self.db.transaction() as con:
+			message_ids = [x for (x,) in con.execute("SELECT message_id FROM blobs WHERE refs <= 0").fetchall()]
+			con.execute("DELETE FROM blobs WHERE refs <= 0")
+		return message_ids
+
+
+class JobData:
+	__slots__ = ('job_id', 'kind', 'payload', 'attempts')
+
+	def __init__(self, job_id: int, kind: str, payload: dict, attempts: int):
+		self.job_id = job_id
+		self.kind = kind
+		self.payload = payload
+		self.attempts = attempts
+
+	def __repr__(self):
+		return f"JobData(job_id={self.job_id}, kind='{self.kind}', payload={self.payload}, attempts={self.attempts})"
+
+
+class JobDataHandler:
+	def __init__(self, db: "Database"):
+		self.db = db
+
+	def enqueue(self, kind: str, payload: dict, idempotency_key: Optional[str] = None, delay: float = 0) -> Optional[int]:
+		# Returns None if a job with the same idempotency key already exists
+		now = time.time()
+		with self.db.transaction() as con:
+			cursor = con.execute("INSERT OR IGNORE INTO jobs (kind, payload, idempotency_key, next_run, created) VALUES (?, ?, ?, ?, ?)",
+						(kind, json.dumps(payload), idempotency_key, now + delay, now))
+			return cursor.lastrowid if cursor.rowcount else None
+
+	def claim(self, limit: int = 1) -> List[JobData]:
+		with self.db.transaction() as con:
+			rows = con.execute("SELECT id, kind, payload, attempts FROM jobs WHERE status = 'pending' AND next_run <= ? ORDER BY next_run LIMIT ?",
+						(time.time(), limit)).fetchall()
+			con.executemany("UPDATE jobs SET status = 'running', attempts = attempts + 1 WHERE id = ?", [(x[0],) for x in rows])
+		return [JobData(job_id, kind, json.loads(payload), attempts + 1) for job_id, kind, payload, attempts in rows]
+
+	def update_payload(self, job_id: int, payload: dict) -> None:
+		with self.db.transaction() as con:
+			con.execute("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(payload), job_id))
+
+	def complete(self, job_id: int) -> None:
+		with self.db.transaction() as con:
+			con.execute("UPDATE jobs SET status = 'done', last_error = NULL WHERE id = ?", (job_id,))
+
+	def retry(self, job_id: int, delay: float, error: str) -> None:
+		with self.db.transaction() as con:
+			con.execute("UPDATE jobs SET status = 'pending', next_run = ?, last_error = ? WHERE id = ?", (time.time() + delay, error, job_id))
+
+	def fail(self, job_id: int, error: str) -> None:
+		with self.db.transaction() as con:
+			con.execute("UPDATE jobs SET status = 'failed', last_error = ? WHERE id = ?", (error, job_id))
+
+	def requeue_running(self) -> int:
+		# Jobs left running by a crashed process go back to the queue
+		with self.db.transaction() as con:
+			return con.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'").rowcount
+
+	def prune(self, older_than: float) -> int:
+		with self.db.transaction() as con:
+			return con.execute("DELETE FROM jobs WHERE status = 'done' AND created < ?", (time.time() - older_than,)).rowcount
+
+	def pending(self) -> int:
+		return self.db.read().execute("SELECT COUNT(*) FROM jobs WHERE status IN ('pending', 'running')").fetchone()[0]
+
+	def get_cursor(self, name: str) -> int:
+		row = self.db.read().execute("SELECT value FROM job_cursors WHERE name = ?", (name,)).fetchone()
+		return row[0] if row else 0
+
+	def set_cursor(self, name: str, value: int) -> None:
+		with self.db.transaction() as con:
+			con.execute("INSERT INTO job_cursors (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = excluded.value", (name, value))
+
+	def queued_upload_size(self, user_id: int) -> int:
+		# Bytes of the user's files waiting in forward jobs, stored ones leave the payload's file list
+		return self.db.read().execute("""
+		SELECT COALESCE(SUM(json_extract(f.value, '$.file_size')), 0) FROM jobs j, json_each(j.payload, '$.files') f
+			WHERE j.kind = 'forward' AND j.status IN ('pending', 'running') AND json_extract(j.payload, '$.user_id') = ?
+		""", (user_id,)).fetchone()[0]
+
 
 class Database:
-	def __init__(self, database_name: str = "data.db"):
-		self.con = sqlite3.connect(database_name, isolation_level=None, check_same_thread=False)
-		cursor = self.con.cursor()
-		cursor.execute("""
-		CREATE TABLE IF NOT EXISTS folders (
-			id INTEGER PRIMARY KEY,
-			user_id INTEGER,
-			name TEXT,
-			parent_folder_id INTEGER,
-				FOREIGN KEY (parent_folder_id) REFERENCES folders(id)
-		)
-		""")
-		cursor.execute("""
-		CREATE TABLE IF NOT EXISTS files (
-			id INTEGER PRIMARY KEY,
-			actual_file_id TEXT,
-			name TEXT,
-			mime_type TEXT,
-			user_id INTEGER,
-			message_id INTEGER,
-			parent_folder_id INTEGER,
-				FOREIGN KEY (parent_folder_id) REFERENCES folders(id)
-		)
-		""")
-		cursor.execute("""
-		CREATE TABLE IF NOT EXISTS users (
-			id INTEGER PRIMARY KEY,
-			last_opened_folder_id INTEGER,
-			root_folder_id INTEGER,
-				FOREIGN KEY (last_opened_folder_id) REFERENCES folders(id),
-				FOREIGN KEY (root_folder_id) REFERENCES folders(id)
-		)
-		""")
-		cursor.close()
+	def __init__(self, database_name: str = "data.db", synchronous: str = 'NORMAL', cache_size: int = -16000,
+			  mmap_size: int = 64 * 1024 * 1024, lru_size: int = 10000, lru_ttl: Optional[float] = None, external_check: float = 1.0):
+		self.pool = ConnectionPool(database_name, synchronous=synchronous, cache_size=cache_size, mmap_size=mmap_size)
+		# Seconds between checks for writes by other processes, which drop all cached rows
+		self.external_check = external_check
+		self.checked = time.monotonic()
+		self.user_cache = LRUCache(lru_size, lru_ttl)
+		self.folder_cache = LRUCache(lru_size, lru_ttl)
+		self.children_cache = LRUCache(lru_size // 10, lru_ttl)
+		self.con = self.pool.writer
+		with self.pool.lock:
+			migrate(self.con)
 
 		self.user = UserDataHandler(self)
 		self.folder = FolderDataHandler(self)
-		self.file = FileDataHandler(self)
\ No newline at end of file
+		self.file = FileDataHandler(self)
+		self.job = JobDataHandler(self)
+		self.blob = BlobDataHandler(self)
+		self.search = SearchHandler(self)
+		self.usage = UsageDataHandler(self)
+
+	def read(self) -> sqlite3.Connection:
+		return self.pool.read()
+
+	def transaction(self):
+		return self.pool.transaction()
+
+	def cached(self, cache: LRUCache, key: Hashable, load: Callable[[], T]) -> T:
+		# Reads inside a transaction may see uncommitted rows, so they bypass the cache
+		if self.pool.in_transaction():
+			return load()
+		self.check_external()
+		value, generation = cache.get(key)
+		if value is MISS:
+			value = load()
+			if value is not None:
+				cache.put(key, value, generation)
+		return value
+
+	def invalidate(self, cache: LRUCache, *keys: Hashable):
+		# Dropped after commit, a reader that looked up the old row in between is fenced off by the cache generation
+		self.pool.after_commit(lambda: cache.invalidate(*keys))
+
+	def check_external(self):
+		# Called before cache lookups, at most every external_check seconds
+		if (now := time.monotonic()) - self.checked >= self.external_check:
+			self.checked = now
+			if self.pool.changed_elsewhere():
+				self.clear_caches()
+
+	def clear_caches(self):
+		for cache in (self.user_cache, self.folder_cache, self.children_cache):
+			cache.clear()
+
+	def cache_stats(self) -> dict:
+		return {'users': self.user_cache.stats(), 'folders': self.folder_cache.stats(), 'children': self.children_cache.stats()}
@@ -0,0 +1,266 @@
+import sqlite3
+import logging
+from typing import Optional
+from .search import TOKENIZER
+
+
+# Recomputes usage from scratch into a temp table of (kind 0 folder / 1 user, id, file_count, total_size),
+# used to fill in usage columns when they are added and by Database.usage.check to find drift
+USAGE_TOTALS = """
+	DROP TABLE IF EXISTS temp.usage_totals;
+	CREATE TEMP TABLE usage_totals AS
+	WITH RECURSIVE tree(folder_id, ancestor) AS (
+		SELECT id, id FROM folders
+		UNION ALL
+		SELECT t.folder_id, f.parent_folder_id FROM tree t JOIN folders f ON f.id = t.ancestor WHERE f.parent_folder_id IS NOT NULL
+	)
+	SELECT 0 AS kind, t.ancestor AS id, COUNT(fi.id) AS file_count, COALESCE(SUM(fi.file_size), 0) AS total_size
+		FROM tree t JOIN files fi ON fi.parent_folder_id = t.folder_id GROUP BY t.ancestor
+	UNION ALL
+	SELECT 1, user_id, COUNT(*), COALESCE(SUM(file_size), 0) FROM files GROUP BY user_id;
+"""
+
+
+NOW = "CAST(strftime('%s', 'now') AS INTEGER)"
+
+def ancestors(folder_id: str) -> str:
+	# Subquery for a folder and all its parents, usable inside triggers
+	return f"WITH RECURSIVE up(id) AS (SELECT {folder_id} UNION ALL SELECT f.parent_folder_id FROM folders f JOIN up ON f.id = up.id WHERE f.parent_folder_id IS NOT NULL) SELECT id FROM up"
+
+
+# Each entry upgrades the schema by one version, index in list + 1 is stored in PRAGMA user_version.
+# Never edit an applied migration, append a new one instead.
+MIGRATIONS = [
+	# 1: base schema (IF NOT EXISTS so databases created before versioning are picked up as is)
+	"""
+	CREATE TABLE IF NOT EXISTS folders (
+		id INTEGER PRIMARY KEY,
+		user_id INTEGER,
+		name TEXT,
+		parent_folder_id INTEGER,
+			FOREIGN KEY (parent_folder_id) REFERENCES folders(id)
+	);
+	CREATE TABLE IF NOT EXISTS files (
+		id INTEGER PRIMARY KEY,
+		actual_file_id TEXT,
+		name TEXT,
+		mime_type TEXT,
+		user_id INTEGER,
+		message_id INTEGER,
+		parent_folder_id INTEGER,
+			FOREIGN KEY (parent_folder_id) REFERENCES folders(id)
+	);
+	CREATE TABLE IF NOT EXISTS users (
+		id INTEGER PRIMARY KEY,
+		last_opened_folder_id INTEGER,
+		root_folder_id INTEGER,
+			FOREIGN KEY (last_opened_folder_id) REFERENCES folders(id),
+			FOREIGN KEY (root_folder_id) REFERENCES folders(id)
+	);
+	""",
+	# 2: indexes for get_children and find_folder
+	"""
+	CREATE INDEX IF NOT EXISTS folders_parent_name ON folders (parent_folder_id, name);
+	CREATE INDEX IF NOT EXISTS files_parent_name ON files (parent_folder_id, name);
+	CREATE INDEX IF NOT EXISTS folders_user_name ON folders (user_id, name);
+	""",
+	# 3: durable queue for storage chat operations
+	"""
+	CREATE TABLE IF NOT EXISTS jobs (
+		id INTEGER PRIMARY KEY,
+		kind TEXT NOT NULL,
+		payload TEXT NOT NULL,
+		idempotency_key TEXT UNIQUE,
+		status TEXT NOT NULL DEFAULT 'pending',
+		attempts INTEGER NOT NULL DEFAULT 0,
+		next_run REAL NOT NULL,
+		last_error TEXT,
+		created REAL NOT NULL
+	);
+	CREATE INDEX IF NOT EXISTS jobs_status_next_run ON jobs (status, next_run);
+	""",
+	# 4: content deduplication, one storage message per distinct file_unique_id
+	"""
+	ALTER TABLE files ADD COLUMN file_unique_id TEXT;
+	CREATE INDEX IF NOT EXISTS files_unique_id ON files (file_unique_id);
+	CREATE TABLE IF NOT EXISTS blobs (
+		file_unique_id TEXT PRIMARY KEY,
+		actual_file_id TEXT NOT NULL,
+		message_id INTEGER NOT NULL,
+		refs INTEGER NOT NULL DEFAULT 0
+	);
+	CREATE INDEX IF NOT EXISTS blobs_unreferenced ON blobs (refs) WHERE refs <= 0;
+	CREATE TRIGGER IF NOT EXISTS files_blob_ref AFTER INSERT ON files WHEN NEW.file_unique_id IS NOT NULL BEGIN
+		UPDATE blobs SET refs = refs + 1 WHERE file_unique_id = NEW.file_unique_id;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_blob_unref AFTER DELETE ON files WHEN OLD.file_unique_id IS NOT NULL BEGIN
+		UPDATE blobs SET refs = refs - 1 WHERE file_unique_id = OLD.file_unique_id;
+	END;
+	""",
+	# 5: full-text search over folder and file names, rowid is id * 2 + kind (0 folder, 1 file).
+	# Terms are prefixed with the owner by search_terms (see search.py)
+	"""
+	CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(name, mime_type, tokenize = '""" + TOKENIZER + """');
+	INSERT INTO search (search, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
+	INSERT INTO search (rowid, name, mime_type) SELECT id * 2, search_terms(user_id, name), '' FROM folders;
+	INSERT INTO search (rowid, name, mime_type) SELECT id * 2 + 1, search_terms(user_id, name), search_terms(user_id, mime_type) FROM files;
+	CREATE TRIGGER IF NOT EXISTS folders_search_insert AFTER INSERT ON folders BEGIN
+		INSERT INTO search (rowid, name, mime_type) VALUES (NEW.id * 2, search_terms(NEW.user_id, NEW.name), '');
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_search_update AFTER UPDATE OF name, user_id ON folders BEGIN
+		UPDATE search SET name = search_terms(NEW.user_id, NEW.name) WHERE rowid = NEW.id * 2;
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_search_delete AFTER DELETE ON folders BEGIN
+		DELETE FROM search WHERE rowid = OLD.id * 2;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_search_insert AFTER INSERT ON files BEGIN
+		INSERT INTO search (rowid, name, mime_type) VALUES (NEW.id * 2 + 1, search_terms(NEW.user_id, NEW.name), search_terms(NEW.user_id, NEW.mime_type));
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_search_update AFTER UPDATE OF name, mime_type, user_id ON files BEGIN
+		UPDATE search SET name = search_terms(NEW.user_id, NEW.name), mime_type = search_terms(NEW.user_id, NEW.mime_type) WHERE rowid = NEW.id * 2 + 1;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_search_delete AFTER DELETE ON files BEGIN
+		DELETE FROM search WHERE rowid = OLD.id * 2 + 1;
+	END;
+	""",
+	# 6: document metadata known at upload time, older rows are filled in by a backfill job
+	"""
+	ALTER TABLE files ADD COLUMN file_size INTEGER;
+	CREATE INDEX IF NOT EXISTS files_missing_size ON files (id) WHERE file_size IS NULL;
+	""",
+	# 7: recursive file count, total size and last modification per folder and per user, plus optional user quotas.
+	# Triggers walk the ancestors of every changed row, so each write path keeps them right in its own transaction
+	"""
+	ALTER TABLE folders ADD COLUMN file_count INTEGER NOT NULL DEFAULT 0;
+	ALTER TABLE folders ADD COLUMN total_size INTEGER NOT NULL DEFAULT 0;
+	ALTER TABLE folders ADD COLUMN modified INTEGER;
+	ALTER TABLE users ADD COLUMN file_count INTEGER NOT NULL DEFAULT 0;
+	ALTER TABLE users ADD COLUMN total_size INTEGER NOT NULL DEFAULT 0;
+	ALTER TABLE users ADD COLUMN modified INTEGER;
+	ALTER TABLE users ADD COLUMN quota INTEGER;
+	""" + USAGE_TOTALS + """
+	UPDATE folders SET (file_count, total_size) = (SELECT file_count, total_size FROM usage_totals t WHERE t.kind = 0 AND t.id = folders.id)
+		WHERE id IN (SELECT id FROM usage_totals WHERE kind = 0);
+	UPDATE users SET (file_count, total_size) = (SELECT file_count, total_size FROM usage_totals t WHERE t.kind = 1 AND t.id = users.id)
+		WHERE id IN (SELECT id FROM usage_totals WHERE kind = 1);
+	DROP TABLE usage_totals;
+	CREATE TRIGGER IF NOT EXISTS files_usage_insert AFTER INSERT ON files BEGIN
+		UPDATE folders SET file_count = file_count + 1, total_size = total_size + COALESCE(NEW.file_size, 0), modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('NEW.parent_folder_id') + """);
+		UPDATE users SET file_count = file_count + 1, total_size = total_size + COALESCE(NEW.file_size, 0), modified = """ + NOW + """
+			WHERE id = NEW.user_id;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_usage_delete AFTER DELETE ON files BEGIN
+		UPDATE folders SET file_count = file_count - 1, total_size = total_size - COALESCE(OLD.file_size, 0), modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('OLD.parent_folder_id') + """);
+		UPDATE users SET file_count = file_count - 1, total_size = total_size - COALESCE(OLD.file_size, 0), modified = """ + NOW + """
+			WHERE id = OLD.user_id;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_usage_size AFTER UPDATE OF file_size ON files BEGIN
+		UPDATE folders SET total_size = total_size + COALESCE(NEW.file_size, 0) - COALESCE(OLD.file_size, 0)
+			WHERE id IN (""" + ancestors('NEW.parent_folder_id') + """);
+		UPDATE users SET total_size = total_size + COALESCE(NEW.file_size, 0) - COALESCE(OLD.file_size, 0) WHERE id = NEW.user_id;
+	END;
+	CREATE TRIGGER IF NOT EXISTS files_usage_move AFTER UPDATE OF parent_folder_id ON files WHEN OLD.parent_folder_id IS NOT NEW.parent_folder_id BEGIN
+		UPDATE folders SET file_count = file_count - 1, total_size = total_size - COALESCE(OLD.file_size, 0), modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('OLD.parent_folder_id') + """);
+		UPDATE folders SET file_count = file_count + 1, total_size = total_size + COALESCE(OLD.file_size, 0), modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('NEW.parent_folder_id') + """);
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_usage_insert AFTER INSERT ON folders BEGIN
+		UPDATE folders SET modified = """ + NOW + """ WHERE id IN (""" + ancestors('NEW.id') + """);
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_usage_rename AFTER UPDATE OF name ON folders BEGIN
+		UPDATE folders SET modified = """ + NOW + """ WHERE id IN (""" + ancestors('NEW.id') + """);
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_usage_delete AFTER DELETE ON folders BEGIN
+		UPDATE folders SET modified = """ + NOW + """ WHERE id IN (""" + ancestors('OLD.parent_folder_id') + """);
+	END;
+	CREATE TRIGGER IF NOT EXISTS folders_usage_move AFTER UPDATE OF parent_folder_id ON folders WHEN OLD.parent_folder_id IS NOT NEW.parent_folder_id BEGIN
+		UPDATE folders SET file_count = file_count - NEW.file_count, total_size = total_size - NEW.total_size, modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('OLD.parent_folder_id') + """);
+		UPDATE folders SET file_count = file_count + NEW.file_count, total_size = total_size + NEW.total_size, modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('NEW.parent_folder_id') + """);
+	END;
+	""",
+	# 8: finds rows stored before deduplication by their storage message, for imports that share them
+	"""
+	CREATE INDEX IF NOT EXISTS files_legacy_message ON files (message_id) WHERE file_unique_id IS NULL;
+	""",
+	# 9: files uploaded before owners were recorded carry the storage chat id as user_id, they belong to their folder's owner.
+	# The search trigger re-indexes the moved rows, per-user totals are recounted as no trigger follows user_id
+	"""
+	UPDATE files SET user_id = (SELECT user_id FROM folders WHERE id = files.parent_folder_id)
+		WHERE user_id IS NOT (SELECT user_id FROM folders WHERE id = files.parent_folder_id)
+		AND parent_folder_id IN (SELECT id FROM folders);
+	UPDATE users SET (file_count, total_size) = (SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM files WHERE files.user_id = users.id);
+	""",
+	# 10: the search triggers of 5 called the app's search_terms function, so writes from any other connection (the sqlite3 shell,
+	# admin scripts) failed. They now only queue the search rowid in plain SQL, lib.indexer.SearchIndexer builds the terms
+	"""
+	CREATE TABLE IF NOT EXISTS search_pending (id INTEGER PRIMARY KEY);
+	DROP TRIGGER IF EXISTS folders_search_insert;
+	DROP TRIGGER IF EXISTS folders_search_update;
+	DROP TRIGGER IF EXISTS files_search_insert;
+	DROP TRIGGER IF EXISTS files_search_update;
+	CREATE TRIGGER folders_search_insert AFTER INSERT ON folders BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2);
+	END;
+	CREATE TRIGGER folders_search_update AFTER UPDATE OF name, user_id ON folders BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2);
+	END;
+	CREATE TRIGGER files_search_insert AFTER INSERT ON files BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2 + 1);
+	END;
+	CREATE TRIGGER files_search_update AFTER UPDATE OF name, mime_type, user_id ON files BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2 + 1);
+	END;
+	""",
+	# 11: bulk loads (lib/archive.py) put a row in bulk_load for the length of their transaction, the insert triggers
+	# skip per-row work then and the loader updates usage totals and search_pending for the whole batch at once.
+	# Other connections never see the row, the loader holds the write lock until it's gone
+	"""
+	CREATE TABLE IF NOT EXISTS bulk_load (active INTEGER);
+	DROP TRIGGER IF EXISTS files_usage_insert;
+	DROP TRIGGER IF EXISTS folders_usage_insert;
+	DROP TRIGGER IF EXISTS files_search_insert;
+	DROP TRIGGER IF EXISTS folders_search_insert;
+	CREATE TRIGGER files_usage_insert AFTER INSERT ON files WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+		UPDATE folders SET file_count = file_count + 1, total_size = total_size + COALESCE(NEW.file_size, 0), modified = """ + NOW + """
+			WHERE id IN (""" + ancestors('NEW.parent_folder_id') + """);
+		UPDATE users SET file_count = file_count + 1, total_size = total_size + COALESCE(NEW.file_size, 0), modified = """ + NOW + """
+			WHERE id = NEW.user_id;
+	END;
+	CREATE TRIGGER folders_usage_insert AFTER INSERT ON folders WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+		UPDATE folders SET modified = """ + NOW + """ WHERE id IN (""" + ancestors('NEW.id') + """);
+	END;
+	CREATE TRIGGER files_search_insert AFTER INSERT ON files WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2 + 1);
+	END;
+	CREATE TRIGGER folders_search_insert AFTER INSERT ON folders WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+		INSERT OR IGNORE INTO search_pending (id) VALUES (NEW.id * 2);
+	END;
+	""",
+	# 12: progress of jobs that walk a table page by page, kept after their job rows are pruned
+	"""
+	CREATE TABLE IF NOT EXISTS job_cursors (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+	""",
+]
+
+
+def get_version(con: sqlite3.Connection) -> int:
+	return con.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(con: sqlite3.Connection, target: Optional[int] = None) -> int:
+	target = len(MIGRATIONS) if target is None else target
+	version = get_version(con)
+	while version < target:
+		logging.info(f'Migrating database schema to version {version + 1}')
+		try:
+			con.executescript(f"BEGIN; {MIGRATIONS[version]}; PRAGMA user_version = {version + 1}; COMMIT;")
+		except Exception:
+			if con.in_transaction:
+				con.execute("ROLLBACK")
+			raise
+		version += 1
+	return version
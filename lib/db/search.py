@@ -0,0 +1,22 @@
+import re
+from typing import Optional
+
+
+# FTS5 can't filter by user_id cheaply, so every indexed word is stored as u<user_id>_<word>.
+# A user's (prefix) query then only ever touches that user's terms, and bm25 statistics are per user.
+# search_terms is registered as an SQL function on the app's connections. Triggers only queue changed rows in
+# search_pending, so other connections can write without it, and lib.indexer.SearchIndexer indexes them.
+TOKENIZER = "unicode61 remove_diacritics 2 tokenchars _"
+
+def search_words(text: Optional[str]) -> list:
+	return re.findall(r'[^\W_]+', text or '')
+
+def search_terms(user_id: int, text: Optional[str]) -> str:
+	return ' '.join(f'u{user_id}_{x}' for x in search_words(text))
+
+def search_query(user_id: int, text: str) -> Optional[str]:
+	# Every word of the user's text becomes a quoted prefix term, so FTS5 operators in it are taken literally
+	words = search_words(text)
+	if not words:
+		return None
+	return ' '.join(f'"u{int(user_id)}_{x}"*' for x in words)
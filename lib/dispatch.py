@@ -0,0 +1,81 @@
+import logging
+from collections import deque
+from queue import Queue
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable, Hashable
+from lib.base import Service
+
+
+class CommandStats:
+	def __init__(self) -> None:
+		self.count = 0
+		self.errors = 0
+		self.wait_total = 0.0
+		self.wait_max = 0.0
+		self.exec_total = 0.0
+		self.exec_max = 0.0
+
+	def __repr__(self):
+		return f"CommandStats(count={self.count}, errors={self.errors}, " \
+			f"wait_avg={self.wait_total / (self.count or 1):.4f}, wait_max={self.wait_max:.4f}, " \
+			f"exec_avg={self.exec_total / (self.count or 1):.4f}, exec_max={self.exec_max:.4f})"
+
+
+class Dispatcher(Service):
+	# Fixed pool of workers. Jobs with the same key (user id) run one at a time in submission order,
+	# different keys run in parallel. A key goes to the back of the ready queue after each job so busy users can't starve others.
+	def __init__(self, workers: int = 8, max_pending: int = 10000):
+		self.max_pending = max_pending
+		self.pending = 0
+		self.queues: dict[Hashable, deque] = {}
+		self.ready: Queue = Queue()
+		self.lock = Lock()
+		self.stats: dict[str, CommandStats] = {}
+		self.threads = [Thread(target=self.worker, name=f'dispatch-{i}', daemon=True) for i in range(workers)]
+		for t in self.threads:
+			t.start()
+
+	def submit(self, key: Hashable, name: str, fn: Callable, *args) -> bool:
+		with self.lock:
+			if self.pending >= self.max_pending:
+				logging.warning(f'Dispatcher queue full, dropping "{name}" for {key}')
+				return False
+			self.pending += 1
+			item = (name, fn, args, monotonic())
+			if (q := self.queues.get(key)) is not None:
+				q.append(item)
+			else:
+				self.queues[key] = deque([item])
+				self.ready.put(key)
+		return True
+
+	def worker(self):
+		while True:
+			key = self.ready.get()
+			with self.lock:
+				name, fn, args, queued = self.queues[key].popleft()
+			start = monotonic()
+			failed = False
+			try:
+				fn(*args)
+			except Exception as e:
+				failed = True
+				logging.error(f'Error in dispatched command "{name}" for {key}: {e}')
+			end = monotonic()
+			with self.lock:
+				s = self.stats.get(name) or self.stats.setdefault(name, CommandStats())
+				s.count += 1
+				s.errors += failed
+				s.wait_total += start - queued
+				s.wait_max = max(s.wait_max, start - queued)
+				s.exec_total += end - start
+				s.exec_max = max(s.exec_max, end - start)
+				self.pending -= 1
+				if self.queues[key]:
+					self.ready.put(key)
+				else:
+					del self.queues[key]
+
+	def depth(self) -> int:
+		return self.pending
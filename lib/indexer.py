@@ -0,0 +1,30 @@
+import logging
+from threading import Event, Thread
+from lib.base import Service
+from lib.db import Database
+
+
+class SearchIndexer(Service):
+	# Drains search_pending on its own thread so searches only ever read. Woken after every commit of this process,
+	# and every poll_interval for rows queued by other processes (backup.py imports, the sqlite3 shell).
+	# Each batch is a short transaction, a large backlog never holds the writer for long
+	def __init__(self, db: Database, batch: int = 5000, poll_interval: float = 1.0):
+		self.db = db
+		self.batch = batch
+		self.poll_interval = poll_interval
+		self.wakeup = Event()
+		db.pool.commit_hooks.append(self.wakeup.set)
+		self.thread = Thread(target=self.worker, name='search-indexer', daemon=True)
+
+	def start(self):
+		self.thread.start()
+
+	def worker(self):
+		while True:
+			try:
+				while self.db.search.has_pending() and self.db.search.index_pending(self.batch) == self.batch:
+					pass
+			except Exception as e:
+				logging.error(f'Search indexing failed: {e}')
+			self.wakeup.wait(self.poll_interval)
+			self.wakeup.clear()
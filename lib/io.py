@@ -1,43 +1,255 @@
 import logging
+from threading import Lock, Timer
+from typing import Callable
 from lib.base import Service
 from lib.db import Database, FileData, FolderData
-from lib.bot import TelegramBot
+from lib.db.main import JobData
+from lib.bot import TelegramBot, BACKGROUND
+from lib.jobs import JobQueue
+from utils.funcs import chunks
 from telebot import types as tt
+from telebot.apihelper import ApiTelegramException
 
 
 class TelegramIO(Service):
-	def __init__(self, storage: tt.Chat, tg: TelegramBot, db: Database) -> None:
+	def __init__(self, storage: tt.Chat, tg: TelegramBot, db: Database, workers: int = 2) -> None:
 		self.chat = storage
 		self.tg   = tg
 		self.db   = db
+		# Called with (user_id, folder, uploaded, failed) when a queued upload finishes
+		self.on_uploaded: Callable[[int, FolderData, list[FileData], list[tt.Document]], None]|None = None
+		self.jobs = JobQueue(db, workers)
+		self.jobs.register('forward', self._forward_job, self._forward_failed)
+		self.jobs.register('delete', self._delete_job)
+		self.jobs.register('backfill_size', self._backfill_size_job)
+		# Rows before the cursor were asked for already, the ones still without a size are too big for getFile
+		after = self.db.job.get_cursor('backfill_size')
+		if self.db.file.missing_size(after, limit=1):
+			self.jobs.enqueue('backfill_size', {'after': after}, f'backfill_size:{after}')
+
+	def _send(self, files: list[tt.Document], caption: str = None) -> list[tt.Message]:
+		if len(files) == 1:
+			return [self.tg.call(self.chat.id, self.tg.bot.send_document, self.chat.id, files[0].file_id, caption=caption, priority=BACKGROUND)]
+		if not 1 < len(files) <= 10:
+			raise ValueError(f"Media group must have 2-10 files, got {len(files)}")
+		return self.tg.call(self.chat.id, self.tg.bot.send_media_group, self.chat.id,
+						  [tt.InputMediaDocument(f.file_id) for f in files], priority=BACKGROUND)
+
+	def _send_new(self, files: list[tt.Document], caption: str = None) -> dict[str, int]:
+		# Forwards only content the storage chat doesn't hold yet, returns storage message ids by content key
+		known = self.db.blob.get_blobs([f.file_unique_id for f in files if f.file_unique_id])
+		new = list({content_key(f): f for f in files if f.file_unique_id not in known}.values())
+		msgs = self._send(new, caption) if new else []
+		return {content_key(f): msg.message_id for f, msg in zip(new, msgs)}
+
+	def _store(self, files: list[tt.Document], sent: dict[str, int], folder: FolderData) -> list[int]:
+		with self.db.transaction():
+			file_ids, spare = store_files(self.db, files, sent, folder)
+			if spare:
+				self._enqueue_delete(spare)
+			return file_ids
 
 	def upload(self, f: tt.Document, folder: FolderData, caption: str = None) -> FileData:
 		try:
-			msg = self.tg.bot.send_document(self.chat.id, f.file_id, caption=caption)
-			file_id = self.db.file.create_file(
-							actual_file_id=f.file_id, name=f.file_name, mime_type=f.mime_type,
-							user_id=self.chat.id, message_id=msg.message_id,
-							parent_folder_id=folder.folder_id
-			)
+			file_id, = self._store([f], self._send_new([f], caption), folder)
 			return self.db.file.get_file(file_id)
 		except Exception as e:
-			logging.error("File upload failed:", e)
+			logging.error(f"File upload failed: {e}")
+			raise ValueError("File upload failed")
+
+	def upload_group(self, files: list[tt.Document], folder: FolderData) -> list[FileData]:
+		# Telegram media groups hold 2-10 items, a single file goes through a plain upload
+		try:
+			return [self.db.file.get_file(x) for x in self._store(files, self._send_new(files), folder)]
+		except Exception as e:
+			logging.error(f"File group upload failed: {e}")
 			raise ValueError("File upload failed")
 
+	def enqueue_upload(self, user_id: int, folder: FolderData, files: list[tt.Document], message_id: int):
+		# message_id of the first user message in the batch makes Telegram redeliveries a no-op
+		self.jobs.enqueue('forward', {
+			'user_id': user_id, 'folder_id': folder.folder_id, 'uploaded': [],
+			'files': [{'file_id': f.file_id, 'file_unique_id': f.file_unique_id, 'file_name': f.file_name,
+					   'mime_type': f.mime_type, 'file_size': f.file_size} for f in files],
+		}, f'forward:{user_id}:{message_id}')
+
+	def _forward_job(self, job: JobData):
+		p = job.payload
+		folder = self.db.folder.get_folder(p['folder_id'])
+		if folder is None:
+			logging.warning(f"Folder {p['folder_id']} is gone, dropping upload job {job.job_id}")
+			return
+		while p['files']:
+			group = [tt.Document(**x) for x in p['files'][:10]]
+			sent = self._send_new(group)
+			# Rows and job progress are committed together, a retry resumes with the files not stored yet
+			with self.db.transaction():
+				p['uploaded'] += self._store(group, sent, folder)
+				p['files'] = p['files'][len(group):]
+				self.db.job.update_payload(job.job_id, p)
+		self._notify_uploaded(p, folder, [])
+
+	def _forward_failed(self, job: JobData):
+		p = job.payload
+		if (folder := self.db.folder.get_folder(p['folder_id'])) is not None:
+			self._notify_uploaded(p, folder, [tt.Document(**x) for x in p['files']])
+
+	def _notify_uploaded(self, p: dict, folder: FolderData, failed: list[tt.Document]):
+		if self.on_uploaded is not None:
+			uploaded = [f for x in p['uploaded'] if (f := self.db.file.get_file(x)) is not None]
+			self.on_uploaded(p['user_id'], folder, uploaded, failed)
+
 	def get(self, file_id: int) -> tt.File:
 		try:
-			return self.tg.bot.get_file(file_id)
+			return self.tg.call(None, self.tg.bot.get_file, file_id)
 		except Exception as e:
-			logging.error("Error retrieving file:", e)
+			logging.error(f"Error retrieving file: {e}")
 			raise ValueError("Error retrieving file")
 
-	def delete(self, file_id: int):
-		try:
-			message_id = self.db.get_file_message_id(file_id)
-			if not message_id:
+	def delete(self, file_id: int) -> FileData:
+		# Removes the row now, storage messages nobody references anymore are deleted by the job queue
+		with self.db.transaction():
+			file = self.db.file.get_file(file_id)
+			if file is None:
 				raise ValueError(f"Invalid file: {file_id}")
-			self.tg.bot.delete_message(self.chat.id, message_id)
-			self.db.delete_file(file_id)
+			self.db.file.delete_file(file_id)
+			self._release([file])
+		return file
+
+	def delete_folder(self, folder_id: int) -> list[FileData]:
+		with self.db.transaction():
+			files = self.db.folder.delete_folder(folder_id)
+			self._release(files)
+		return files
+
+	def _release(self, files: list[FileData]):
+		for group in chunks(release_files(self.db, files), 100):
+			self._enqueue_delete(group)
+
+	def _enqueue_delete(self, message_ids: list[int]):
+		self.jobs.enqueue('delete', {'message_ids': message_ids}, f'delete:{message_ids[0]}:{len(message_ids)}')
+
+	def _delete_job(self, job: JobData):
+		ids = job.payload['message_ids']
+		try:
+			if len(ids) == 1:
+				self.tg.call(self.chat.id, self.tg.bot.delete_message, self.chat.id, ids[0], priority=BACKGROUND)
+			else:
+				self.tg.call(self.chat.id, self.tg.bot.delete_messages, self.chat.id, ids, priority=BACKGROUND)
+		except ApiTelegramException as e:
+			if e.error_code != 400:
+				raise
+			# Already deleted or too old to delete, retrying won't help
+			logging.warning(f"Could not delete storage messages {ids}: {e.description}")
+
+	def _backfill_size_job(self, job: JobData):
+		# Sizes of files stored before they were recorded, getFile only returns metadata and sends nothing to the
+		# storage chat, so it only takes from the global rate limit. One page per job, the next one queues up behind
+		# the forwards and deletes enqueued meanwhile instead of holding a worker until the whole table is done
+		after = job.payload['after']
+		rows = self.db.file.missing_size(after)
+		for file_id, actual_file_id in rows:
+			try:
+				f = self.tg.call(None, self.tg.bot.get_file, actual_file_id, priority=BACKGROUND)
+				if f.file_size is not None:
+					self.db.file.set_file_size(file_id, f.file_size)
+			except ApiTelegramException as e:
+				if e.error_code != 400:
+					raise
+				# Too big for getFile, preview_file records the size when the file is opened
+				logging.info(f"Could not get size of file {file_id}: {e.description}")
+		if rows:
+			with self.db.transaction():
+				self.db.job.set_cursor('backfill_size', rows[-1][0])
+				self.jobs.enqueue('backfill_size', {'after': rows[-1][0]}, f'backfill_size:{rows[-1][0]}')
+
+
+def content_key(f: tt.Document) -> str:
+	return f.file_unique_id or f.file_id
+
+def store_files(db: Database, files: list[tt.Document], sent: dict[str, int], folder: FolderData) -> tuple[list[int], list[int]]:
+	# Creates the rows of files forwarded by _send_new, returns (file ids, storage messages that turned out to be spare copies)
+	with db.transaction():
+		for f in files:
+			if f.file_unique_id and f.file_unique_id in sent:
+				db.blob.add(f.file_unique_id, f.file_id, sent[f.file_unique_id])
+		blobs = db.blob.get_blobs([f.file_unique_id for f in files if f.file_unique_id])
+		file_ids, spare = [], []
+		for f in files:
+			if (blob := blobs.get(f.file_unique_id)) is not None:
+				message_id = blob.message_id
+				if content_key(f) in sent and sent[content_key(f)] != message_id:
+					# Same content was stored concurrently, ours is a spare copy
+					spare.append(sent.pop(content_key(f)))
+			elif content_key(f) in sent:
+				message_id = sent[content_key(f)]
+			else:
+				raise ValueError(f"Storage message for {f.file_unique_id} was released meanwhile")
+			file_ids.append(db.file.create_file(
+							actual_file_id=f.file_id, name=f.file_name, mime_type=f.mime_type,
+							user_id=folder.user_id, message_id=message_id,
+							parent_folder_id=folder.folder_id, file_unique_id=f.file_unique_id, file_size=f.file_size
+			))
+		return file_ids, spare
+
+def release_files(db: Database, files: list[FileData]) -> list[int]:
+	# Storage messages no row references after files were deleted in the current transaction.
+	# Rows stored before deduplication own their message, the rest go through blob reference counts
+	return db.blob.release() + [x.message_id for x in files if x.file_unique_id is None]
+
+
+class UploadBatch:
+	def __init__(self, folder: FolderData) -> None:
+		self.folder = folder
+		self.files: list[tt.Document] = []
+		self.message_ids: list[int] = []
+		self.timer: Timer|None = None
+
+
+class UploadCoalescer:
+	# Buffers documents per user for `window` seconds, then hands the whole batch to
+	# on_flush(user_id, folder, files, first_message_id) in one go.
+	def __init__(self, on_flush: Callable[[int, FolderData, list[tt.Document], int], None], window: float = 1.5):
+		self.on_flush = on_flush
+		self.window = window
+		self.lock = Lock()
+		self.pending: dict[int, UploadBatch] = {}
+		# Bytes per user of batches handed to on_flush that it hasn't returned from yet
+		self.flushing: dict[int, int] = {}
+
+	def add(self, user_id: int, f: tt.Document, folder: FolderData, message_id: int):
+		with self.lock:
+			batch = self.pending.get(user_id)
+			if batch is not None and batch.folder.folder_id != folder.folder_id:
+				# User switched folders mid-window, send what we have right away
+				batch.timer.cancel()
+				Timer(0, self.flush, (user_id, batch)).start()
+				batch = None
+			if batch is None:
+				batch = self.pending[user_id] = UploadBatch(folder)
+				batch.timer = Timer(self.window, self.flush, (user_id, batch))
+				batch.timer.start()
+			batch.files.append(f)
+			batch.message_ids.append(message_id)
+
+	def pending_size(self, user_id: int) -> int:
+		with self.lock:
+			batch = self.pending.get(user_id)
+			return (sum(f.file_size or 0 for f in batch.files) if batch is not None else 0) + self.flushing.get(user_id, 0)
+
+	def flush(self, user_id: int, batch: UploadBatch):
+		size = sum(f.file_size or 0 for f in batch.files)
+		with self.lock:
+			if self.pending.get(user_id) is batch:
+				del self.pending[user_id]
+			self.flushing[user_id] = self.flushing.get(user_id, 0) + size
+		try:
+			self.on_flush(user_id, batch.folder, batch.files, batch.message_ids[0])
 		except Exception as e:
-			logging.error("File deletion failed:", e)
-			raise ValueError("File deletion failed")
\ No newline at end of file
+			logging.error(f"Upload flush failed for user {user_id}: {e}")
+		finally:
+			with self.lock:
+				if (left := self.flushing[user_id] - size):
+					self.flushing[user_id] = left
+				else:
+					del self.flushing[user_id]
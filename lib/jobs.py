@@ -0,0 +1,76 @@
+import logging
+from threading import Event, Thread
+from time import monotonic
+from typing import Callable
+from lib.base import Service
+from lib.db import Database
+from lib.db.main import JobData
+
+
+class JobQueue(Service):
+	# Workers draining the jobs table. A handler gets the claimed job and raises to have it retried with
+	# exponential backoff, after max_attempts the job is marked failed and on_failure is called.
+	# Jobs still marked running at startup were interrupted by a crash and are picked up again.
+	def __init__(self, db: Database, workers: int = 2, max_attempts: int = 8, max_backoff: float = 300,
+			  poll_interval: float = 1.0, keep_done: float = 24 * 3600):
+		self.db = db
+		self.max_attempts = max_attempts
+		self.max_backoff = max_backoff
+		self.poll_interval = poll_interval
+		self.keep_done = keep_done
+		self.handlers: dict[str, Callable[[JobData], None]] = {}
+		self.failure_handlers: dict[str, Callable[[JobData], None]] = {}
+		self.wakeup = Event()
+		self.last_prune = 0.0
+		requeued = db.job.requeue_running()
+		if requeued:
+			logging.info(f'Resuming {requeued} interrupted jobs')
+		self.threads = [Thread(target=self.worker, name=f'jobs-{i}', daemon=True) for i in range(workers)]
+
+	def register(self, kind: str, handler: Callable[[JobData], None], on_failure: Callable[[JobData], None] = None):
+		self.handlers[kind] = handler
+		if on_failure is not None:
+			self.failure_handlers[kind] = on_failure
+
+	def start(self):
+		for t in self.threads:
+			t.start()
+
+	def enqueue(self, kind: str, payload: dict, idempotency_key: str|None = None) -> int|None:
+		job_id = self.db.job.enqueue(kind, payload, idempotency_key)
+		self.wakeup.set()
+		return job_id
+
+	def worker(self):
+		while True:
+			jobs = self.db.job.claim()
+			if not jobs:
+				self.maybe_prune()
+				self.wakeup.wait(self.poll_interval)
+				self.wakeup.clear()
+				continue
+			for job in jobs:
+				self.run(job)
+
+	def run(self, job: JobData):
+		try:
+			self.handlers[job.kind](job)
+			self.db.job.complete(job.job_id)
+		except Exception as e:
+			if job.attempts >= self.max_attempts:
+				logging.error(f'Job {job.job_id} ({job.kind}) failed after {job.attempts} attempts: {e}')
+				self.db.job.fail(job.job_id, str(e))
+				if (h := self.failure_handlers.get(job.kind)) is not None:
+					try:
+						h(job)
+					except Exception as e:
+						logging.error(f'Failure handler of job {job.job_id} ({job.kind}) failed: {e}')
+			else:
+				delay = min(self.max_backoff, 2 ** job.attempts)
+				logging.warning(f'Job {job.job_id} ({job.kind}) attempt {job.attempts} failed, retrying in {delay}s: {e}')
+				self.db.job.retry(job.job_id, delay, str(e))
+
+	def maybe_prune(self):
+		if monotonic() - self.last_prune > 3600:
+			self.last_prune = monotonic()
+			self.db.job.prune(self.keep_done)
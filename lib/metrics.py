@@ -0,0 +1,277 @@
+import re
+import json
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Awaitable, Callable, Iterator, TypeVar
+from telebot.apihelper import ApiTelegramException
+from telebot.asyncio_helper import ApiTelegramException as AsyncApiTelegramException
+from lib.base import Service
+from lib.db import Database
+from lib.db.connection import counter
+
+
+T = TypeVar('T')
+Labels = tuple[tuple[str, str], ...]
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+	'tgdrive_db_seconds': ('histogram', 'Time spent in Database handler methods, nested calls included'),
+	'tgdrive_db_queries_total': ('counter', 'SQLite statements run by Database handler methods, nested calls included'),
+	'tgdrive_telegram_call_seconds': ('histogram', 'Bot API calls including rate limiter waits and 429 retries'),
+	'tgdrive_telegram_request_seconds': ('histogram', 'Single Bot API requests'),
+	'tgdrive_telegram_errors_total': ('counter', 'Failed Bot API requests by error code'),
+	'tgdrive_callback_seconds': ('histogram', 'Callback commands from start to finish'),
+	'tgdrive_slow_callbacks_total': ('counter', 'Callback commands slower than the trace threshold'),
+}
+
+DB_HANDLERS = ('user', 'folder', 'file', 'job', 'blob', 'search', 'usage')
+
+# Trace of the request being handled, set for the duration of Metrics.trace
+current_trace: ContextVar['Trace|None'] = ContextVar('current_trace', default=None)
+
+
+class Histogram:
+	__slots__ = ('buckets', 'count', 'sum')
+
+	def __init__(self):
+		self.buckets = [0] * (len(BUCKETS) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def observe(self, value: float):
+		self.buckets[bisect_left(BUCKETS, value)] += 1
+		self.count += 1
+		self.sum += value
+
+
+class Trace:
+	# Timed steps of one request in the order they finished, as [kind, name, ms, queries, nesting depth]
+	def __init__(self, name: str, user_id: int|None, max_spans: int = 200):
+		self.name = name
+		self.user_id = user_id
+		self.max_spans = max_spans
+		self.spans: list[list] = []
+		self.queries = 0
+		self.dropped = 0
+		self.start = perf_counter()
+
+	def add(self, kind: str, name: str, seconds: float, queries: int|None = None, depth: int = 0):
+		if queries is not None and not depth:
+			self.queries += queries
+		if len(self.spans) < self.max_spans:
+			self.spans.append([kind, name, round(seconds * 1000, 3), queries, depth])
+		else:
+			self.dropped += 1
+
+
+class Metrics(Service):
+	# In-memory timings and counters, served in the Prometheus text format by serve().
+	# Requests slower than `slow` seconds are written to trace_log with every DB and API step they took
+	def __init__(self, slow: float|None = None, trace_log: logging.Logger|None = None):
+		self.slow = slow
+		self.trace_log = trace_log or logging.getLogger('tgdrive.trace')
+		self.lock = threading.Lock()
+		self.histograms: dict[tuple[str, Labels], Histogram] = {}
+		self.counters: dict[tuple[str, Labels], float] = {}
+		self.gauges: dict[str, tuple[str, str|None, Callable[[], float|dict[str, float]]]] = {}
+		self.server: ThreadingHTTPServer|None = None
+		# Nesting of timed Database calls on this thread
+		self.local = threading.local()
+		self.gauge('tgdrive_threads', 'Live threads by pool', thread_pools, 'pool')
+
+	def histogram(self, name: str, labels: Labels) -> Histogram:
+		with self.lock:
+			h = self.histograms.get((name, labels))
+			if h is None:
+				h = self.histograms[(name, labels)] = Histogram()
+			return h
+
+	def observe(self, name: str, labels: Labels, seconds: float):
+		h = self.histogram(name, labels)
+		with self.lock:
+			h.observe(seconds)
+
+	def inc(self, name: str, labels: Labels, value: float = 1):
+		with self.lock:
+			self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+	def gauge(self, name: str, help: str, fn: Callable[[], float|dict[str, float]], label: str|None = None):
+		# fn is read at scrape time, with `label` set it returns values by label value
+		self.gauges[name] = (help, label, fn)
+
+	def instrument(self, db: Database):
+		# Replaces the public methods of db's handlers with timed ones, calls between handlers go through them too
+		for handler_name in DB_HANDLERS:
+			handler = getattr(db, handler_name)
+			for name in dir(type(handler)):
+				if not name.startswith('_') and callable(getattr(handler, name)):
+					setattr(handler, name, self._timed_db(handler_name, name, getattr(handler, name)))
+		self.gauge('tgdrive_sqlite_queries', 'SQLite statements run on all connections', db.pool.query_count)
+		self.gauge('tgdrive_cache_hit_rate', 'Hit rate of the row caches', lambda: {k: v['hit_rate'] for k, v in db.cache_stats().items()}, 'cache')
+
+	def _timed_db(self, handler: str, method: str, fn: Callable[..., T]) -> Callable[..., T]:
+		labels = (('handler', handler), ('method', method))
+		h = self.histogram('tgdrive_db_seconds', labels)
+		span = f'{handler}.{method}'
+		local = self.local
+		def timed(*args, **kwargs):
+			depth = getattr(local, 'depth', 0)
+			local.depth = depth + 1
+			queries = counter.queries
+			start = perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				seconds = perf_counter() - start
+				n = counter.queries - queries
+				local.depth = depth
+				with self.lock:
+					h.observe(seconds)
+					self.counters[('tgdrive_db_queries_total', labels)] = self.counters.get(('tgdrive_db_queries_total', labels), 0) + n
+				if (trace := current_trace.get()) is not None:
+					trace.add('db', span, seconds, n, depth)
+		return timed
+
+	def api(self, fn: Callable[..., T]) -> Callable[..., T]:
+		# Times every request made through fn, one per attempt when the scheduler retries
+		method = fn.__name__
+		def timed(*args, **kwargs):
+			start = perf_counter()
+			error = None
+			try:
+				return fn(*args, **kwargs)
+			except Exception as e:
+				error = api_error(e)
+				raise
+			finally:
+				self._request_done(method, perf_counter() - start, error)
+		return timed
+
+	def api_async(self, fn: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+		method = fn.__name__
+		async def timed(*args, **kwargs):
+			start = perf_counter()
+			error = None
+			try:
+				return await fn(*args, **kwargs)
+			except Exception as e:
+				error = api_error(e)
+				raise
+			finally:
+				self._request_done(method, perf_counter() - start, error)
+		return timed
+
+	def _request_done(self, method: str, seconds: float, error: str|None):
+		self.observe('tgdrive_telegram_request_seconds', (('method', method),), seconds)
+		if error is not None:
+			self.inc('tgdrive_telegram_errors_total', (('method', method), ('code', error)))
+		if (trace := current_trace.get()) is not None:
+			trace.add('api', method if error is None else f'{method} ({error})', seconds)
+
+	@contextmanager
+	def timer(self, name: str, labels: Labels) -> Iterator[None]:
+		start = perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, labels, perf_counter() - start)
+
+	@contextmanager
+	def trace(self, command: str, user_id: int|None = None) -> Iterator[Trace]:
+		# Times a callback command and logs its steps if it took longer than `slow`
+		trace = Trace(f'callback {command}', user_id)
+		token = current_trace.set(trace)
+		try:
+			yield trace
+		finally:
+			current_trace.reset(token)
+			seconds = perf_counter() - trace.start
+			self.observe('tgdrive_callback_seconds', (('command', command),), seconds)
+			if self.slow is not None and seconds >= self.slow:
+				self.inc('tgdrive_slow_callbacks_total', (('command', command),))
+				self.trace_log.warning(json.dumps({
+					'request': trace.name, 'user_id': user_id, 'ms': round(seconds * 1000, 3),
+					'queries': trace.queries, 'spans': trace.spans, 'dropped': trace.dropped,
+				}, ensure_ascii=False))
+
+	def render(self) -> str:
+		with self.lock:
+			histograms = {k: (list(v.buckets), v.count, v.sum) for k, v in self.histograms.items()}
+			counters = dict(self.counters)
+		lines = []
+		for name, (kind, help) in METRICS.items():
+			lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+			if kind == 'histogram':
+				for (n, labels), (buckets, count, total) in sorted(histograms.items()):
+					if n != name or not count:
+						continue
+					cumulative = 0
+					for le, c in zip(BUCKETS + ('+Inf',), buckets):
+						cumulative += c
+						lines.append(f'{name}_bucket{format_labels(labels + (("le", str(le)),))} {cumulative}')
+					lines.append(f'{name}_sum{format_labels(labels)} {total}')
+					lines.append(f'{name}_count{format_labels(labels)} {count}')
+			else:
+				lines += [f'{name}{format_labels(labels)} {v}' for (n, labels), v in sorted(counters.items()) if n == name]
+		for name, (help, label, fn) in list(self.gauges.items()):
+			try:
+				value = fn()
+			except Exception as e:
+				logging.warning(f'Could not read gauge {name}: {e}')
+				continue
+			lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+			if isinstance(value, dict):
+				lines += [f'{name}{format_labels(((label, str(k)),))} {v}' for k, v in sorted(value.items())]
+			else:
+				lines.append(f'{name} {value}')
+		return '\n'.join(lines) + '\n'
+
+	def serve(self, host: str = '127.0.0.1', port: int = 9464) -> threading.Thread:
+		# GET /metrics on a background thread
+		metrics = self
+		class Handler(BaseHTTPRequestHandler):
+			def do_GET(self):
+				if self.path.split('?')[0] != '/metrics':
+					self.send_response(404)
+					self.send_header('Content-Length', '0')
+					self.end_headers()
+					return
+				body = metrics.render().encode()
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, format, *args):
+				pass
+		self.server = ThreadingHTTPServer((host, port), Handler)
+		self.server.daemon_threads = True
+		logging.info(f'Metrics on http://{host}:{self.server.server_address[1]}/metrics')
+		t = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+		t.start()
+		return t
+
+
+def api_error(e: Exception) -> str:
+	return str(e.error_code) if isinstance(e, (ApiTelegramException, AsyncApiTelegramException)) else type(e).__name__
+
+def format_labels(labels: Labels) -> str:
+	if not labels:
+		return ''
+	escape = lambda v: v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+	return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+def thread_pools() -> dict[str, int]:
+	# Live threads by name with the worker number stripped, e.g. dispatch-3 counts as dispatch
+	pools: dict[str, int] = {}
+	for t in threading.enumerate():
+		name = re.sub(r'[-_]?\d+$', '', re.sub(r' \(.*\)$', '', t.name)) or t.name
+		pools[name] = pools.get(name, 0) + 1
+	return pools
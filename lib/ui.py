@@ -1,92 +1,273 @@
-from typing import Literal
-from time import sleep
-from threading import Event, Thread
-from lib.db.main import FolderData, FileData
+from typing import Callable, Literal
+from lib.db import Database
+from lib.db.main import FolderData, FileData, UsageData, Cursor, child_cursor, FOLDER, FILE
 from utils.funcs import sanitize_folder_name, size_to_human, mime_type_to_emoji
-from lib.io  import TelegramIO
+from lib.io  import TelegramIO, UploadCoalescer
 from lib.bot import TelegramBot
+from lib.dispatch import Dispatcher
+from lib.indexer import SearchIndexer
+from lib.metrics import Metrics
 from telebot import types as tt
+from html import escape
+from time import gmtime, strftime
 import logging
+import sqlite3
 
 
 
-class TextHandler:
-	def __init__(self) -> None:
-		self.event = Event()
-		self.result: str|None = None
+PAGE_SIZE = 40
+SEARCH_PAGE_SIZE = 20
 
+HELP_TEXT = '''
+Use /start to go to root directory
+Use /search <text> to find files and folders by name or type
+Use /usage to see how much you store
+
+While in a directory:
+  - Send a file to have it uploaded
+  - Send text message to have another folder created with that name'''
+
+
+def parse_commands(data: str) -> list[list[str]]:
+	commands = [x.split(':') for x in data.split(';')]
+	# Explorer edits its own message now, older buttons still send deleteme;explorer:...
+	return [x for i, x in enumerate(commands)
+		 if not (x[0] == 'deleteme' and i + 1 < len(commands) and commands[i + 1][0] == 'explorer')]
+
+def ensure_home(db: Database, u: int) -> FolderData:
+	with db.transaction():
+		user = db.user.get_user(u)
+		if user is None:
+			logging.info(f'New user {u}')
+			user = db.user.get_user(db.user.create_user(u))
+		root_dir = db.folder.get_folder(user.root_folder_id)
+		if root_dir is None:
+			logging.info(f'No root directory for user {u}, creating one')
+			root_dir = db.folder.get_folder(db.folder.create_folder(u, 'Home', None))
+			db.user.set_root_folder(u, root_dir.folder_id)
+	return root_dir
+
+def create_in_current(db: Database, u: int, name: str) -> bool:
+	user = db.user.get_user(u)
+	cur_folder_id = user.last_opened_folder_id if user else None
+	if cur_folder_id is None: return False
+	db.folder.create_folder(u, name, cur_folder_id)
+	return True
+
+def file_caption(file: FileData, file_size: int|None = None) -> str:
+	return f'''{mime_type_to_emoji(file.mime_type)} File <b>{file.name}</b>
 
-def main(tg: TelegramBot, storage: TelegramIO):
+<i>File size: <b>{size_to_human(file_size if file_size is not None else file.file_size)}</b>
+MIME type: <b>{file.mime_type}</b></i>
+'''
+
+def file_label(file: FileData) -> str:
+	label = f"{mime_type_to_emoji(file.mime_type)} {file.name}"
+	return f"{label} ({size_to_human(file.file_size)})" if file.file_size is not None else label
+
+def upload_summary(folder: FolderData, uploaded: list[FileData], failed: list[tt.Document]) -> str:
+	if len(uploaded) == 1 and not failed:
+		t = f"<b>✅ File \"{uploaded[0].name}\" uploaded to folder \"{folder.name}\"</b>"
+	elif uploaded:
+		t = f"<b>✅ {len(uploaded)} files uploaded to folder \"{folder.name}\"</b>"
+	else:
+		t = ''
+	if failed:
+		t += ('\n' if t else '') + f"❌ <b>File uploading failed:</b> " + ', '.join(f'"{x.file_name}"' for x in failed)
+	return t
+
+def usage_text(user: UsageData, quota: int|None, folder: FolderData|None = None, folder_usage: UsageData|None = None) -> str:
+	t = f'📊 You store <b>{user.file_count}</b> files, <b>{size_to_human(user.total_size)}</b>'
+	if quota is not None:
+		t += f' of <b>{size_to_human(quota)}</b> ({user.total_size * 100 // max(quota, 1)}%)'
+	if folder is not None and folder_usage is not None:
+		t += f'\n📂 <b>{escape(folder.name)}</b>: {folder_usage.file_count} files, {size_to_human(folder_usage.total_size)}'
+		if folder_usage.modified is not None:
+			t += f'\n<i>Last changed {strftime("%Y-%m-%d %H:%M UTC", gmtime(folder_usage.modified))}</i>'
+	return t
+
+def over_quota(db: Database, user_id: int, default_quota: int|None, extra: int = 0) -> int|None:
+	# Returns the quota if storing `extra` more bytes would exceed it, files waiting in upload jobs count as stored
+	usage = db.usage.user(user_id)
+	quota = usage.quota if usage and usage.quota is not None else default_quota
+	if quota is None:
+		return None
+	size = (usage.total_size if usage else 0) + extra
+	if size > quota or size + db.job.queued_upload_size(user_id) > quota:
+		return quota
+	return None
+
+def paste(db: Database, user_id: int, action: Literal['move','copy'], target_id: int, items: set[Cursor],
+		  default_quota: int|None = None) -> tuple[bool, str]:
+	# Moves or copies the selected items into target_id in one transaction, returns (done, reply text)
+	if not items:
+		return True, '❌ Nothing is selected'
+	target = db.folder.get_folder(target_id)
+	if target is None or target.user_id != user_id:
+		return False, '❌ This folder does not exist or you do not have necessary permissions.'
+	folders = [x for kind, id in items if kind == FOLDER and (x := db.folder.get_folder(id)) is not None and x.user_id == user_id]
+	files = [x for kind, id in items if kind == FILE and (x := db.file.get_file(id)) is not None and x.user_id == user_id]
+	# Items inside another selected folder come along with it
+	nested = db.folder.within({x.parent_folder_id for x in folders + files if x.parent_folder_id is not None}, [x.folder_id for x in folders])
+	folders = [x.folder_id for x in folders if x.parent_folder_id not in nested]
+	files = [x for x in files if x.parent_folder_id not in nested]
+	if not folders and not files:
+		return True, '❌ The selected items no longer exist'
+	if action == 'copy':
+		size = sum(db.usage.folder(x).total_size for x in folders) + sum(x.file_size or 0 for x in files)
+		if (limit := over_quota(db, user_id, default_quota, size)) is not None:
+			return False, f'❌ Copying would exceed your {size_to_human(limit)} quota'
+	try:
+		with db.transaction():
+			if folders:
+				(db.folder.move_folders if action == 'move' else db.folder.copy_folders)(folders, target_id)
+			if files:
+				(db.file.move_files if action == 'move' else db.file.copy_files)([x.file_id for x in files], target_id)
+	except ValueError as e:
+		logging.info(f'User {user_id} could not {action} into folder {target_id}: {e}')
+		return False, "❌ A folder can't be moved or copied into itself"
+	except sqlite3.Error as e:
+		logging.exception(f'User {user_id} could not {action} into folder {target_id}: {e}')
+		return False, f'❌ Could not {action} the selected items, please try again'
+	return True, f'✅ {len(folders) + len(files)} items {"moved" if action == "move" else "copied"} to "{escape(target.name)}"'
+
+def page_token(direction: Literal['a','b'], cursor: Cursor) -> str:
+	return f'{direction}{cursor[0]}.{cursor[1]}'
+
+def parse_page(token: str|None) -> tuple[Cursor|None, Cursor|None]:
+	# Returns (after, before) for get_children
+	if not token:
+		return None, None
+	kind, id = token[1:].split('.')
+	cursor = (int(kind), int(id))
+	return (cursor, None) if token[0] == 'a' else (None, cursor)
+
+def render_dir(db: Database, user_id: int, folder_id: int|None, mode: Literal['browse','delete','rename','select'] = 'browse',
+			   page: str|None = None, limit: int = PAGE_SIZE, selected: set[Cursor]|frozenset = frozenset()):
+	# Returns (text, parse_mode, keyboard rows, prev page callback, next page callback, page label)
+	# for the explorer message, or None if the folder is not accessible
+	path = db.folder.get_path(folder_id) if folder_id is not None else []
+	folder = path[-1] if path else None
+	logging.info(f'User {user_id} acessed folder {folder}')
+	if (folder is None) or (folder.user_id != user_id):
+		return None
+	current_path = '/'.join(x.name for x in path)
+	after, before = parse_page(page)
+	children = db.folder.get_children(folder_id, after=after, before=before, limit=limit + 1)
+	if before is not None:
+		has_prev, has_next = len(children) > limit, True
+		children = children[-limit:]
+	else:
+		has_prev, has_next = after is not None, len(children) > limit
+		children = children[:limit]
+	if not children and page: # Page emptied by deletes, show the first one
+		return render_dir(db, user_id, folder_id, mode, None, limit, selected)
+	prev_page = f'explorer:{folder_id}:{mode}:{page_token("b", child_cursor(children[0]))}' if has_prev else None
+	next_page = f'explorer:{folder_id}:{mode}:{page_token("a", child_cursor(children[-1]))}' if has_next else None
+	page_label = f'{db.folder.count_children(folder_id)} items'
+	buttons = [[
+		tt.InlineKeyboardButton('♻️ Refresh', callback_data=f'explorer:{folder_id}:{mode}' + (f':{page}' if page else ''))
+	], [
+		tt.InlineKeyboardButton('🗑️ Delete', callback_data=f'explorer:{folder_id}:delete'),
+		tt.InlineKeyboardButton('📦 Move/Copy', callback_data=f'explorer:{folder_id}:select'),
+		tt.InlineKeyboardButton('✏️ Rename', callback_data=f'explorer:{folder_id}:rename')
+	]]
+	if (mode == 'browse') and (len(path) > 1):
+		parent = path[-2]
+		buttons.append(tt.InlineKeyboardButton(f"📁 .. ({parent.name})", callback_data=f"explorer:{parent.folder_id}:{mode}"))	
+	if (mode == 'browse') and selected:
+		buttons.append([
+			tt.InlineKeyboardButton(f"📥 Move here ({len(selected)})", callback_data=f"paste:move:{folder_id}"),
+			tt.InlineKeyboardButton(f"📑 Copy here ({len(selected)})", callback_data=f"paste:copy:{folder_id}"),
+			tt.InlineKeyboardButton("✖️ Clear", callback_data=f"unselect:{folder_id}"),
+		])
+	if mode == 'select':
+		buttons.append(tt.InlineKeyboardButton(f"✔️ Done selecting ({len(selected)})", callback_data=f"explorer:{folder_id}"))
+	elif mode != 'browse':
+		buttons.append(tt.InlineKeyboardButton(f"✖️ Cancel {({'delete':'deleting','rename':'renaming'})[mode]}", callback_data=f"explorer:{folder_id}"))	
+	t = f'📂 Current directory: <b>{current_path}</b>'
+	if mode == 'delete':
+		t = f'\n<b>Select file/directory to be deleted:</b>'
+	if mode == 'rename':
+		t = f'\n<b>Select directory to rename (renaming files isn\'t supported yet):</b>'
+	if mode == 'select':
+		t = f'\n<b>Select files/directories, then open the destination directory and move or copy them there:</b>'
+	folder_buttons, file_buttons = [], []
+	if children:
+		buttons.append(tt.InlineKeyboardButton('---------', callback_data='none'))
+		if mode == 'browse':
+			folder_buttons = [tt.InlineKeyboardButton(f"📁 {x.name}", callback_data=f"explorer:{x.folder_id}") for x in children if isinstance(x, FolderData)]
+			file_buttons = [tt.InlineKeyboardButton(file_label(x), callback_data=f"file:{x.file_id}") for x in children if isinstance(x, FileData)]
+		elif mode == 'delete':
+			folder_buttons = [tt.InlineKeyboardButton(f"[CLICK TO DELETE] 📁 {x.name}", callback_data=f"delete_folder:{x.folder_id}") for x in children if isinstance(x, FolderData)]
+			file_buttons = [tt.InlineKeyboardButton(f"[CLICK TO DELETE] {file_label(x)}", callback_data=f"delete_file:{x.file_id}") for x in children if isinstance(x, FileData)]
+		elif mode == 'rename':
+			folder_buttons = [tt.InlineKeyboardButton(f"[CLICK TO RENAME] 📁 {x.name}", callback_data=f"rename_folder:{x.folder_id};explorer:{folder_id}:browse") for x in children if isinstance(x, FolderData)]
+		elif mode == 'select':
+			back = f"{folder_id}" + (f":{page}" if page else '')
+			mark = lambda x: '✅' if child_cursor(x) in selected else '⬜'
+			folder_buttons = [tt.InlineKeyboardButton(f"{mark(x)} 📁 {x.name}", callback_data=f"select:{FOLDER}:{x.folder_id}:{back}") for x in children if isinstance(x, FolderData)]
+			file_buttons = [tt.InlineKeyboardButton(f"{mark(x)} {file_label(x)}", callback_data=f"select:{FILE}:{x.file_id}:{back}") for x in children if isinstance(x, FileData)]
+	else:
+		t += '\n\n<i>(empty)</i>'
+	return t, None, [x if isinstance(x, list) else [x,] for x in (buttons + folder_buttons + file_buttons)], prev_page, next_page, page_label
+
+def render_search(db: Database, user_id: int, text: str, offset: int = 0, limit: int = SEARCH_PAGE_SIZE):
+	# Same shape as render_dir, results link to the file preview or the folder
+	results = db.search.search(user_id, text, limit + 1, offset)
+	has_next, results = len(results) > limit, results[:limit]
+	prev_page = f'search:{max(offset - limit, 0)}' if offset > 0 else None
+	next_page = f'search:{offset + limit}' if has_next else None
+	page_label = f'{offset + 1}-{offset + len(results)}' if results else ''
+	t = f'🔎 Search results for <b>{escape(text)}</b>'
+	if not results:
+		t += '\n\n<i>(nothing found)</i>'
+	buttons = [[
+		tt.InlineKeyboardButton(f"📁 {x.name}", callback_data=f"explorer:{x.folder_id}") if isinstance(x, FolderData) else
+		tt.InlineKeyboardButton(file_label(x), callback_data=f"file:{x.file_id}")
+	] for x in results]
+	return t, None, buttons, prev_page, next_page, page_label
+
+
+
+def main(tg: TelegramBot, storage: TelegramIO, upload_window: float = 1.5, workers: int = 8, quota: int|None = None,
+		 metrics: Metrics|None = None):
+	# quota (bytes) applies to users without a quota of their own, None for unlimited.
+	# With metrics set, callback commands are timed and traced and the handler state is exported as gauges
 	db = storage.db
-	text_handlers: dict[int, TextHandler] = {}
-	def wait_for_text(user_id: int, timeout: int = None):
-		text_handlers[user_id] = t = TextHandler()
-		t.event.wait(timeout)
-		r = t.result
-		del text_handlers[user_id]
-		return r
+	dispatcher = Dispatcher(workers)
+	# Pending text prompts, the callback runs on the dispatcher when the user answers
+	text_handlers: dict[int, Callable[[str], None]] = {}
+	# Last search text per user, result pages only carry the offset in their callback data
+	searches: dict[int, str] = {}
+	# Items picked for move/copy per user, kept while the user walks to the destination
+	selections: dict[int, set[Cursor]] = {}
+	if metrics is not None:
+		metrics.gauge('tgdrive_text_handlers_pending', 'Prompts waiting for an answer from the user', lambda: len(text_handlers))
+		metrics.gauge('tgdrive_dispatcher_pending', 'Commands queued or running on the dispatcher', dispatcher.depth)
 
 
 	def preview_file(user_id: int, file_id: int):
 		file = db.file.get_file(file_id)
-		msg = tg.bot.send_document(chat_id=user_id, document=file.actual_file_id, caption="⏳ Please wait...")
-		f = msg.document
 		kb = tt.InlineKeyboardMarkup([
 			[tt.InlineKeyboardButton("🆗", callback_data='deleteme')]
 		])
-		tg.bot.edit_message_caption(
-f'''{mime_type_to_emoji(file.mime_type)} File <b>{file.name}</b>
-
-<i>File size: <b>{size_to_human(f.file_size)}</b>
-MIME type: <b>{file.mime_type}</b></i>
-''', user_id, msg.message_id, reply_markup=kb)
+		if file.file_size is not None:
+			tg.call(user_id, tg.bot.send_document, user_id, file.actual_file_id, caption=file_caption(file), reply_markup=kb)
+			return
+		# Size wasn't recorded for this file yet, learn it from the sent document and keep it for next time
+		msg = tg.call(user_id, tg.bot.send_document, user_id, file.actual_file_id, caption="⏳ Please wait...")
+		f = msg.document
+		tg.call(user_id, tg.bot.edit_message_caption, file_caption(file, f.file_size), user_id, msg.message_id, reply_markup=kb)
+		db.file.set_file_size(file.file_id, f.file_size)
 
-	def explore_dir(user_id: int, folder_id: int|None, mode: Literal['browse','delete','rename'] = 'browse'):
-		folder = db.folder.get_folder(folder_id)
-		logging.info(f'User {user_id} acessed folder {folder}')
-		if (folder is None) or (folder.user_id != user_id):
+	def explore_dir(user_id: int, folder_id: int|None, mode: Literal['browse','delete','rename','select'] = 'browse', page: str|None = None,
+				 message: tt.Message|None = None):
+		r = render_dir(db, user_id, folder_id, mode, page, selected=selections.get(user_id, frozenset()))
+		if r is None:
 			tg.text(user_id, '❌ This folder does not exist or you do not have necessary permissions.')
 			return
-		current_path = []
-		c_folder = folder
-		while c_folder:
-			current_path.append(c_folder.name)
-			p = c_folder.parent_folder_id
-			c_folder = db.folder.get_folder(p) if p else None
-		current_path = '/'.join(current_path[::-1])
-		children = db.folder.get_children(folder_id)
-		buttons = [[
-			tt.InlineKeyboardButton('♻️ Refresh', callback_data=f'deleteme;explorer:{folder_id}:{mode}')
-		], [
-			tt.InlineKeyboardButton('🗑️ Delete', callback_data=f'deleteme;explorer:{folder_id}:delete'),
-			tt.InlineKeyboardButton('📦 Move', callback_data=f'maint'),
-			tt.InlineKeyboardButton('✏️ Rename', callback_data=f'deleteme;explorer:{folder_id}:rename')
-		]]
-		if (mode == 'browse') and (folder.parent_folder_id is not None):
-			parent = db.folder.get_folder(folder.parent_folder_id)
-			buttons.append(tt.InlineKeyboardButton(f"📁 .. ({parent.name})", callback_data=f"deleteme;explorer:{parent.folder_id}:{mode}"))	
-		if mode != 'browse':
-			buttons.append(tt.InlineKeyboardButton(f"✖️ Cancel {({'delete':'deleting','rename':'renaming'})[mode]}", callback_data=f"deleteme;explorer:{folder_id}"))	
-		t = f'📂 Current directory: <b>{current_path}</b>'
-		if mode == 'delete':
-			t = f'\n<b>Select file/directory to be deleted:</b>'
-		if mode == 'rename':
-			t = f'\n<b>Select directory to rename (renaming files isn\'t supported yet):</b>'
-		if children:
-			buttons.append(tt.InlineKeyboardButton('---------', callback_data='none'))
-			if mode == 'browse':
-				folder_buttons = [tt.InlineKeyboardButton(f"📁 {x.name}", callback_data=f"deleteme;explorer:{x.folder_id}") for x in children if isinstance(x, FolderData)]
-				file_buttons = [tt.InlineKeyboardButton(f"{mime_type_to_emoji(x.mime_type)} {x.name}", callback_data=f"file:{x.file_id}") for x in children if isinstance(x, FileData)]
-			elif mode == 'delete':
-				folder_buttons = [tt.InlineKeyboardButton(f"[CLICK TO DELETE] 📁 {x.name}", callback_data=f"delete_folder:{x.folder_id}") for x in children if isinstance(x, FolderData)]
-				file_buttons = [tt.InlineKeyboardButton(f"[CLICK TO DELETE] {mime_type_to_emoji(x.mime_type)} {x.name}", callback_data=f"delete_file:{x.file_id}") for x in children if isinstance(x, FileData)]
-			elif mode == 'rename':
-				folder_buttons = [tt.InlineKeyboardButton(f"[CLICK TO RENAME] 📁 {x.name}", callback_data=f"rename_folder:{x.folder_id};deleteme;explorer:{folder_id}:browse") for x in children if isinstance(x, FolderData)]
-				file_buttons = []
-			all_buttons = [x if isinstance(x, list) else [x,] for x in (buttons + folder_buttons + file_buttons)]
-			tg.list(user_id, t, None, all_buttons)
-		else:
-			tg.text(user_id, t+'\n\n<i>(empty)</i>', keyboard=tt.InlineKeyboardMarkup([x if isinstance(x, list) else [x,] for x in buttons]))
+		tg.list(user_id, *r, message=message)
 		db.user.set_last_opened_folder(user_id, folder_id)
 
 	def confirm_delete_folder(confirmed: bool, user_id: int, folder_id: int ):
@@ -100,10 +281,10 @@ MIME type: <b>{file.mime_type}</b></i>
 		if not confirmed:
 			return tg.text(user_id, f"Are you sure you want to delete folder \"{folder.name}\"?", keyboard=kb)
 		try:
-			db.folder.delete_folder(folder.folder_id)
+			storage.delete_folder(folder.folder_id)
 			tg.text(user_id, f"✅ Folder \"{folder.name}\" deleted")
 		except Exception as e:
-			logging.error(f"Error deleting folder {folder_id} by user {user_id}", e)
+			logging.error(f"Error deleting folder {folder_id} by user {user_id}: {e}")
 			tg.text(user_id, "❌ Error deleting folder")
 			
 	def confirm_delete_file(confirmed: bool, user_id: int, file_id: int ):
@@ -117,92 +298,121 @@ MIME type: <b>{file.mime_type}</b></i>
 		if not confirmed:
 			return tg.text(user_id, f"Are you sure you want to delete file \"{file.name}\"?", keyboard=kb)
 		try:
-			db.file.delete_file(file.file_id)
+			storage.delete(file.file_id)
 			tg.text(user_id, f"✅ File \"{file.name}\" deleted")
 		except Exception as e:
-			logging.error(f"Error deleting file {file_id} by user {user_id}")
+			logging.error(f"Error deleting file {file_id} by user {user_id}: {e}")
 			tg.text(user_id, "❌ Error deleting file")
 
 	def rename_folder(user_id: int, folder_id: int):
 		folder = db.folder.get_folder(folder_id)
 		tg.text(user_id, f'Send the new name for folder {folder.name}')
-		new_folder_name = wait_for_text(user_id)
+		text_handlers[user_id] = lambda t: do_rename_folder(user_id, folder_id, t)
+
+	def do_rename_folder(user_id: int, folder_id: int, new_folder_name: str):
 		try:
 			db.folder.rename_folder(folder_id, new_folder_name)
 			logging.info(f"User {user_id} renamed folder {folder_id} to \"{new_folder_name}\"")
 			tg.text(user_id, f'✅ Folder renamed to \"{new_folder_name}\"')
 		except Exception as e:
-			logging.error(f"Error renaming folder {folder_id} by user {user_id} to \"{new_folder_name}\"")
+			logging.error(f"Error renaming folder {folder_id} by user {user_id} to \"{new_folder_name}\": {e}")
 			tg.text(user_id, f'❌ Error renaming folder')
 
 
 
+	def search(user_id: int, text: str|None, offset: int = 0, message: tt.Message|None = None):
+		if text is None:
+			return tg.text(user_id, '⌛ This search has expired, use /search again')
+		searches[user_id] = text
+		tg.list(user_id, *render_search(db, user_id, text, offset), message=message)
+
+
+	def toggle_selected(user_id: int, kind: int, item_id: int, folder_id: int, page: str|None, message: tt.Message):
+		selected = selections.setdefault(user_id, set())
+		selected.symmetric_difference_update({(kind, item_id)})
+		explore_dir(user_id, folder_id, 'select', page, message)
+
+	def paste_selected(user_id: int, action: Literal['move','copy'], folder_id: int, message: tt.Message):
+		done, text = paste(db, user_id, action, folder_id, selections.get(user_id, set()), quota)
+		if done:
+			selections.pop(user_id, None)
+		tg.text(user_id, text)
+		explore_dir(user_id, folder_id, 'browse', None, message)
+
+
+	def upload_done(user_id: int, folder: FolderData, uploaded: list[FileData], failed: list[tt.Document]):
+		tg.text(user_id, upload_summary(folder, uploaded, failed))
+
+	storage.on_uploaded = upload_done
+	storage.jobs.start()
+	SearchIndexer(db).start()
+	uploads = UploadCoalescer(storage.enqueue_upload, upload_window)
+
+
 
 	@tg.bot.message_handler(commands=['help'])
 	def help(msg: tt.Message):
-		tg.bot.reply_to(msg, '''
-Use /start to go to root directory
-
-While in a directory:
-  - Send a file to have it uploaded
-  - Send text message to have another folder created with that name''')
+		tg.call(msg.chat.id, tg.bot.reply_to, msg, HELP_TEXT)
 
 	@tg.bot.message_handler(commands=['start'])
 	def start(msg: tt.Message):
 		u = msg.chat.id
-		user = db.user.get_user(u)
-		if user is None:
-			logging.info(f'New user {u}')
-			user = db.user.get_user(db.user.create_user(u))
-		root_dir = db.folder.get_folder(user.root_folder_id)
-		if root_dir is None:
-			logging.info(f'No root directory for user {u}, creating one')
-			root_dir = db.folder.get_folder(db.folder.create_folder(u, 'Home', None))
-			db.user.set_root_folder(u, root_dir.folder_id)
-		explore_dir(u, root_dir.folder_id)
+		explore_dir(u, ensure_home(db, u).folder_id)
 	
+	@tg.bot.message_handler(commands=['search'])
+	def search_command(msg: tt.Message):
+		u = msg.chat.id
+		text = msg.text.partition(' ')[2].strip()
+		if text:
+			dispatcher.submit(u, 'search', search, u, text)
+		else:
+			tg.text(u, 'Send the name or type of the file or folder to look for')
+			text_handlers[u] = lambda t: search(u, t)
+
+	@tg.bot.message_handler(commands=['usage'])
+	def usage(msg: tt.Message):
+		u = msg.chat.id
+		user = db.user.get_user(u)
+		if user is None or (total := db.usage.user(u)) is None:
+			return tg.text(u, 'Use /start first')
+		folder_id = user.last_opened_folder_id
+		folder = db.folder.get_folder(folder_id) if folder_id is not None else None
+		tg.text(u, usage_text(total, total.quota if total.quota is not None else quota, folder,
+							 db.usage.folder(folder_id) if folder is not None else None))
+
 	@tg.bot.message_handler(content_types=['text'])
 	def handle_text(msg: tt.Message):
 		u = msg.chat.id
 		t = msg.text # or msg.caption
-		if (h := text_handlers.get(u, None)) is not None: # Answer TextHandler
-			h.result = t
-			h.event.set()
+		if (h := text_handlers.pop(u, None)) is not None: # Answer pending prompt
+			dispatcher.submit(u, 'text_reply', h, t)
 		else: # Create new folder
 			name = sanitize_folder_name(t)
 			if name:
-				user = db.user.get_user(u)
-				cur_folder_id = user.last_opened_folder_id if user else None
-				if cur_folder_id is None: return
-				db.folder.create_folder(u, name, cur_folder_id)
-				tg.text(u, f"✅ Folder '{name}' created")
+				if create_in_current(db, u, name):
+					tg.text(u, f"✅ Folder '{name}' created")
 			else:
 				tg.text(u, "❌ Invalid folder name, try again")
 
 	@tg.bot.message_handler(content_types=['document'])
 	def upload_file(msg: tt.Message):
 		f = msg.document
-		# TODO: Handle multiple files uploaded, to avoid rate limit (storage.upload gets rate limited too)
-		# Maybe do a media group upload to storage, or wait before uploading all files user sent in a period of time
 		u = msg.chat.id
 		user = db.user.get_user(u)
 		if (folder_id := user.last_opened_folder_id) is None: return
 		folder = db.folder.get_folder(folder_id)
 		logging.info(f'File from {u} to folder {folder_id}: {f.file_name} ({f.mime_type}) of size {size_to_human(f.file_size)}')
-		try:
-			file: FileData = storage.upload(f, folder)
-			tg.text(u, f"<b>✅ File \"{file.name}\" uploaded to folder \"{folder.name}\"</b>")
-			# try: tg.delete(msg)
-			# except Exception as e: print(e)
-		except Exception as e:
-			tg.text(u, f"❌ <b>File uploading failed:</b> {e}")
+		# Files still waiting in the upload window count too
+		if (limit := over_quota(db, u, quota, uploads.pending_size(u) + (f.file_size or 0))) is not None:
+			return tg.text(u, f'❌ File "{escape(f.file_name or "")}" not uploaded, it would exceed your {size_to_human(limit)} quota')
+		uploads.add(u, f, folder, msg.message_id)
 
 	@tg.bot.callback_query_handler(func = lambda x: True)
 	def buttons_handle(query: tt.CallbackQuery):
-		commands = [x.split(':') for x in query.data.split(';')]
+		commands = parse_commands(query.data)
 		user_id = query.from_user.id
 		logging.info(f"Callback from {user_id}: {commands}")
-		def handle_command(command):
+		def handle_command(command: list[str]):
 			cmd = command[0]
 			args = command[1:]
 			try:
@@ -213,7 +423,16 @@ While in a directory:
 				elif cmd == 'maint':
 					tg.text(user_id, "🚧 Please try again later, this option is now under maintenance 🚧")
 				elif cmd == 'explorer':
-					explore_dir(user_id, int(args[0]), args[1] if len(args) > 1 else 'browse')
+					explore_dir(user_id, int(args[0]), args[1] if len(args) > 1 else 'browse', args[2] if len(args) > 2 else None, query.message)
+				elif cmd == 'search':
+					search(user_id, searches.get(user_id), int(args[0]), query.message)
+				elif cmd == 'select':
+					toggle_selected(user_id, int(args[0]), int(args[1]), int(args[2]), args[3] if len(args) > 3 else None, query.message)
+				elif cmd == 'unselect':
+					selections.pop(user_id, None)
+					explore_dir(user_id, int(args[0]), 'browse', None, query.message)
+				elif cmd == 'paste':
+					paste_selected(user_id, args[0], int(args[1]), query.message)
 				elif cmd == 'file':
 					preview_file(user_id, int(args[0]))
 				elif cmd == 'delete_folder':
@@ -224,7 +443,10 @@ While in a directory:
 					rename_folder(user_id, int(args[0]))
 			except Exception as e:
 				logging.error(f"Error in callback command \"{cmd}\" with args {args}: {e}")
+		def handle_traced(command: list[str]):
+			with metrics.trace(command[0], user_id):
+				handle_command(command)
 		for command in commands:
-			Thread(target=handle_command, args=(command, )).start()
+			dispatcher.submit(user_id, command[0], handle_command if metrics is None else handle_traced, command)
 
-	tg.polling()
\ No newline at end of file
+	tg.run()
\ No newline at end of file
@@ -0,0 +1,101 @@
+import hmac
+import json
+import logging
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Full, Queue
+from threading import Thread
+from time import monotonic
+from telebot import TeleBot, types as tt
+from lib.base import Service
+
+
+class HTTPServer(ThreadingHTTPServer):
+	daemon_threads = True
+	# Telegram opens up to 40 connections at once (max_connections of setWebhook), the default backlog of 5 resets some
+	request_queue_size = 128
+
+
+class WebhookServer(Service):
+	# Accepts update POSTs from Telegram, checks the secret token, acknowledges right away
+	# and leaves the processing to a fixed set of workers reading from a bounded queue.
+	# A full queue answers 503 so Telegram redelivers the update later.
+	def __init__(self, bot: TeleBot, secret: str, host: str = '0.0.0.0', port: int = 8443,
+			  path: str = '/', workers: int = 4, max_queue: int = 1000):
+		# Without the secret anyone reaching the port could post updates in any user's name
+		if not secret:
+			raise ValueError("Webhook server needs a secret token")
+		self.bot = bot
+		self.secret = secret
+		self.path = path
+		self.queue: Queue = Queue(max_queue)
+		self.latencies: deque[float] = deque(maxlen=100000)
+		self.received = 0
+		self.rejected = 0
+		self.server = HTTPServer((host, port), self._handler())
+		self.workers = [Thread(target=self.worker, name=f'webhook-{i}', daemon=True) for i in range(workers)]
+		for t in self.workers:
+			t.start()
+
+	@property
+	def port(self) -> int:
+		return self.server.server_address[1]
+
+	def _handler(self):
+		server = self
+		class Handler(BaseHTTPRequestHandler):
+			# Keep-alive, Telegram reuses its connections for later updates
+			protocol_version = 'HTTP/1.1'
+
+			def do_POST(self):
+				if self.path != server.path:
+					return self.reply(404, close=True)
+				token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+				if not hmac.compare_digest(token.encode(), server.secret.encode()):
+					return self.reply(403, close=True)
+				try:
+					update = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+				except ValueError:
+					return self.reply(400)
+				try:
+					server.queue.put_nowait((monotonic(), update))
+				except Full:
+					server.rejected += 1
+					return self.reply(503)
+				server.received += 1
+				self.reply(200)
+
+			def reply(self, code: int, close: bool = False):
+				# close when the request body was left unread
+				self.close_connection = close
+				self.send_response(code)
+				self.send_header('Content-Length', '0')
+				if close:
+					self.send_header('Connection', 'close')
+				self.end_headers()
+
+			def log_message(self, format, *args):
+				pass
+		return Handler
+
+	def worker(self):
+		while True:
+			received, update = self.queue.get()
+			try:
+				self.bot.process_new_updates([tt.Update.de_json(update)])
+			except Exception as e:
+				logging.error(f'Error processing update {update.get("update_id")}: {e}')
+			self.latencies.append(monotonic() - received)
+
+	def serve_forever(self):
+		logging.info(f'Webhook server listening on {self.server.server_address}')
+		self.server.serve_forever()
+
+	def start(self) -> Thread:
+		t = Thread(target=self.serve_forever, name='webhook-server', daemon=True)
+		t.start()
+		return t
+
+	def shutdown(self):
+		self.server.shutdown()
+		self.server.server_close()
@@ -4,17 +4,53 @@ from lib.db  import Database
 from lib.io  import TelegramIO
 from lib.bot import TelegramBot
 from lib.ui  import main
+from lib.metrics import Metrics
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
 
-tg = TelegramBot(cfg.get('TG_BOT_KEY'))
+upload_window = float(cfg.get('UPLOAD_WINDOW', 1.5))
+quota = int(float(cfg.get('QUOTA_MB')) * 1024 * 1024) if cfg.get('QUOTA_MB') else None
 
-db = Database()
+# Prometheus metrics on METRICS_PORT, callbacks slower than SLOW_CALLBACK_MS are logged with their DB and API steps
+metrics = None
+if cfg.get('METRICS_PORT') or cfg.get('SLOW_CALLBACK_MS'):
+	metrics = Metrics(float(cfg.get('SLOW_CALLBACK_MS')) / 1000 if cfg.get('SLOW_CALLBACK_MS') else None)
+	if path := cfg.get('TRACE_LOG'):
+		metrics.trace_log.addHandler(logging.FileHandler(path))
+		metrics.trace_log.propagate = False
+	if cfg.get('METRICS_PORT'):
+		metrics.serve(cfg.get('METRICS_HOST', '127.0.0.1'), int(cfg.get('METRICS_PORT')))
 
-storage_chat = tg.bot.get_chat(int(cfg.get('STORAGE_CHAT')))
-storage = TelegramIO(storage_chat, tg, db)
+if cfg.get('RUNTIME') == 'async':
+	import asyncio
+	from lib.aio import AsyncTelegramBot, AsyncDatabase, AsyncTelegramIO
+	from lib.aio.ui import main as async_main
 
+	async def run():
+		tg = AsyncTelegramBot(cfg.get('TG_BOT_KEY'), metrics=metrics)
+		db = AsyncDatabase(Database(), int(cfg.get('DB_WORKERS', 4)))
+		if metrics is not None:
+			metrics.instrument(db.db)
+		storage_chat = await tg.bot.get_chat(int(cfg.get('STORAGE_CHAT')))
+		storage = AsyncTelegramIO(storage_chat, tg, db)
+		await async_main(tg, storage, upload_window, quota=quota, metrics=metrics)
 
-main(tg, storage)
\ No newline at end of file
+	asyncio.run(run())
+else:
+	tg = TelegramBot(cfg.get('TG_BOT_KEY'), metrics=metrics, threaded=not cfg.get('WEBHOOK_URL'))
+
+	db = Database()
+	if metrics is not None:
+		metrics.instrument(db)
+
+	storage_chat = tg.bot.get_chat(int(cfg.get('STORAGE_CHAT')))
+	storage = TelegramIO(storage_chat, tg, db, int(cfg.get('JOB_WORKERS', 2)))
+
+	if url := cfg.get('WEBHOOK_URL'):
+		tg.use_webhook(url, cfg.get('WEBHOOK_SECRET'), cfg.get('WEBHOOK_HOST', '0.0.0.0'),
+				 int(cfg.get('WEBHOOK_PORT', 8443)), int(cfg.get('WEBHOOK_WORKERS', 4)))
+
+
+	main(tg, storage, upload_window, int(cfg.get("WORKERS", 8)), quota, metrics)